@@ -0,0 +1,249 @@
+"""Append-only pack file holding archived chats, with an offset index.
+
+Archiving tens of thousands of chats as separate files wastes inodes and
+makes every directory walk slow.  Instead each archived chat is appended to
+one pack file and an index records where it starts and how long it is.
+Deleting only writes an index record, clearing starts a fresh pack, and the
+space of deleted chats is reclaimed by repacking in a background thread.
+
+The index is a JSON lines file like the chat journals: a header naming the
+pack generation, then ``put`` and ``del`` records.  A chat's bytes are
+written and synced before its ``put`` record, so a crash can only leave
+unreferenced bytes behind, which the next repack drops.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+INDEX_FORMAT = 1
+# Repack once deleted chats take more than this many bytes and more than
+# the live ones
+REPACK_MIN_BYTES = 1 << 20
+
+
+def _dump_record(record):
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+class ArchivePack:
+    """Archived chats stored in ``directory`` as one pack file and its index.
+
+    Chats are keyed by their path below the archive directory, such as
+    ``autosave/autosave-20240101-120000.chat``.  Every method is thread-safe,
+    and the index is reloaded when another process changed it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "pack.idx")
+        self._lock = threading.RLock()
+        self._repacking = False
+        self._index_stat = None
+        self._load()
+
+    def _pack_path(self, generation=None):
+        gen = self.generation if generation is None else generation
+        return os.path.join(self.directory, f"pack-{gen}.dat")
+
+    def _load(self):
+        self.generation = 0
+        self._entries = {}
+        try:
+            with open(self.index_path, "r") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        for n, line in enumerate(lines):
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn last line from a crash mid-append
+                break
+            if n == 0:
+                self.generation = rec.get("generation", 0)
+            elif rec.get("op") == "put":
+                self._entries[rec["file"]] = (rec["at"], rec["len"], rec["time"])
+            elif rec.get("op") == "del":
+                self._entries.pop(rec["file"], None)
+        try:
+            self._size = os.path.getsize(self._pack_path())
+        except OSError:
+            self._size = 0
+        # Drop entries pointing past the end of a truncated pack
+        self._entries = {k: e for k, e in self._entries.items() if e[0] + e[1] <= self._size}
+        if not lines:
+            self._write_index(self.generation, {})
+        self._index_stat = self._stat_index()
+
+    def _stat_index(self):
+        try:
+            st = os.stat(self.index_path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def _refresh(self):
+        """Reload the index if another process wrote to it."""
+        if self._stat_index() != self._index_stat:
+            self._load()
+
+    def _write_index(self, generation, entries):
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(_dump_record({"archive": INDEX_FORMAT, "generation": generation}))
+            for name, (at, length, added) in entries.items():
+                f.write(_dump_record({"op": "put", "file": name, "at": at, "len": length, "time": added}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.index_path)
+
+    def _log(self, record):
+        with open(self.index_path, "a") as f:
+            f.write(_dump_record(record))
+            f.flush()
+            os.fsync(f.fileno())
+        self._index_stat = self._stat_index()
+
+    def __contains__(self, name):
+        with self._lock:
+            self._refresh()
+            return name in self._entries
+
+    def names(self):
+        """Return ``{name: archived_time}`` for every archived chat."""
+        with self._lock:
+            self._refresh()
+            return {name: e[2] for name, e in self._entries.items()}
+
+    def get(self, name):
+        """Return the stored bytes of ``name`` or ``None``."""
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            with open(self._pack_path(), "rb") as f:
+                f.seek(entry[0])
+                return f.read(entry[1])
+
+    def put(self, name, data):
+        """Append the chat file contents ``data`` under ``name``."""
+        with self._lock:
+            self._refresh()
+            with open(self._pack_path(), "ab") as f:
+                at = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            added = time.time()
+            self._log({"op": "put", "file": name, "at": at, "len": len(data), "time": added})
+            self._entries[name] = (at, len(data), added)
+            self._size = at + len(data)
+            self._maybe_repack()
+
+    def delete(self, name):
+        """Forget ``name`` and return whether it was archived."""
+        with self._lock:
+            self._refresh()
+            if name not in self._entries:
+                return False
+            self._log({"op": "del", "file": name})
+            del self._entries[name]
+            self._maybe_repack()
+            return True
+
+    def clear(self):
+        """Drop every archived chat by starting a new, empty pack."""
+        with self._lock:
+            self._refresh()
+            old = self._pack_path()
+            self.generation += 1
+            self._write_index(self.generation, {})
+            self._index_stat = self._stat_index()
+            self._entries = {}
+            self._size = 0
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Return the number of archived chats and the live and total pack bytes."""
+        with self._lock:
+            live = sum(e[1] for e in self._entries.values())
+            return {
+                "chats": len(self._entries),
+                "live_bytes": live,
+                "pack_bytes": self._size,
+                "repacking": self._repacking,
+            }
+
+    def _maybe_repack(self):
+        live = sum(e[1] for e in self._entries.values())
+        dead = self._size - live
+        if dead > REPACK_MIN_BYTES and dead > live and not self._repacking:
+            self._repacking = True
+            threading.Thread(target=self._repack_in_background, daemon=True).start()
+
+    def _repack_in_background(self):
+        try:
+            self.repack()
+        except Exception as e:
+            print(f"[Error] Could not repack the chat archive: {e}", file=sys.stderr)
+        finally:
+            with self._lock:
+                self._repacking = False
+
+    def repack(self):
+        """Copy the live chats into a new pack and drop the old one.
+
+        Old pack bytes never change, so the bulk of the copy runs without the
+        lock; chats archived or deleted meanwhile are caught up at the end.
+        The copy is written under a temporary name and only renamed into
+        place if the archive was not cleared or repacked in the meantime.
+        """
+        with self._lock:
+            self._refresh()
+            generation = self.generation
+            snapshot = dict(self._entries)
+        src = self._pack_path(generation)
+        tmp = f"{self._pack_path(generation + 1)}.tmp"
+        moved = {}
+        try:
+            with open(src, "rb") as fin, open(tmp, "wb") as fout:
+                for name, (at, length, added) in snapshot.items():
+                    fin.seek(at)
+                    moved[name] = (fout.tell(), length, added)
+                    fout.write(fin.read(length))
+            with self._lock:
+                self._refresh()
+                if self.generation != generation:
+                    # Cleared or repacked by someone else in the meantime
+                    os.remove(tmp)
+                    return
+                with open(src, "rb") as fin, open(tmp, "ab") as fout:
+                    for name, entry in self._entries.items():
+                        if snapshot.get(name) != entry:
+                            fin.seek(entry[0])
+                            moved[name] = (fout.tell(), entry[1], entry[2])
+                            fout.write(fin.read(entry[1]))
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                    size = fout.tell()
+                os.replace(tmp, self._pack_path(generation + 1))
+                entries = {name: moved[name] for name in self._entries}
+                self._write_index(generation + 1, entries)
+                self._index_stat = self._stat_index()
+                self.generation = generation + 1
+                self._entries = entries
+                self._size = size
+                os.remove(src)
+        except FileNotFoundError:
+            # The archive was cleared before the copy started
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,395 @@
+"""Benchmarks for GroqChat that run against a local mock of the Groq API.
+
+    python benchmark.py                  # full run, JSON on stdout
+    python benchmark.py --quick -o a.json
+    python benchmark.py --only api_message,chat_io
+
+Each benchmark runs in its own process and temporary directory, so chats and
+catalogs from one never affect another.  The mock API (mock_groq.py) is
+started on a free port and every client is pointed at it through
+``GROQ_BASE_URL``; no API quota is used.  Compare the JSON of two versions to
+spot regressions.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ["api_message", "list_chats", "chat_io", "storage", "cli_turn"]
+
+
+def percentile(values, pct):
+    """Return the ``pct`` percentile of ``values`` (nearest rank)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+def latency_summary(seconds):
+    """Summarize a list of durations in milliseconds."""
+    ms = [s * 1000 for s in seconds]
+    return {
+        "count": len(ms),
+        "mean_ms": statistics.fmean(ms) if ms else None,
+        "p50_ms": percentile(ms, 50),
+        "p99_ms": percentile(ms, 99),
+        "max_ms": max(ms) if ms else None,
+    }
+
+
+def make_chat(count, length=200):
+    """Return a chat with ``count`` alternating messages of ``length`` characters."""
+    import logic
+
+    chat_data, _ = logic.get_new_session_state()
+    filler = ("lorem ipsum dolor sit amet " * (length // 27 + 1))[:length]
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        chat_data["messages"].append({"role": role, "content": f"{i} {filler}"})
+    return chat_data
+
+
+# --- benchmarks, each run inside a worker process ---
+
+def bench_api_message(params):
+    """Throughput and latency of POST /api/message with concurrent sessions."""
+    import httpx
+    import server
+
+    requests = params["requests"]
+    concurrency = params["concurrency"]
+    latencies = []
+    errors = 0
+
+    async def user(number):
+        nonlocal errors
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as c:
+            for turn in range(number, requests, concurrency):
+                start = time.perf_counter()
+                r = await c.post("/api/message", json={"message": f"benchmark message {turn}"})
+                latencies.append(time.perf_counter() - start)
+                if r.status_code != 200 or "assistant" not in r.json().get("result", {}):
+                    errors += 1
+
+    async def run():
+        async with server.lifespan(server.app):
+            start = time.perf_counter()
+            await asyncio.gather(*(user(n) for n in range(concurrency)))
+            return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "seconds": elapsed,
+        "requests_per_second": requests / elapsed,
+        **latency_summary(latencies),
+    }
+
+
+def bench_list_chats(params):
+    """Time listing chats with the catalog cold (first start) and warm."""
+    import logic
+    import server
+
+    count = params["chats"]
+    logic.ensure_directories()
+    chat = make_chat(4)
+    start = time.perf_counter()
+    for i in range(count):
+        chat["name"] = f"Chat {i}"
+        path = os.path.join(logic.AUTOSAVE_DIR, f"autosave-bench-{i:06d}.chat")
+        logic.compact_chat_file(path, chat)
+    prepare = time.perf_counter() - start
+
+    start = time.perf_counter()
+    listed = server.list_chats()
+    cold = time.perf_counter() - start
+    warm = []
+    for _ in range(params["repeat"]):
+        start = time.perf_counter()
+        server.list_chats()
+        warm.append(time.perf_counter() - start)
+    return {
+        "chats": count,
+        "listed": sum(len(v) for v in listed.values()),
+        "prepare_seconds": prepare,
+        "cold_ms": cold * 1000,
+        "warm": latency_summary(warm),
+    }
+
+
+def bench_chat_io(params):
+    """Save, append to and load a chat with many messages."""
+    import logic
+
+    count = params["messages"]
+    logic.start_save_worker()
+    chat_data = make_chat(count)
+    filename = os.path.join("autosave", "bench.chat")
+
+    start = time.perf_counter()
+    logic.save_chat_to_file(filename, chat_data)
+    logic.flush_saves()
+    first_save = time.perf_counter() - start
+
+    appends = []
+    for i in range(params["appends"]):
+        chat_data["messages"].append({"role": "user", "content": f"appended {i}"})
+        start = time.perf_counter()
+        logic.save_chat_to_file(filename, chat_data)
+        logic.flush_saves()
+        appends.append(time.perf_counter() - start)
+
+    loads = []
+    for _ in range(params["loads"]):
+        start = time.perf_counter()
+        loaded, _ = logic.load_chat_from_file(filename)
+        loads.append(time.perf_counter() - start)
+    assert len(loaded["messages"]) == len(chat_data["messages"])
+    return {
+        "messages": count,
+        "file_bytes": os.path.getsize(os.path.join(logic.CHAT_HISTORY_DIR, filename)),
+        "first_save_ms": first_save * 1000,
+        "append_save": latency_summary(appends),
+        "load": latency_summary(loads),
+    }
+
+
+def bench_storage(params):
+    """Save, append to, load and list chats with one storage backend."""
+    import logic
+
+    logic.CHAT_STORAGE = params["backend"]
+    logic.start_save_worker()
+    count = params["chats"]
+    chats = []
+    start = time.perf_counter()
+    for i in range(count):
+        chat_data = make_chat(params["messages"])
+        chat_data["name"] = f"Chat {i}"
+        filename = os.path.join("autosave", f"autosave-bench-{i:06d}.chat")
+        logic.save_chat_to_file(filename, chat_data)
+        chats.append((filename, chat_data))
+    logic.flush_saves()
+    first_save = time.perf_counter() - start
+
+    appends = []
+    for i in range(params["appends"]):
+        filename, chat_data = chats[i % count]
+        chat_data["messages"].append({"role": "user", "content": f"appended {i}"})
+        start = time.perf_counter()
+        logic.save_chat_to_file(filename, chat_data)
+        logic.flush_saves()
+        appends.append(time.perf_counter() - start)
+
+    loads = []
+    for i in range(params["loads"]):
+        filename, chat_data = chats[i % count]
+        start = time.perf_counter()
+        loaded, _ = logic.load_chat_from_file(filename)
+        loads.append(time.perf_counter() - start)
+        assert len(loaded["messages"]) == len(chat_data["messages"])
+
+    lists = []
+    for _ in range(params["repeat"]):
+        start = time.perf_counter()
+        listed = logic.get_storage().entries()
+        lists.append(time.perf_counter() - start)
+    assert len(listed) == count
+    return {
+        "backend": params["backend"],
+        "chats": count,
+        "messages": params["messages"],
+        "first_save_ms": first_save * 1000,
+        "append_save": latency_summary(appends),
+        "load": latency_summary(loads),
+        "list": latency_summary(lists),
+    }
+
+
+def bench_cli_turn(params):
+    """Latency of a CLI chat turn: save, build context, stream, save."""
+    import cli
+    import logic
+
+    cli.console.file = open(os.devnull, "w")
+    logic.start_save_worker()
+    client = cli.setup_client()
+    chat_data, filename = cli.get_new_session_state()
+    messages = chat_data["messages"]
+    turns = {"stream": [], "no_stream": []}
+    for mode in turns:
+        for i in range(params["turns"]):
+            start = time.perf_counter()
+            messages.append({"role": "user", "content": f"cli benchmark {mode} {i}"})
+            cli.save_chat_to_file(filename, chat_data)
+            context, _ = logic.build_context(messages, cli.MODEL)
+            if mode == "stream":
+                answer = cli.stream_assistant_response(client, context, fresh=True)
+            else:
+                answer = logic.cached_completion(client, context, cli.MODEL, fresh=True)
+            messages.append({"role": "assistant", "content": answer})
+            cli.save_chat_to_file(filename, chat_data)
+            turns[mode].append(time.perf_counter() - start)
+    logic.flush_saves()
+    return {mode: latency_summary(values) for mode, values in turns.items()}
+
+
+# --- orchestration ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock(args):
+    """Start mock_groq.py in a subprocess and return ``(process, base_url)``."""
+    port = free_port()
+    proc = subprocess.Popen(
+        [
+            sys.executable, os.path.join(ROOT, "mock_groq.py"),
+            "--port", str(port),
+            "--latency", str(args.latency),
+            "--tokens-per-second", str(args.tokens_per_second),
+            "--error-rate", str(args.error_rate),
+            "--answer-tokens", str(args.answer_tokens),
+            "--requests-per-minute", str(args.requests_per_minute),
+        ],
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline and proc.poll() is None:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return proc, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("The mock Groq server did not start")
+
+
+def run_worker(name, params, base_url):
+    """Run one benchmark in a fresh process and temporary directory."""
+    with tempfile.TemporaryDirectory(prefix="groqchat-bench-") as workdir:
+        os.symlink(os.path.join(ROOT, "static"), os.path.join(workdir, "static"))
+        # Ignore .env so no real key or endpoint replaces the mock
+        env = dict(os.environ, GROQ_BASE_URL=base_url, GROQ_API_KEY="mock-key", GROQ_API_KEYS="",
+                   LOAD_DOTENV="false", PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--worker", name, json.dumps(params)],
+            cwd=workdir, env=env, capture_output=True, text=True,
+        )
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def plan(args):
+    """Return the list of ``(benchmark, label, params)`` to run."""
+    quick = args.quick
+    jobs = [
+        ("api_message", None, {"requests": 50 if quick else args.requests, "concurrency": args.concurrency}),
+    ]
+    for count in ([10, 1000] if quick else [10, 1000, 10000]):
+        jobs.append(("list_chats", str(count), {"chats": count, "repeat": 5}))
+    for count in ([1000] if quick else [1000, 10000]):
+        jobs.append(("chat_io", str(count), {"messages": count, "appends": 10, "loads": 3}))
+    for backend in ("files", "sqlite"):
+        jobs.append(("storage", backend, {
+            "backend": backend, "chats": 100 if quick else 500, "messages": 200,
+            "appends": 20, "loads": 10, "repeat": 5,
+        }))
+    jobs.append(("cli_turn", None, {"turns": 5 if quick else 20}))
+    return [job for job in jobs if job[0] in args.only]
+
+
+def git_version():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+        return commit or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GroqChat against a mock Groq API.")
+    parser.add_argument("-o", "--output", help="write the JSON results to this file")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes for a fast check")
+    parser.add_argument("--only", default=",".join(BENCHMARKS),
+                        help="comma separated benchmarks: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--tokens-per-second", type=float, default=500.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--answer-tokens", type=int, default=50)
+    parser.add_argument("--requests-per-minute", type=int, default=0,
+                        help="rate limit of the mock API, 0 for none")
+    parser.add_argument("--worker", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        name, params = args.worker
+        result = globals()[f"bench_{name}"](json.loads(params))
+        print(json.dumps(result))
+        return
+
+    args.only = [name.strip() for name in args.only.split(",") if name.strip()]
+    unknown = set(args.only) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    proc, base_url = start_mock(args)
+    results = {}
+    try:
+        for name, label, params in plan(args):
+            print(f"Running {name} {label or ''}".rstrip(), file=sys.stderr)
+            result = run_worker(name, params, base_url)
+            if label is None:
+                results[name] = result
+            else:
+                results.setdefault(name, {})[label] = result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    report = {
+        "version": git_version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mock": {
+            "latency": args.latency,
+            "tokens_per_second": args.tokens_per_second,
+            "error_rate": args.error_rate,
+            "answer_tokens": args.answer_tokens,
+            "requests_per_minute": args.requests_per_minute,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""SQLite catalog of chat files so listings and searches never parse the chats."""
+
+import os
+import sqlite3
+import re
+import threading
+
+# Bumped whenever the tables change shape; older catalogs are rebuilt from disk
+SCHEMA_VERSION = 3
+
+
+class ChatCatalog:
+    """Index of chat file metadata and message text stored next to the history.
+
+    Entries are keyed by the path relative to ``root`` and kept up to date by
+    the code that writes, moves and deletes chats.  :meth:`reconcile` catches
+    changes made behind the catalog's back by rescanning only directories
+    whose mtime changed since the last scan.  Non-system messages are kept in
+    an FTS5 full-text index used by :meth:`search`.
+
+    For uncompressed journals the catalog also holds the chat metadata and
+    the byte offset of the record of every message, so the tail of a long
+    chat can be read without parsing the whole file.  These are only valid
+    while the file's size and mtime match the entry.
+    """
+
+    def __init__(self, root, path):
+        self.root = root
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._db.executescript(
+                """
+                DROP TABLE IF EXISTS chats;
+                DROP TABLE IF EXISTS dirs;
+                DROP TABLE IF EXISTS messages;
+                DROP TABLE IF EXISTS messages_fts;
+                DROP TABLE IF EXISTS offsets;
+                """
+            )
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                file TEXT PRIMARY KEY,
+                dir TEXT NOT NULL,
+                name TEXT NOT NULL,
+                model TEXT,
+                messages INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                meta TEXT,
+                records INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS chats_dir ON chats (dir, mtime);
+            CREATE TABLE IF NOT EXISTS offsets (
+                file TEXT NOT NULL,
+                dir TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                at INTEGER NOT NULL,
+                len INTEGER NOT NULL,
+                PRIMARY KEY (file, idx)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                mtime REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                file TEXT NOT NULL,
+                dir TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                UNIQUE (file, idx)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, content='messages', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END;
+            """
+        )
+        self._db.commit()
+
+    @staticmethod
+    def top_dir(rel):
+        """Return the history subdirectory (``autosave``, ``archive``...) of ``rel``."""
+        return rel.split(os.sep, 1)[0] if os.sep in rel else ""
+
+    def record(self, rel, name, model, messages, size, mtime, meta=None, records=None):
+        """Insert or update the entry for the chat at ``rel``.
+
+        ``meta`` (JSON text) and the journal's ``records`` count are given
+        when the message offsets of ``rel`` are complete and up to date.
+        """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (rel, self.top_dir(rel), name, model, messages, size, mtime, meta, records),
+            )
+            self._db.commit()
+
+    def update_offsets(self, rel, puts, cut=None):
+        """Update where the messages of ``rel`` are stored in its file.
+
+        Offsets at index ``cut`` and above are dropped first, then every
+        ``(index, at, length)`` in ``puts`` replaces the offset of that index.
+        """
+        top = self.top_dir(rel)
+        with self._lock:
+            if cut is not None:
+                self._db.execute("DELETE FROM offsets WHERE file = ? AND idx >= ?", (rel, cut))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO offsets VALUES (?, ?, ?, ?, ?)",
+                [(rel, top, idx, at, length) for idx, at, length in puts],
+            )
+            self._db.commit()
+
+    def journal(self, rel):
+        """Return what is known about the journal of ``rel`` for random access.
+
+        The dict has ``size``, ``mtime``, ``messages``, ``meta`` and
+        ``records``; ``None`` is returned unless the offsets are recorded.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime, messages, meta, records FROM chats WHERE file = ?", (rel,)
+            ).fetchone()
+        if row is None or row[3] is None:
+            return None
+        size, mtime, messages, meta, records = row
+        return {"size": size, "mtime": mtime, "messages": messages, "meta": meta, "records": records}
+
+    def offsets(self, rel, start, stop):
+        """Return ``(index, at, length)`` of the messages ``start`` to ``stop`` of ``rel``."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT idx, at, len FROM offsets WHERE file = ? AND idx >= ? AND idx < ? ORDER BY idx",
+                (rel, start, stop),
+            ).fetchall()
+
+    def update_messages(self, rel, puts, cut=None):
+        """Update the indexed messages of ``rel``.
+
+        Messages at index ``cut`` and above are dropped first, then every
+        ``(index, message)`` pair in ``puts`` replaces the message stored at
+        that index.  System prompts are not indexed.
+        """
+        top = self.top_dir(rel)
+        with self._lock:
+            if cut is not None:
+                self._db.execute("DELETE FROM messages WHERE file = ? AND idx >= ?", (rel, cut))
+            for idx, m in puts:
+                self._db.execute("DELETE FROM messages WHERE file = ? AND idx = ?", (rel, idx))
+                if m.get("role") != "system":
+                    self._db.execute(
+                        "INSERT INTO messages (file, dir, idx, role, content) VALUES (?, ?, ?, ?, ?)",
+                        (rel, top, idx, m.get("role", ""), m.get("content") or ""),
+                    )
+            self._db.commit()
+
+    def move(self, old_rel, new_rel):
+        """Re-key an entry after its file was renamed."""
+        top = self.top_dir(new_rel)
+        with self._lock:
+            for table in ("chats", "messages", "offsets"):
+                self._db.execute(f"DELETE FROM {table} WHERE file = ?", (new_rel,))
+                self._db.execute(
+                    f"UPDATE {table} SET file = ?, dir = ? WHERE file = ?", (new_rel, top, old_rel)
+                )
+            self._db.commit()
+
+    def remove(self, rel):
+        """Forget the entry for ``rel``."""
+        with self._lock:
+            for table in ("chats", "messages", "offsets"):
+                self._db.execute(f"DELETE FROM {table} WHERE file = ?", (rel,))
+            self._db.commit()
+
+    def remove_dir(self, top):
+        """Forget every entry below the history subdirectory ``top``."""
+        with self._lock:
+            for table in ("chats", "messages", "offsets"):
+                self._db.execute(f"DELETE FROM {table} WHERE dir = ?", (top,))
+            self._db.commit()
+
+    @staticmethod
+    def fts_query(text):
+        """Turn user search text into a safe FTS5 query.
+
+        Double-quoted parts are matched as phrases and every other word must
+        appear somewhere in the message.
+        """
+        terms = []
+        for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+            term = phrase if phrase else word
+            term = term.replace('"', '')
+            if term.strip():
+                terms.append('"' + term + '"')
+        return " ".join(terms)
+
+    def search(self, text, dirs=None, limit=50):
+        """Return the best matching messages for ``text`` ranked by BM25.
+
+        ``dirs`` restricts results to the given history subdirectories.
+        """
+        query = self.fts_query(text)
+        if not query:
+            return []
+        sql = (
+            "SELECT m.file, m.idx, m.role,"
+            " snippet(messages_fts, 0, '**', '**', '...', 16), bm25(messages_fts) AS score,"
+            " c.name"
+            " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+            " LEFT JOIN chats c ON c.file = m.file"
+            " WHERE messages_fts MATCH ?"
+        )
+        args = [query]
+        if dirs:
+            sql += " AND m.dir IN (%s)" % ",".join("?" * len(dirs))
+            args.extend(dirs)
+        sql += " ORDER BY score LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [
+            {
+                "file": file,
+                "name": name or os.path.splitext(os.path.basename(file))[0],
+                "index": idx,
+                "role": role,
+                "snippet": snippet,
+                "score": -score,
+            }
+            for file, idx, role, snippet, score, name in rows
+        ]
+
+    def get(self, rel):
+        """Return the entry for ``rel`` as a dict or ``None``."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file, name, model, messages, size, mtime FROM chats WHERE file = ?",
+                (rel,),
+            ).fetchone()
+        return self._row(row) if row else None
+
+    def entries(self, top=None):
+        """Return catalog entries, newest first, optionally for one subdirectory."""
+        query = "SELECT file, name, model, messages, size, mtime FROM chats"
+        args = ()
+        if top is not None:
+            query += " WHERE dir = ?"
+            args = (top,)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY mtime DESC", args).fetchall()
+        return [self._row(r) for r in rows]
+
+    @staticmethod
+    def _row(row):
+        file, name, model, messages, size, mtime = row
+        return {
+            "file": file,
+            "name": name,
+            "model": model,
+            "messages": messages,
+            "size": size,
+            "mtime": mtime,
+        }
+
+    def reconcile(self, describe, keep=None):
+        """Bring the catalog in line with the files on disk.
+
+        ``describe(path)`` must return ``(name, model, messages)`` for a chat
+        file.  Directories whose mtime is unchanged are skipped, and in
+        rescanned directories only files whose size or mtime changed are read.
+        Entries for which ``keep(rel)`` is true are kept even without a file,
+        as for chats stored in the archive pack.
+        """
+        keep = keep or (lambda rel: False)
+        with self._lock:
+            known_dirs = dict(self._db.execute("SELECT path, mtime FROM dirs"))
+        self._reconcile_dir("", known_dirs, describe, keep)
+        with self._lock:
+            # Directories that vanished since the last scan
+            for path in known_dirs:
+                self._db.execute("DELETE FROM dirs WHERE path = ?", (path,))
+                if path:
+                    rows = self._db.execute(
+                        "SELECT file FROM chats WHERE file LIKE ? ESCAPE '\\'",
+                        (self._like_prefix(path),),
+                    ).fetchall()
+                    for (rel,) in rows:
+                        if not keep(rel):
+                            for table in ("chats", "messages", "offsets"):
+                                self._db.execute(f"DELETE FROM {table} WHERE file = ?", (rel,))
+            self._db.commit()
+
+    @staticmethod
+    def _like_prefix(rel_dir):
+        escaped = rel_dir.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return escaped + os.sep + "%"
+
+    def _reconcile_dir(self, rel_dir, known_dirs, describe, keep):
+        path = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        recorded = known_dirs.pop(rel_dir, None)
+        if recorded == mtime:
+            # Unchanged listing: recurse into the subdirectories we already know
+            prefix = rel_dir + os.sep if rel_dir else ""
+            children = [
+                p for p in list(known_dirs)
+                if p.startswith(prefix) and os.sep not in p[len(prefix):]
+            ]
+            for child in children:
+                self._reconcile_dir(child, known_dirs, describe, keep)
+            return
+
+        subdirs = []
+        on_disk = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                rel = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                if entry.is_dir():
+                    subdirs.append(rel)
+                elif entry.name.endswith(".chat"):
+                    st = entry.stat()
+                    on_disk[rel] = (st.st_size, st.st_mtime)
+        with self._lock:
+            if rel_dir:
+                rows = self._db.execute(
+                    "SELECT file, size, mtime FROM chats WHERE file LIKE ? ESCAPE '\\'",
+                    (self._like_prefix(rel_dir),),
+                ).fetchall()
+            else:
+                rows = self._db.execute("SELECT file, size, mtime FROM chats WHERE dir = ''").fetchall()
+        cataloged = {f: (s, m) for f, s, m in rows if os.path.dirname(f) == rel_dir}
+        changed = [rel for rel, stat in on_disk.items() if cataloged.get(rel) != stat]
+        for rel in cataloged:
+            if rel not in on_disk and not keep(rel):
+                self.remove(rel)
+        for rel in changed:
+            try:
+                name, model, messages = describe(os.path.join(self.root, rel))
+            except Exception:
+                name, model, messages = os.path.splitext(os.path.basename(rel))[0], None, []
+            self.record(rel, name, model, len(messages), *on_disk[rel])
+            self.update_messages(rel, list(enumerate(messages)), cut=0)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (rel_dir, mtime))
+            self._db.commit()
+        for sub in subdirs:
+            self._reconcile_dir(sub, known_dirs, describe, keep)
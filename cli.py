@@ -2,18 +2,26 @@
 
 import os
 import json
+import sqlite3
 import sys
 from datetime import datetime
-import shutil
-from groq import Groq
+from groq import Groq, RateLimitError
 from dotenv import load_dotenv
 import subprocess
+import time
+import threading
 
 # Load variables from .env and let them override system environment values.
-load_dotenv(override=True)
+if os.getenv("LOAD_DOTENV", "true").lower() == "true":
+    load_dotenv(override=True)
 from termcolor import colored
 from rich.console import Console
 from rich.markdown import Markdown
+from rich.live import Live
+
+import logic
+import migrate
+import scheduler
 
 console = Console()
 
@@ -26,118 +34,117 @@ console = Console()
 API_KEY = os.getenv("GROQ_API_KEY", "your_groq_api_key")
 MODEL = "llama3-70b-8192"
 CHAT_VERSION = "1.0"
-CHAT_HISTORY_DIR = "chat_history"
-AUTOSAVE_DIR = os.path.join(CHAT_HISTORY_DIR, "autosave")
-USERCHAT_DIR = os.path.join(CHAT_HISTORY_DIR, "userchat")
-ARCHIVE_DIR = os.path.join(CHAT_HISTORY_DIR, "archive")
-PROMPTS_DIR = "prompts"
-EXPORTS_DIR = "exports"
 AVAILABLE_MODELS = [
     "llama3-70b-8192",
     "llama3-8b-8192",
     "mixtral-8x7b",
 ]
 
-def ensure_directories():
-    """Ensure chat history directories exist."""
-    os.makedirs(AUTOSAVE_DIR, exist_ok=True)
-    os.makedirs(USERCHAT_DIR, exist_ok=True)
-    os.makedirs(ARCHIVE_DIR, exist_ok=True)
-    os.makedirs(EXPORTS_DIR, exist_ok=True)
-
-def sort_chats():
+def sort_chats(dry_run=False, workers=None):
     """Move chat files into autosave or userchat directories based on filename."""
-    ensure_directories()
-    for fname in os.listdir(CHAT_HISTORY_DIR):
-        path = os.path.join(CHAT_HISTORY_DIR, fname)
-        if os.path.isdir(path):
-            continue
-        if not fname.endswith(".chat"):
-            continue
-        if fname.startswith("autosave-"):
-            target = os.path.join(AUTOSAVE_DIR, fname)
-        else:
-            target = os.path.join(USERCHAT_DIR, fname)
-        shutil.move(path, target)
-    print("Chats sorted into 'autosave' and 'userchat' directories.")
-
-def convert_chats():
-    """Convert legacy chat files to version 1.0 format."""
-    ensure_directories()
-    for root_dir, _, files in os.walk(CHAT_HISTORY_DIR):
+    stats = migrate.run("sort", dry_run=dry_run, workers=workers)
+    report_migration(stats, "moved", dry_run)
+    if not dry_run and not stats["interrupted"]:
+        print("Chats sorted into 'autosave' and 'userchat' directories.")
+
+def convert_chats(dry_run=False, workers=None):
+    """Convert legacy chat files to the current format version."""
+    stats = migrate.run("convert", dry_run=dry_run, workers=workers)
+    report_migration(stats, "converted", dry_run)
+
+def copy_storage(source, target, dry_run=False):
+    """Copy every chat from the ``source`` storage backend into ``target``."""
+    for kind in (source, target):
+        if kind not in logic.STORAGE_BACKENDS:
+            print(colored(f"[Error] Unknown storage '{kind}'. Use one of: {', '.join(logic.STORAGE_BACKENDS)}", ERROR_COLOR))
+            return
+    if source == target:
+        print(colored("[Error] Source and target storage are the same.", ERROR_COLOR))
+        return
+    stats = migrate.copy_storage(source, target, dry_run=dry_run)
+    report_migration(stats, "copied", dry_run)
+    if not dry_run and not stats["errors"] and not stats["interrupted"]:
+        print(colored(f"Set CHAT_STORAGE={target} to use the copied chats.", SYSTEM_COLOR))
+
+def report_migration(stats, verb, dry_run):
+    """Print the outcome of a bulk migration."""
+    for path, error in stats["errors"]:
+        print(colored(f"[Error] {path}: {error}", ERROR_COLOR))
+    changed = stats["counts"].get(verb, 0)
+    summary = f"{changed} of {stats['done']} files {'would be ' if dry_run else ''}{verb} in {stats['seconds']:.1f}s"
+    if stats["resumed"]:
+        summary += f", {stats['resumed']} already done by an earlier run"
+    print(colored(summary, SYSTEM_COLOR))
+    if stats["interrupted"] or (stats["errors"] and not dry_run):
+        print(colored("Run the same command again to continue where it stopped.", SYSTEM_COLOR))
+
+def compress_chats(codec=None):
+    """Rewrite every chat file compressed with ``codec`` (default CHAT_COMPRESSION)."""
+    codec = codec or logic.CHAT_COMPRESSION
+    if codec not in logic.CHAT_CODECS:
+        print(colored(f"[Error] Unknown compression '{codec}'. Use one of: {', '.join(logic.CHAT_CODECS)}", ERROR_COLOR))
+        return
+    if codec == "zstd" and logic.zstandard is None:
+        print(colored("[Error] zstd compression needs the zstandard package (pip install zstandard).", ERROR_COLOR))
+        return
+    logic.ensure_directories()
+    before = after = count = legacy = 0
+    for root_dir, _, files in os.walk(logic.CHAT_HISTORY_DIR):
         for fname in files:
             if not fname.endswith(".chat"):
                 continue
             path = os.path.join(root_dir, fname)
             try:
-                with open(path, "r") as f:
-                    data = json.load(f)
+                sizes = logic.recompress_chat_file(path, codec)
             except Exception as e:
-                print(colored(f"[Error] Failed to read {path}: {e}", ERROR_COLOR))
+                print(colored(f"[Error] Failed to compress {path}: {e}", ERROR_COLOR))
                 continue
-
-            if isinstance(data, list):
-                chat_data = {
-                    "name": os.path.splitext(fname)[0],
-                    "version": CHAT_VERSION,
-                    "model": MODEL,
-                    "messages": data,
-                }
-            elif isinstance(data, dict):
-                if data.get("version") == CHAT_VERSION:
-                    continue  # Already converted
-                data.setdefault("name", os.path.splitext(fname)[0])
-                data.setdefault("model", MODEL)
-                data["version"] = CHAT_VERSION
-                chat_data = data
-            else:
-                print(colored(f"[Error] Unknown format in {path}", ERROR_COLOR))
+            if sizes is None:
+                legacy += 1
                 continue
-
+            before += sizes[0]
+            after += sizes[1]
+            count += 1
+    print(colored(f"Rewrote {count} chats with {codec}: {before / 1024:.1f} KiB -> {after / 1024:.1f} KiB", SYSTEM_COLOR))
+    if legacy:
+        print(colored(f"Skipped {legacy} legacy chats, run 'python cli.py convert' first.", SYSTEM_COLOR))
+
+def pack_archive():
+    """Move chats archived as separate files into the archive pack."""
+    logic.ensure_directories()
+    pack = logic.get_archive()
+    moved = 0
+    for root_dir, _, files in os.walk(logic.ARCHIVE_DIR):
+        for fname in files:
+            if not fname.endswith(".chat"):
+                continue
+            path = os.path.join(root_dir, fname)
             try:
-                with open(path, "w") as f:
-                    json.dump(chat_data, f, indent=2)
-                print(colored(f"Converted {path}", SYSTEM_COLOR))
+                with open(path, "rb") as f:
+                    raw = f.read()
+                logic.load_chat_bytes(raw)  # Refuse to pack unreadable files
+                pack.put(os.path.relpath(path, logic.ARCHIVE_DIR), raw)
+                os.remove(path)
+                moved += 1
             except Exception as e:
-                print(colored(f"[Error] Failed to write {path}: {e}", ERROR_COLOR))
+                print(colored(f"[Error] Failed to pack {path}: {e}", ERROR_COLOR))
+    print(colored(f"Packed {moved} archived chats into {pack.index_path}", SYSTEM_COLOR))
 
 
 # --- PROMPT MANAGEMENT ---
 
-def ensure_prompts_dir():
-    """Ensure the directory for custom prompts exists."""
-    os.makedirs(PROMPTS_DIR, exist_ok=True)
-
-def list_prompts():
-    """Return a list of saved prompt names without extensions."""
-    ensure_prompts_dir()
-    names = []
-    for fname in os.listdir(PROMPTS_DIR):
-        if fname.endswith('.txt'):
-            names.append(os.path.splitext(fname)[0])
-    return names
-
 def save_prompt(name, text):
     """Save a custom prompt to a file."""
-    ensure_prompts_dir()
-    path = os.path.join(PROMPTS_DIR, f"{name}.txt")
     try:
-        with open(path, 'w') as f:
-            f.write(text)
-        return True, path
+        return logic.save_prompt(name, text)
     except IOError as e:
         print(colored(f"\n[Error] Could not save prompt: {e}", ERROR_COLOR))
-        return False, path
+        return False, None
 
 def load_prompt(name):
     """Load a saved prompt text."""
-    ensure_prompts_dir()
-    path = os.path.join(PROMPTS_DIR, f"{name}.txt")
-    if not os.path.exists(path):
-        return None
     try:
-        with open(path, 'r') as f:
-            return f.read()
+        return logic.load_prompt(name)
     except IOError as e:
         print(colored(f"\n[Error] Could not load prompt: {e}", ERROR_COLOR))
         return None
@@ -155,8 +162,12 @@ SUMMARY_SYSTEM_PROMPT = (
 SUMMARY_HISTORY_LIMIT = 50
 # Maximum length of the summary generated by the API
 SUMMARY_MAX_TOKENS = 200
-# Limit the number of recent messages sent to the model during regular chat
-HISTORY_LIMIT = 10
+# Stream assistant answers as they are generated (disable with --no-stream)
+STREAM = True
+# How many times per second the streamed Markdown is re-rendered
+STREAM_REFRESH_PER_SECOND = 8
+# Reuse cached answers for repeated requests (disable with --no-cache)
+USE_CACHE = True
 
 # --- HELPER FUNCTIONS ---
 
@@ -169,7 +180,8 @@ def setup_client():
         print("Example: export GROQ_API_KEY='your_api_key_here'")
         print("="*60 + "\n")
         exit()
-    return Groq(api_key=API_KEY)
+    # The client retries rate limited and failed requests with jittered backoff
+    return Groq(api_key=API_KEY, base_url=logic.BASE_URL, max_retries=logic.MAX_RETRIES)
 
 def get_new_session_state():
     """Return a new chat object and autosave filename."""
@@ -209,73 +221,32 @@ def generate_chat_name(client, messages):
         {"role": "user", "content": convo},
     ]
     try:
-        completion = client.chat.completions.create(
-            messages=prompt_msgs,
-            model=MODEL,
-            temperature=0.5,
-            top_p=1,
-            max_tokens=10,
+        name = logic.cached_completion(
+            client, prompt_msgs, MODEL, temperature=0.5, top_p=1, max_tokens=10
         )
-        name = completion.choices[0].message.content.strip().strip("\"")
-        return name
+        return name.strip().strip("\"")
     except Exception as e:
         print(colored(f"\n[API Error] Could not generate chat name: {e}", ERROR_COLOR))
         return None
 
 def save_chat_to_file(filename, chat_data):
-    """Save chat data (metadata + messages) to a JSON file."""
-    ensure_directories()
-
-    filepath = os.path.join(CHAT_HISTORY_DIR, filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    """Save chat data (metadata + messages) to the chat storage."""
     try:
-        with open(filepath, "w") as f:
-            json.dump(chat_data, f, indent=2)
-        return True, filepath
-    except IOError as e:
-        print(f"\n[Error] Could not save chat to {filepath}: {e}")
-        return False, filepath
+        return logic.save_chat_to_file(filename, chat_data)
+    except (IOError, sqlite3.Error) as e:
+        print(colored(f"\n[Error] Could not save chat {filename}: {e}", ERROR_COLOR))
+        return False, filename
 
 def load_chat_from_file(filename):
-    """Load chat data from a JSON file."""
-    ensure_directories()
-    filepath = os.path.join(CHAT_HISTORY_DIR, filename)
-    if not os.path.exists(filepath):
-        alt_auto = os.path.join(AUTOSAVE_DIR, filename)
-        alt_user = os.path.join(USERCHAT_DIR, filename)
-        alt_arch = os.path.join(ARCHIVE_DIR, filename)
-        if os.path.exists(alt_auto):
-            filepath = alt_auto
-        elif os.path.exists(alt_user):
-            filepath = alt_user
-        elif os.path.exists(alt_arch):
-            filepath = alt_arch
-        else:
-            print(f"\n[Error] File not found: {filepath}")
-            return None, None
-
+    """Load chat data from the chat storage."""
     try:
-        with open(filepath, "r") as f:
-            data = json.load(f)
-        if isinstance(data, list):
-            chat_data = {
-                "name": os.path.splitext(os.path.basename(filepath))[0],
-                "version": "0",
-                "model": MODEL,
-                "messages": data,
-            }
-        elif isinstance(data, dict) and "messages" in data:
-            data.setdefault("name", os.path.splitext(os.path.basename(filepath))[0])
-            data.setdefault("model", MODEL)
-            data.setdefault("version", CHAT_VERSION)
-            chat_data = data
-        else:
-            print(colored(f"\n[Error] Invalid chat file format: {filepath}", ERROR_COLOR))
-            return None, None
-        return chat_data, os.path.relpath(filepath, CHAT_HISTORY_DIR)
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"\n[Error] Could not read or parse file {filepath}: {e}")
+        chat_data, rel = logic.load_chat_from_file(filename)
+    except (json.JSONDecodeError, IOError, sqlite3.Error) as e:
+        print(colored(f"\n[Error] Could not read or parse chat {filename}: {e}", ERROR_COLOR))
         return None, None
+    if chat_data is None:
+        print(colored(f"\n[Error] Chat not found or not a chat: {filename}", ERROR_COLOR))
+    return chat_data, rel
 
 def print_welcome_message():
     """Prints a welcome and help message to the user."""
@@ -293,10 +264,12 @@ def print_welcome_message():
     print("  /prompt sys <name> - Set system prompt from a saved prompt.")
     print("  /summary       - Summarize the current chat.")
     print("  /search <term> - Search messages in the current chat.")
+    print("  /search --all [--dir <name>] <term> - Search every saved chat.")
     print("  /export <name> - Export chat as Markdown or text.")
     print("  /update       - Update the application and restart.")
     print("  /model <name>  - Change the model in use.")
     print("  /model select  - Choose a model from a list.")
+    print("  /compare m1,m2 <msg> - Ask several models at once and keep one answer.")
     print("  /info          - Display chat info.")
     print("  /help         - Show this help message.")
     print("  /exit         - Exit the application.")
@@ -305,11 +278,137 @@ def print_welcome_message():
 def print_chat_history(messages):
     """Print the conversation history."""
     for msg in messages[1:]:
+        if msg is logic.UNLOADED:
+            continue  # Older messages of a long chat stay in storage
         role = msg["role"].capitalize()
         color = USER_COLOR if msg['role'] == 'user' else ASSISTANT_COLOR if msg['role'] == 'assistant' else SYSTEM_COLOR
         console.print(f"[{color}]{role}:[/{color}]")
         console.print(Markdown(msg['content']))
 
+def stream_assistant_response(client, context_messages, fresh=False):
+    """Render the answer live while it streams and return the text received.
+
+    Pressing Ctrl-C stops the stream early; the partial answer received so far
+    is returned instead of aborting the whole program.  A cached answer is
+    shown at once unless ``fresh`` is set.
+    """
+    parts = []
+    stream = None
+    interrupted = False
+    interval = 1 / STREAM_REFRESH_PER_SECOND
+    try:
+        with Live(console=console, refresh_per_second=STREAM_REFRESH_PER_SECOND,
+                  vertical_overflow="visible") as live:
+            try:
+                stream = logic.stream_completion(client, context_messages, MODEL, fresh=fresh)
+                last_render = 0.0
+                for delta in stream:
+                    parts.append(delta)
+                    # Re-parsing Markdown on every token is wasteful, so throttle it
+                    now = time.monotonic()
+                    if now - last_render >= interval:
+                        live.update(Markdown("".join(parts), style=ASSISTANT_COLOR))
+                        last_render = now
+            except KeyboardInterrupt:
+                interrupted = True
+            live.update(Markdown("".join(parts), style=ASSISTANT_COLOR))
+    finally:
+        if stream is not None:
+            stream.close()
+    if interrupted:
+        print(colored("[System] Generation stopped.", SYSTEM_COLOR))
+    return "".join(parts)
+
+def update_memory_in_background(client, chat_data, active_filename, first_index):
+    """Fold messages that left the context window into the running summary.
+
+    The summary request runs on a worker thread so the prompt comes back
+    immediately.  Returns the thread, or ``None`` if there was nothing to do.
+    """
+    job = logic.memory_update_request(chat_data, first_index, MODEL)
+    if job is None:
+        return None
+    request, upto = job
+
+    def run():
+        try:
+            summary = logic.cached_completion(
+                client,
+                request,
+                MODEL,
+                temperature=0.3,
+                top_p=1,
+                max_tokens=logic.ROLLING_SUMMARY_MAX_TOKENS,
+            )
+            if logic.apply_memory(chat_data, upto, summary):
+                save_chat_to_file(active_filename, chat_data)
+        except Exception as e:
+            print(colored(f"\n[API Error] Could not update running summary: {e}", ERROR_COLOR))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def name_chat_in_background(client, chat_data, active_filename):
+    """Name a new chat on a worker thread so the first answer is not delayed.
+
+    The name is saved with the chat once it arrives, unless the chat was
+    renamed in the meantime.
+    """
+    first_exchange = chat_data["messages"][:3]
+
+    def run():
+        new_name = generate_chat_name(client, first_exchange)
+        if new_name and chat_data["name"].startswith("Chat "):
+            chat_data["name"] = new_name
+            save_chat_to_file(active_filename, chat_data)
+            print(colored(f"\n[System] Chat renamed to '{new_name}'", SYSTEM_COLOR))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+def compare_models(client, chat_data, models, text):
+    """Send the chat to several models at once and let the user keep one answer.
+
+    Returns True if an answer was added to the chat.
+    """
+    messages = chat_data["messages"]
+    if text:
+        request = messages + [{"role": "user", "content": text}]
+    elif messages[-1]["role"] == "user":
+        request = messages
+    else:
+        print(colored("\n[Error] Add a message to send to the models.", ERROR_COLOR))
+        return False
+    memory = chat_data.get("memory") if logic.ROLLING_SUMMARY else None
+    print(colored(f"\n[System] Asking {len(models)} models...", SYSTEM_COLOR))
+    start = time.perf_counter()
+    results = logic.compare_models(client, request, models, memory)
+    elapsed = time.perf_counter() - start
+    for number, result in enumerate(results, start=1):
+        color = ERROR_COLOR if result["error"] else SYSTEM_COLOR
+        print(colored(f"\n{logic.format_comparison(number, result)}", color))
+        if result["answer"]:
+            console.print(Markdown(result["answer"]), style=ASSISTANT_COLOR)
+    print(colored(f"\n[System] All answers in {elapsed:.2f}s", SYSTEM_COLOR))
+
+    choice = input("Keep which answer? (number or model, empty for none): ").strip()
+    if not choice:
+        return False
+    if choice.isdigit() and 1 <= int(choice) <= len(results):
+        result = results[int(choice) - 1]
+    else:
+        result = next((r for r in results if r["model"] == choice), None)
+    if result is None or not result["answer"]:
+        print(colored(f"\n[Error] No answer to keep for '{choice}'.", ERROR_COLOR))
+        return False
+    if text:
+        messages.append({"role": "user", "content": text})
+    messages.append({"role": "assistant", "content": result["answer"], "model": result["model"]})
+    print(colored(f"[System] Kept the answer from {result['model']}", SYSTEM_COLOR))
+    return True
+
 def summarize_chat(client, messages):
     """Generate a detailed summary of the recent conversation without modifying it."""
     recent = messages[-SUMMARY_HISTORY_LIMIT:]
@@ -322,14 +421,14 @@ def summarize_chat(client, messages):
     ]
 
     try:
-        completion = client.chat.completions.create(
-            messages=summary_messages,
-            model=MODEL,
+        summary = logic.cached_completion(
+            client,
+            summary_messages,
+            MODEL,
             temperature=0.7,
             top_p=1,
             max_tokens=SUMMARY_MAX_TOKENS,
         )
-        summary = completion.choices[0].message.content
         print(colored(f"\n[Summary]\n{summary}\n", ASSISTANT_COLOR))
     except Exception as e:
         print(colored(f"\n[API Error] Could not generate summary: {e}", ERROR_COLOR))
@@ -343,49 +442,22 @@ def search_messages(messages, term):
             results.append(f"{i}: {m['role']} - {m['content']}")
     return results
 
-def export_chat(chat_data, name):
-    """Export the current chat to EXPORTS_DIR."""
-    ensure_directories()
-    if not name:
-        name = chat_data["name"].replace(" ", "_") + ".txt"
-    path = os.path.join(EXPORTS_DIR, name)
-    if name.endswith('.md'):
-        with open(path, 'w') as f:
-            f.write(f"# {chat_data['name']}\n\n")
-            for m in chat_data['messages']:
-                f.write(f"**{m['role']}**: {m['content']}\n\n")
-    else:
-        if not name.endswith('.txt'):
-            path += '.txt'
-        with open(path, 'w') as f:
-            for m in chat_data['messages']:
-                f.write(f"{m['role'].capitalize()}: {m['content']}\n\n")
-    return path
-
 def find_latest_autosave_file(current_active_filename):
     """Finds the most recent 'autosave-*.chat' file, excluding the current_active_filename."""
-    ensure_directories()
-
-    autosave_files = [
-        f for f in os.listdir(AUTOSAVE_DIR)
-        if f.startswith("autosave-") and f.endswith(".chat") and f != os.path.basename(current_active_filename)
-    ]
-
-    if not autosave_files:
-        return None
-
-    # Sort by modification time, newest first
-    autosave_files.sort(
-        key=lambda f: os.path.getmtime(os.path.join(AUTOSAVE_DIR, f)),
-        reverse=True
-    )
-    return os.path.join("autosave", autosave_files[0])
+    logic.flush_saves()
+    # Storage entries come newest first
+    for e in logic.get_storage().entries("autosave"):
+        fname = os.path.basename(e["file"])
+        if fname.startswith("autosave-") and fname.endswith(".chat") and fname != os.path.basename(current_active_filename):
+            return e["file"]
+    return None
 
 def browse_chats():
     """Interactive browser to pick a chat file."""
-    ensure_directories()
+    logic.ensure_directories()
+    store = logic.get_storage()
 
-    subdirs = [d for d in os.listdir(CHAT_HISTORY_DIR) if os.path.isdir(os.path.join(CHAT_HISTORY_DIR, d))]
+    subdirs = store.dirs()
     if not subdirs:
         print(colored("\n[System] No chat directories found.", SYSTEM_COLOR))
         return None
@@ -424,18 +496,12 @@ def browse_chats():
     if not selected_dir:
         return None
 
-    dir_path = os.path.join(CHAT_HISTORY_DIR, selected_dir)
-    chats = []
-    for fname in os.listdir(dir_path):
-        if fname.endswith(".chat"):
-            path = os.path.join(dir_path, fname)
-            try:
-                with open(path, "r") as f:
-                    data = json.load(f)
-                name = data.get("name", os.path.splitext(fname)[0]) if isinstance(data, dict) else os.path.splitext(fname)[0]
-            except Exception:
-                name = os.path.splitext(fname)[0]
-            chats.append((os.path.getmtime(path), os.path.relpath(path, CHAT_HISTORY_DIR), name))
+    # The storage already knows every chat's name and mtime
+    logic.flush_saves()
+    chats = [
+        (e["mtime"], e["file"], e["name"])
+        for e in store.entries(selected_dir)
+    ]
 
     if not chats:
         print(colored(f"\n[System] No chats found in '{selected_dir}'.", SYSTEM_COLOR))
@@ -488,19 +554,25 @@ ERROR_COLOR = "red"
 
 # --- MAIN APPLICATION LOGIC ---
 
-def main():
+def main(stream=True, use_cache=True):
     """The main function to run the CLI chat application."""
     global MODEL
     client = setup_client()
-    ensure_directories()
+    logic.ensure_directories()
+    # Autosaves are written by a background thread and flushed on exit
+    logic.start_save_worker()
     chat_data, active_filename = get_new_session_state()
     messages = chat_data["messages"]
+    # What the context builder sent on the last turn, shown by /info
+    last_context = None
+    # Background running-summary update, if one is in flight
+    memory_job = None
 
     # Do not create the autosave file until the first message is sent
 
     print_welcome_message()
     print(colored(
-        f"[System] New chat started: {chat_data['name']}. Autosave file will be created at '{os.path.join(CHAT_HISTORY_DIR, active_filename)}' after your first message",
+        f"[System] New chat started: {chat_data['name']}. Autosave file will be created at '{os.path.join(logic.CHAT_HISTORY_DIR, active_filename)}' after your first message",
         SYSTEM_COLOR,
     ))
 
@@ -522,7 +594,7 @@ def main():
                     messages = chat_data["messages"]
                     print(colored(f"\n[System] New chat session started: {chat_data['name']}", SYSTEM_COLOR))
                     print(colored(
-                        f"[System] Autosave file will be created at '{os.path.join(CHAT_HISTORY_DIR, active_filename)}' after your first message",
+                        f"[System] Autosave file will be created at '{os.path.join(logic.CHAT_HISTORY_DIR, active_filename)}' after your first message",
                         SYSTEM_COLOR,
                     ))
                     continue
@@ -613,7 +685,7 @@ def main():
                                 print(colored(f"\n[System] Prompt '{name}' saved to '{path}'.", SYSTEM_COLOR))
                         continue
                     elif action == "list":
-                        names = list_prompts()
+                        names = logic.list_prompts()
                         if names:
                             print(colored("\n[System] Saved prompts:", SYSTEM_COLOR))
                             for n in names:
@@ -657,11 +729,15 @@ def main():
                     continue
 
                 elif command == "/search":
-                    if len(command_parts) < 2:
-                        print(colored("\n[Error] Usage: /search <term>", ERROR_COLOR))
+                    all_chats, dirs, term = logic.parse_search_args(command_parts[1:])
+                    if not term:
+                        print(colored("\n[Error] Usage: /search [--all] [--dir <name>] <term>", ERROR_COLOR))
                         continue
-                    term = " ".join(command_parts[1:])
-                    results = search_messages(messages, term)
+                    if all_chats:
+                        hits = logic.search_all_chats(term, dirs=dirs or None)
+                        results = [logic.format_search_hit(h) for h in hits]
+                    else:
+                        results = search_messages(logic.chat_messages(chat_data), term)
                     if results:
                         print(colored("\n[Search Results]", SYSTEM_COLOR))
                         for r in results:
@@ -672,7 +748,7 @@ def main():
 
                 elif command == "/export":
                     name = command_parts[1] if len(command_parts) > 1 else ""
-                    path = export_chat(chat_data, name)
+                    path = logic.export_chat(chat_data, name)
                     print(colored(f"\n[System] Exported to '{path}'", SYSTEM_COLOR))
                     continue
 
@@ -680,6 +756,7 @@ def main():
                     print(colored("\n[System] Updating application...", SYSTEM_COLOR))
                     subprocess.run([sys.executable, "update.py"])
                     print(colored("[System] Restarting...", SYSTEM_COLOR))
+                    logic.flush_saves()
                     os.execl(sys.executable, sys.executable, *sys.argv)
 
                 elif command == "/model":
@@ -698,17 +775,44 @@ def main():
                     print(colored(f"\n[System] Model set to {MODEL}", SYSTEM_COLOR))
                     continue
 
+                elif command == "/compare":
+                    args = user_input.split(None, 2)[1:]
+                    models, text = logic.parse_compare_args(args)
+                    if not models:
+                        print(colored("\n[Error] Usage: /compare model1,model2 <message>", ERROR_COLOR))
+                    elif compare_models(client, chat_data, models, text):
+                        save_chat_to_file(active_filename, chat_data)
+                        if len(messages) == 3 and chat_data["name"].startswith("Chat "):
+                            name_chat_in_background(client, chat_data, active_filename)
+                    continue
+
                 elif command == "/info":
-                    path = os.path.join(CHAT_HISTORY_DIR, active_filename)
-                    try:
-                        mtime = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
-                    except Exception:
-                        mtime = "unknown"
+                    logic.flush_saves()
+                    entry = logic.get_storage().get(active_filename)
+                    mtime = datetime.fromtimestamp(entry["mtime"]).isoformat() if entry else "unknown"
                     print(colored("", SYSTEM_COLOR))
                     print(colored(f"File: {active_filename}", SYSTEM_COLOR))
                     print(colored(f"Model: {chat_data['model']}", SYSTEM_COLOR))
                     print(colored(f"Messages: {len(messages)-1}", SYSTEM_COLOR))
                     print(colored(f"Last saved: {mtime}", SYSTEM_COLOR))
+                    if last_context:
+                        print(colored(
+                            f"Context: {last_context['sent']} messages, {last_context['tokens']}/"
+                            f"{last_context['budget']} tokens, {last_context['dropped']} older messages left out",
+                            SYSTEM_COLOR,
+                        ))
+                    status = logic.save_status()
+                    print(colored(
+                        f"Pending saves: {status['pending_saves']} ({status['save_lag']:.2f}s behind)",
+                        SYSTEM_COLOR,
+                    ))
+                    cache = logic.completions.stats()
+                    print(colored(
+                        f"Cache: {cache['memory_hits'] + cache['disk_hits']} hits, "
+                        f"{cache['misses']} misses ({cache['hit_rate']:.0%}), "
+                        f"{cache['memory_entries']} answers in memory",
+                        SYSTEM_COLOR,
+                    ))
                     continue
 
                 elif command == "/help":
@@ -732,32 +836,45 @@ def main():
             console.print(f"[{ASSISTANT_COLOR}]Assistant:[/{ASSISTANT_COLOR}]")
 
             try:
-                context_messages = messages[-HISTORY_LIMIT:]
-                if context_messages[0]["role"] != "system":
-                    context_messages = [messages[0]] + context_messages
-
-                chat_completion = client.chat.completions.create(
-                    messages=context_messages,
-                    model=MODEL,
-                    temperature=0.7,
-                    top_p=1,
-                )
+                memory = chat_data.get("memory") if logic.ROLLING_SUMMARY else None
+                context_messages, last_context = logic.build_context(messages, MODEL, memory)
 
-                assistant_response = chat_completion.choices[0].message.content
-                console.print(Markdown(assistant_response), style=ASSISTANT_COLOR)
+                if stream:
+                    assistant_response = stream_assistant_response(
+                        client, context_messages, fresh=not use_cache
+                    )
+                else:
+                    assistant_response = logic.cached_completion(
+                        client, context_messages, MODEL, temperature=0.7, top_p=1,
+                        fresh=not use_cache,
+                    )
+                    console.print(Markdown(assistant_response), style=ASSISTANT_COLOR)
+
+                if stream and not assistant_response:
+                    # Stopped before any text arrived, forget the unanswered message
+                    messages.pop()
+                    save_chat_to_file(active_filename, chat_data)
+                    continue
 
                 if assistant_response:
                     messages.append({"role": "assistant", "content": assistant_response})
                     # Autosave to the active file after getting the assistant's response
                     save_chat_to_file(active_filename, chat_data)
 
+                    if logic.ROLLING_SUMMARY and not (memory_job and memory_job.is_alive()):
+                        memory_job = update_memory_in_background(
+                            client, chat_data, active_filename, last_context["first_index"]
+                        )
+
                     if len(messages) == 3 and chat_data["name"].startswith("Chat "):
-                        new_name = generate_chat_name(client, messages)
-                        if new_name:
-                            chat_data["name"] = new_name
-                            print(colored(f"[System] Chat renamed to '{new_name}'", SYSTEM_COLOR))
-                            save_chat_to_file(active_filename, chat_data)
+                        name_chat_in_background(client, chat_data, active_filename)
 
+            except RateLimitError as e:
+                wait = scheduler.retry_after(e)
+                hint = f" Try again in {wait:.0f}s." if wait else ""
+                print(colored(f"\n[API Error] Groq rate limit reached.{hint}", ERROR_COLOR))
+                messages.pop()
+                continue
             except Exception as e:
                 print(colored(f"\n[API Error] An error occurred: {e}", ERROR_COLOR))
                 # Remove the user message that caused the error to prevent loops
@@ -773,12 +890,31 @@ def main():
             break
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        if sys.argv[1] == "sort":
-            sort_chats()
-        elif sys.argv[1] == "convert":
-            convert_chats()
+    args = [a for a in sys.argv[1:] if a not in ("--no-stream", "--no-cache")]
+    use_stream = STREAM and "--no-stream" not in sys.argv[1:]
+    use_cache = USE_CACHE and "--no-cache" not in sys.argv[1:]
+    if args:
+        if args[0] in ("sort", "convert"):
+            dry_run = "--dry-run" in args
+            workers = None
+            if "--workers" in args:
+                value = args[args.index("--workers") + 1:][:1]
+                if not value or not value[0].isdigit() or int(value[0]) < 1:
+                    print(colored(f"[Error] Usage: python cli.py {args[0]} [--dry-run] [--workers <count>]", ERROR_COLOR))
+                    sys.exit(2)
+                workers = int(value[0])
+            (sort_chats if args[0] == "sort" else convert_chats)(dry_run, workers)
+        elif args[0] == "compress":
+            compress_chats(args[1] if len(args) > 1 else None)
+        elif args[0] == "pack":
+            pack_archive()
+        elif args[0] == "storage":
+            backends = [a for a in args[1:] if a != "--dry-run"]
+            if len(backends) != 2:
+                print(colored("[Error] Usage: python cli.py storage <from> <to> [--dry-run]", ERROR_COLOR))
+                sys.exit(2)
+            copy_storage(backends[0], backends[1], "--dry-run" in args)
         else:
-            main()
+            main(stream=use_stream, use_cache=use_cache)
     else:
-        main()
+        main(stream=use_stream, use_cache=use_cache)
@@ -0,0 +1,172 @@
+"""Two-tier cache of model completions: an in-memory LRU and optional SQLite store."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def completion_key(model, messages, temperature, top_p, max_tokens):
+    """Return a stable hash identifying a completion request.
+
+    Messages are reduced to their role and whitespace-trimmed content so
+    cached token counts or other bookkeeping fields do not affect the key.
+    """
+    normalized = [
+        {"role": m["role"], "content": (m.get("content") or "").strip()} for m in messages
+    ]
+    payload = json.dumps(
+        {
+            "model": model,
+            "messages": normalized,
+            "temperature": temperature,
+            "top_p": top_p,
+            "max_tokens": max_tokens,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Bounded LRU of completion texts backed by an optional on-disk tier.
+
+    Entries older than ``ttl`` seconds are treated as missing in both tiers.
+    The disk tier evicts least recently used rows once it grows past
+    ``disk_max_bytes``.  Disk hits are promoted into memory.
+    """
+
+    EVICT_BATCH = 64
+
+    def __init__(self, max_entries=256, ttl=86400, disk_path=None, disk_max_bytes=50 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "stores": 0}
+        self._db = None
+        self._disk_bytes = 0
+        if disk_path:
+            directory = os.path.dirname(disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_created ON completions (created)")
+            self._db.commit()
+            self._disk_bytes = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM completions"
+            ).fetchone()[0]
+
+    def get(self, key):
+        """Return the cached text for ``key`` or ``None``."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    self._db.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._remember(key, row[0], row[1])
+                    self._stats["disk_hits"] += 1
+                    return row[0]
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key, value):
+        """Store ``value`` under ``key`` in every tier."""
+        if value is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            self._stats["stores"] += 1
+            if self._db is not None:
+                size = len(value.encode("utf-8"))
+                old = self._db.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                    (key, value, now, now, size),
+                )
+                self._disk_bytes += size - (old[0] if old else 0)
+                self._evict_disk(now)
+                self._db.commit()
+
+    def note_bypass(self):
+        """Count a request that skipped the cache on purpose."""
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        # Work is bounded by the rows removed: the byte total is kept in
+        # memory and both scans walk an index in LIMIT-sized batches.
+        cutoff = now - self.ttl
+        while True:
+            rows = self._db.execute(
+                "SELECT key, size FROM completions WHERE created < ? ORDER BY created LIMIT ?",
+                (cutoff, self.EVICT_BATCH),
+            ).fetchall()
+            if not rows:
+                break
+            self._delete_rows(rows)
+        while self._disk_bytes > self.disk_max_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM completions ORDER BY accessed LIMIT ?", (self.EVICT_BATCH,)
+            ).fetchall()
+            if not rows:
+                self._disk_bytes = 0
+                break
+            excess = self._disk_bytes - self.disk_max_bytes
+            doomed = []
+            for row in rows:
+                if excess <= 0:
+                    break
+                doomed.append(row)
+                excess -= row[1]
+            self._delete_rows(doomed)
+
+    def _delete_rows(self, rows):
+        self._db.executemany("DELETE FROM completions WHERE key = ?", [(key,) for key, _ in rows])
+        self._disk_bytes -= sum(size for _, size in rows)
+
+    def stats(self):
+        """Return hit/miss counters and the current tier sizes."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._memory)
+            if self._db is not None:
+                count, size = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions"
+                ).fetchone()
+                stats["disk_entries"] = count
+                stats["disk_bytes"] = size
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
@@ -2,22 +2,47 @@ import os
 import json
 """Utility functions shared by the CLI and web server."""
 
+import gzip
+import re
 import shutil
+import sys
+import time
+import asyncio
+import atexit
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from groq import Groq
+from groq import Groq, AsyncGroq, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 
+import archive_pack
+import catalog
+import completion_cache
+import metrics
+import storage
+
+try:
+    import zstandard
+except ImportError:  # Optional, only needed for zstd compressed chats
+    zstandard = None
+
 # Load variables from .env first and fall back to system environment
-load_dotenv(override=True)
+# unless LOAD_DOTENV=false, which benchmark.py sets so only its mock is used
+if os.getenv("LOAD_DOTENV", "true").lower() == "true":
+    load_dotenv(override=True)
 
 # Prefer .env values, then system environment, then a fallback
 API_KEY = os.getenv("GROQ_API_KEY", "your_groq_api_key")
+# Alternative API endpoint, e.g. the local mock used by benchmark.py
+BASE_URL = os.getenv("GROQ_BASE_URL") or None
 MODEL = "llama3-70b-8192"
 CHAT_VERSION = "1.0"
 CHAT_HISTORY_DIR = "chat_history"
 AUTOSAVE_DIR = os.path.join(CHAT_HISTORY_DIR, "autosave")
 USERCHAT_DIR = os.path.join(CHAT_HISTORY_DIR, "userchat")
 ARCHIVE_DIR = os.path.join(CHAT_HISTORY_DIR, "archive")
+CATALOG_FILE = os.path.join(CHAT_HISTORY_DIR, "catalog.sqlite3")
 PROMPTS_DIR = "prompts"
 EXPORTS_DIR = "exports"
 PROMT_FILE = "promt.txt"
@@ -26,6 +51,13 @@ AVAILABLE_MODELS = [
     "llama3-8b-8192",
     "mixtral-8x7b",
 ]
+# Context window of each model in tokens, used to budget the chat history
+MODEL_CONTEXT_WINDOWS = {
+    "llama3-70b-8192": 8192,
+    "llama3-8b-8192": 8192,
+    "mixtral-8x7b": 32768,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
 
 DEFAULT_SYSTEM_PROMPT_FALLBACK = (
     "You are Zyron my alter ego. As I speak speak like me but as if you are another person."
@@ -52,9 +84,92 @@ SUMMARY_SYSTEM_PROMPT = (
     " roleplay as either speaker."
 )
 
+# Maximum number of upstream Groq calls the web server runs at the same time
+MAX_CONCURRENT_REQUESTS = int(os.getenv("GROQ_MAX_CONCURRENCY", "8"))
+# Request and token budgets per minute for the web server's scheduler; 0
+# learns them from Groq's rate-limit headers
+REQUESTS_PER_MINUTE = int(os.getenv("GROQ_REQUESTS_PER_MINUTE", "0"))
+TOKENS_PER_MINUTE = int(os.getenv("GROQ_TOKENS_PER_MINUTE", "0"))
+# Attempts after a rate limited or failed Groq request
+MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "4"))
+
+ROLLING_SUMMARY_PROMPT = (
+    "You maintain the running memory of a conversation between USER and"
+    " ASSISTANT. Merge the new messages into the existing summary, keeping"
+    " names, facts, decisions and open questions. Reply with the updated"
+    " summary only. Do not continue the conversation or roleplay."
+)
+# Fold messages that drop out of the context window into a running summary
+# that is sent after the system prompt (see build_context)
+ROLLING_SUMMARY = os.getenv("ROLLING_SUMMARY", "false").lower() == "true"
+# Wait until this many unsummarized messages have left the window
+ROLLING_SUMMARY_MIN_MESSAGES = 4
+ROLLING_SUMMARY_MAX_TOKENS = 400
+
+# Completion cache: entries kept in memory, lifetime in seconds, and an
+# optional SQLite file for a persistent tier (empty disables it)
+COMPLETION_CACHE_SIZE = int(os.getenv("COMPLETION_CACHE_SIZE", "256"))
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", "86400"))
+COMPLETION_CACHE_FILE = os.getenv("COMPLETION_CACHE_FILE", "")
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Characters of each conversation included in a batched naming request
+NAME_BATCH_CHARS = 2000
+
 SUMMARY_HISTORY_LIMIT = 50
+# Messages of a long chat kept in memory when it is loaded; older ones are read
+# from the file on demand.  Never fewer than a summary needs.
+CHAT_WINDOW = max(int(os.getenv("CHAT_WINDOW", "200")), SUMMARY_HISTORY_LIMIT)
 SUMMARY_MAX_TOKENS = 200
-HISTORY_LIMIT = 10
+# Tokens of the context window kept free for the model's answer
+RESPONSE_TOKEN_RESERVE = 1024
+# Token counts are estimated without a tokenizer; three characters per token
+# errs on the side of sending slightly less history than would fit
+CHARS_PER_TOKEN = 3
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+completions = completion_cache.CompletionCache(
+    max_entries=COMPLETION_CACHE_SIZE,
+    ttl=COMPLETION_CACHE_TTL,
+    disk_path=COMPLETION_CACHE_FILE or None,
+    disk_max_bytes=COMPLETION_CACHE_MAX_BYTES,
+)
+
+# Timings and counts served by the web server's /metrics route
+UPSTREAM_SECONDS = metrics.Histogram(
+    "groqchat_upstream_seconds", "Duration of Groq API requests.", ("model", "kind")
+)
+UPSTREAM_TTFT = metrics.Histogram(
+    "groqchat_upstream_ttft_seconds", "Time until Groq streamed the first token.", ("model",)
+)
+UPSTREAM_TOKENS = metrics.Counter(
+    "groqchat_upstream_tokens_total", "Tokens used by Groq requests as reported by the API.",
+    ("model", "type"),
+)
+UPSTREAM_ERRORS = metrics.Counter(
+    "groqchat_upstream_errors_total", "Groq requests that failed.", ("model",)
+)
+CHAT_NAME_SECONDS = metrics.Histogram(
+    "groqchat_chat_name_seconds", "Time to generate chat names.", ("model", "mode")
+)
+CHAT_SAVE_SECONDS = metrics.Histogram(
+    "groqchat_chat_save_seconds", "Time spent in save_chat_to_file, which queues the write."
+)
+CHAT_WRITE_SECONDS = metrics.Histogram(
+    "groqchat_chat_write_seconds", "Time to write a chat file to disk."
+)
+CHAT_LOAD_SECONDS = metrics.Histogram(
+    "groqchat_chat_load_seconds", "Time to load a chat file."
+)
+metrics.Gauge(
+    "groqchat_pending_saves", "Chat saves queued but not yet written.",
+    function=lambda: save_status()["pending_saves"],
+)
+metrics.Gauge(
+    "groqchat_completion_cache_hit_ratio", "Share of completion lookups answered from the cache.",
+    function=lambda: completions.stats()["hit_rate"],
+)
 
 
 def ensure_directories():
@@ -66,12 +181,55 @@ def ensure_directories():
     os.makedirs(EXPORTS_DIR, exist_ok=True)
 
 
-def setup_client():
-    """Return a Groq client instance using the configured API key."""
+def setup_client(base_url=None):
+    """Return a Groq client instance using the configured API key.
+
+    ``base_url`` (default ``GROQ_BASE_URL``) points the client at another
+    server speaking the same API.
+    """
 
     if not API_KEY:
         raise RuntimeError("GROQ_API_KEY environment variable not set")
-    return Groq(api_key=API_KEY)
+    return Groq(api_key=API_KEY, base_url=base_url or BASE_URL, max_retries=MAX_RETRIES)
+
+
+def api_keys():
+    """Return the Groq API keys to share requests between.
+
+    ``GROQ_API_KEYS`` holds a comma separated list; ``GROQ_API_KEY`` is
+    always included.
+    """
+
+    keys = [k.strip() for k in os.getenv("GROQ_API_KEYS", "").split(",")]
+    keys.append(API_KEY)
+    return [k for k in dict.fromkeys(keys) if k]
+
+
+def setup_async_client(base_url=None, api_key=None, on_response=None):
+    """Return an asynchronous Groq client for use inside an event loop.
+
+    ``on_response`` is an async callback given every HTTP response, e.g.
+    :meth:`scheduler.ApiKey.observe`; such a client leaves retries to its
+    caller.
+    """
+
+    api_key = api_key or API_KEY
+    if not api_key:
+        raise RuntimeError("GROQ_API_KEY environment variable not set")
+    if on_response is None:
+        return AsyncGroq(api_key=api_key, base_url=base_url or BASE_URL, max_retries=MAX_RETRIES)
+    return AsyncGroq(
+        api_key=api_key,
+        base_url=base_url or BASE_URL,
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(event_hooks={"response": [on_response]}),
+    )
+
+
+# Autosave names handed out by get_new_session_state during the current
+# second; older ones can no longer collide
+_issued_autosaves = {"stamp": None, "names": set()}
+_autosave_lock = threading.Lock()
 
 
 def get_new_session_state():
@@ -79,6 +237,19 @@ def get_new_session_state():
 
     timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
     autosave_filename = os.path.join("autosave", f"autosave-{timestamp}.chat")
+    # Chats started within the same second (several web sessions) must not
+    # share a file
+    suffix = 1
+    with _autosave_lock:
+        if _issued_autosaves["stamp"] != timestamp:
+            _issued_autosaves["stamp"] = timestamp
+            _issued_autosaves["names"].clear()
+        while autosave_filename in _issued_autosaves["names"] or os.path.exists(
+            os.path.join(CHAT_HISTORY_DIR, autosave_filename)
+        ):
+            suffix += 1
+            autosave_filename = os.path.join("autosave", f"autosave-{timestamp}-{suffix}.chat")
+        _issued_autosaves["names"].add(autosave_filename)
     chat_data = {
         "name": f"Chat {timestamp}",
         "version": CHAT_VERSION,
@@ -89,74 +260,1545 @@ def get_new_session_state():
     return chat_data, autosave_filename
 
 
-def generate_chat_name(client, messages):
-    """Use the model to generate a short descriptive name for the chat."""
+def estimate_tokens(text):
+    """Return a conservative token estimate for ``text``."""
+
+    return -(-len(text or "") // CHARS_PER_TOKEN) + MESSAGE_TOKEN_OVERHEAD
+
+
+def message_tokens(message):
+    """Return the token count of ``message``, caching it on the message.
+
+    The count is stored under ``tokens`` so it is saved with the chat and
+    not recomputed on every turn.  New messages are counted before their
+    first save (see :func:`count_new_tokens`); adding the count to a message
+    that was saved without one does not make it count as changed.
+    """
+
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(message.get("content"))
+        message["tokens"] = tokens
+    return tokens
+
+
+def context_budget(model=None):
+    """Return how many prompt tokens may be sent to ``model``."""
+
+    window = MODEL_CONTEXT_WINDOWS.get(model or MODEL, DEFAULT_CONTEXT_WINDOW)
+    return window - RESPONSE_TOKEN_RESERVE
+
+
+def memory_message(memory):
+    """Return the message carrying a running summary into the context."""
+
+    return {
+        "role": "system",
+        "content": f"Summary of the earlier conversation:\n{memory['summary']}",
+    }
+
+
+def build_context(messages, model=None, memory=None):
+    """Pack as many recent messages as fit the model's token budget.
+
+    The system prompt is always sent and the newest message is sent even if
+    it alone exceeds the budget.  A running ``memory`` summary, when given, is
+    sent right after the system prompt.  Returns ``(context, report)`` where
+    ``report`` describes what was sent and what was left out.
+    """
+
+    budget = context_budget(model)
+    # Messages before the loaded window of a long chat are never sent
+    has_system = bool(messages) and messages[0]["role"] == "system"
+    start = 1 if has_system else 0
+    used = message_tokens(messages[0]) if has_system else 0
+    if memory and memory.get("summary") and memory.get("upto", 0) <= len(messages):
+        memory_msg = memory_message(memory)
+        used += estimate_tokens(memory_msg["content"])
+    else:
+        memory_msg = None
+    first = len(messages)
+    for i in range(len(messages) - 1, start - 1, -1):
+        if messages[i] is UNLOADED:
+            break
+        cost = message_tokens(messages[i])
+        if first < len(messages) and used + cost > budget:
+            break
+        used += cost
+        first = i
+    picked = messages[:1] if has_system else []
+    if memory_msg:
+        picked.append(memory_msg)
+    picked += messages[first:]
+    context = [{"role": m["role"], "content": m["content"]} for m in picked]
+    report = {
+        "budget": budget,
+        "tokens": used,
+        "sent": len(messages) - first,
+        "dropped": first - start,
+        "first_index": first,
+        "memory_upto": memory["upto"] if memory_msg else None,
+    }
+    return context, report
+
+
+def memory_update_request(chat_data, first_index, model=None):
+    """Prepare folding newly evicted messages into the chat's running summary.
+
+    Messages between the current checkpoint and ``first_index`` (the oldest
+    message still in the context window) are summarized together with the
+    previous summary.  Returns ``(request_messages, upto)`` or ``None`` when
+    too few messages have been evicted yet.  A single request covers at most
+    one context budget worth of messages; the rest is folded on later turns.
+    Messages before the loaded window of a long chat are skipped.
+    """
+
+    messages = chat_data["messages"]
+    memory = chat_data.get("memory") or {}
+    upto = memory.get("upto", 1)
+    if upto > len(messages):
+        # The chat was rewound past the checkpoint; start over
+        memory, upto = {}, 1
+    while upto < first_index and messages[upto] is UNLOADED:
+        upto += 1
+    if first_index - upto < ROLLING_SUMMARY_MIN_MESSAGES:
+        return None
+    previous = memory.get("summary", "")
+    room = context_budget(model) - ROLLING_SUMMARY_MAX_TOKENS - estimate_tokens(previous)
+    end = upto
+    used = 0
+    while end < first_index:
+        cost = message_tokens(messages[end])
+        if end > upto and used + cost > room:
+            break
+        used += cost
+        end += 1
+    convo = "\n".join(
+        f"{m['role']}: {m['content']}" for m in messages[upto:end] if m['role'] != 'system'
+    )
+    request = [
+        {"role": "system", "content": ROLLING_SUMMARY_PROMPT},
+        {
+            "role": "user",
+            "content": f"Current summary:\n{previous or '(none)'}\n\nNew messages:\n{convo}",
+        },
+    ]
+    return request, end
+
+
+def apply_memory(chat_data, upto, summary):
+    """Store a new running-summary checkpoint unless the chat moved past it."""
+
+    current = (chat_data.get("memory") or {}).get("upto", 0)
+    if current > len(chat_data["messages"]):
+        current = 0
+    if upto > len(chat_data["messages"]) or upto <= current:
+        return False
+    chat_data["memory"] = {"upto": upto, "summary": summary.strip()}
+    return True
+
+
+def chat_name_messages(messages):
+    """Build the request used to ask the model for a chat name."""
 
     convo = "\n".join(
         f"{m['role']}: {m['content']}" for m in messages if m['role'] != 'system'
     )
-    prompt_msgs = [
+    return [
         {"role": "system", "content": "Provide a short (max 5 words) name for this conversation."},
         {"role": "user", "content": convo},
     ]
-    completion = client.chat.completions.create(
-        messages=prompt_msgs,
-        model=MODEL,
-        temperature=0.5,
-        top_p=1,
-        max_tokens=10,
+
+
+def chat_names_messages(conversations):
+    """Build one request asking for names of several conversations at once."""
+
+    parts = []
+    for number, messages in enumerate(conversations, start=1):
+        convo = "\n".join(
+            f"{m['role']}: {m['content']}" for m in messages if m['role'] != 'system'
+        )
+        parts.append(f"Conversation {number}:\n{convo[:NAME_BATCH_CHARS]}")
+    return [
+        {
+            "role": "system",
+            "content": "Provide a short (max 5 words) name for each conversation below."
+            " Reply with one line per conversation in the form '<number>. <name>'"
+            " and nothing else.",
+        },
+        {"role": "user", "content": "\n\n".join(parts)},
+    ]
+
+
+def parse_chat_names(text, count):
+    """Return the ``count`` names found in a batched naming reply.
+
+    Conversations the model left out get ``None``.
+    """
+
+    names = [None] * count
+    for line in (text or "").splitlines():
+        match = re.match(r"\s*(?:Conversation\s+)?(\d+)\s*[.):-]\s*(.+)", line)
+        if match and 1 <= int(match.group(1)) <= count:
+            name = match.group(2).strip().strip('"').strip()
+            if name:
+                names[int(match.group(1)) - 1] = name
+    return names
+
+
+def cached_completion(client, messages, model=None, temperature=0.7, top_p=1,
+                      max_tokens=None, fresh=False):
+    """Return the completion text for ``messages``, reusing a cached answer.
+
+    ``fresh`` skips the cache lookup (the new answer is still stored), for
+    sampled requests that must not repeat an earlier answer.
+    """
+
+    model = model or MODEL
+    key = completion_cache.completion_key(model, messages, temperature, top_p, max_tokens)
+    if fresh:
+        completions.note_bypass()
+    else:
+        hit = completions.get(key)
+        if hit is not None:
+            return hit
+    params = {"max_tokens": max_tokens} if max_tokens is not None else {}
+    start = time.perf_counter()
+    try:
+        completion = client.chat.completions.create(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            top_p=top_p,
+            **params,
+        )
+    except Exception:
+        UPSTREAM_ERRORS.inc(model=model)
+        raise
+    record_upstream(model, "completion", start, _response_usage(completion))
+    text = completion.choices[0].message.content
+    completions.put(key, text)
+    return text
+
+
+async def cached_completion_async(client, messages, model=None, temperature=0.7, top_p=1,
+                                  max_tokens=None, fresh=False):
+    """Async variant of :func:`cached_completion` for an ``AsyncGroq`` client."""
+
+    model = model or MODEL
+    key = completion_cache.completion_key(model, messages, temperature, top_p, max_tokens)
+    if fresh:
+        completions.note_bypass()
+    else:
+        hit = completions.get(key)
+        if hit is not None:
+            return hit
+    params = {"max_tokens": max_tokens} if max_tokens is not None else {}
+    start = time.perf_counter()
+    try:
+        completion = await client.chat.completions.create(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            top_p=top_p,
+            **params,
+        )
+    except Exception:
+        UPSTREAM_ERRORS.inc(model=model)
+        raise
+    record_upstream(model, "completion", start, _response_usage(completion))
+    text = completion.choices[0].message.content
+    completions.put(key, text)
+    return text
+
+
+def generate_chat_name(client, messages):
+    """Use the model to generate a short descriptive name for the chat."""
+
+    with CHAT_NAME_SECONDS.time(model=MODEL, mode="single"):
+        name = cached_completion(
+            client, chat_name_messages(messages), MODEL, temperature=0.5, top_p=1, max_tokens=10
+        )
+    return name.strip().strip('"')
+
+
+async def generate_chat_name_async(client, messages):
+    """Async variant of :func:`generate_chat_name` for an ``AsyncGroq`` client."""
+
+    with CHAT_NAME_SECONDS.time(model=MODEL, mode="single"):
+        name = await cached_completion_async(
+            client, chat_name_messages(messages), MODEL, temperature=0.5, top_p=1, max_tokens=10
+        )
+    return name.strip().strip('"')
+
+
+async def generate_chat_names_async(client, conversations):
+    """Name several conversations, using a single request when there are many.
+
+    Returns one name per conversation; ones the batched reply missed are
+    named individually.
+    """
+
+    if len(conversations) == 1:
+        return [await generate_chat_name_async(client, conversations[0])]
+    with CHAT_NAME_SECONDS.time(model=MODEL, mode="batch"):
+        reply = await cached_completion_async(
+            client,
+            chat_names_messages(conversations),
+            MODEL,
+            temperature=0.5,
+            top_p=1,
+            max_tokens=16 * len(conversations),
+        )
+    names = parse_chat_names(reply, len(conversations))
+    for i, name in enumerate(names):
+        if name is None:
+            names[i] = await generate_chat_name_async(client, conversations[i])
+    return names
+
+
+def stream_completion(client, messages, model=None, temperature=0.7, top_p=1, fresh=False):
+    """Yield content fragments from a streaming chat completion as they arrive.
+
+    A cached answer is yielded in one piece.  Completed streams are cached;
+    streams stopped early are not.
+    """
+
+    key = completion_cache.completion_key(model or MODEL, messages, temperature, top_p, None)
+    if fresh:
+        completions.note_bypass()
+    else:
+        hit = completions.get(key)
+        if hit is not None:
+            yield hit
+            return
+    model = model or MODEL
+    parts = []
+    start = time.perf_counter()
+    try:
+        stream = client.chat.completions.create(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            top_p=top_p,
+            stream=True,
+        )
+    except Exception:
+        UPSTREAM_ERRORS.inc(model=model)
+        raise
+    usage = None
+    try:
+        for chunk in stream:
+            usage = _response_usage(chunk) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not parts:
+                    UPSTREAM_TTFT.observe(time.perf_counter() - start, model=model)
+                parts.append(delta)
+                yield delta
+        completions.put(key, "".join(parts))
+        record_upstream(model, "stream", start, usage)
+    except Exception:
+        UPSTREAM_ERRORS.inc(model=model)
+        raise
+    finally:
+        # Release the HTTP connection when the consumer stops early
+        close = getattr(stream, "close", None)
+        if close:
+            close()
+
+
+async def stream_completion_async(client, messages, model=None, temperature=0.7, top_p=1,
+                                  fresh=False):
+    """Async variant of :func:`stream_completion` for an ``AsyncGroq`` client."""
+
+    key = completion_cache.completion_key(model or MODEL, messages, temperature, top_p, None)
+    if fresh:
+        completions.note_bypass()
+    else:
+        hit = completions.get(key)
+        if hit is not None:
+            yield hit
+            return
+    model = model or MODEL
+    parts = []
+    start = time.perf_counter()
+    try:
+        stream = await client.chat.completions.create(
+            messages=messages,
+            model=model,
+            temperature=temperature,
+            top_p=top_p,
+            stream=True,
+        )
+    except Exception:
+        UPSTREAM_ERRORS.inc(model=model)
+        raise
+    usage = None
+    try:
+        async for chunk in stream:
+            usage = _response_usage(chunk) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if not parts:
+                    UPSTREAM_TTFT.observe(time.perf_counter() - start, model=model)
+                parts.append(delta)
+                yield delta
+        completions.put(key, "".join(parts))
+        record_upstream(model, "stream", start, usage)
+    except Exception:
+        UPSTREAM_ERRORS.inc(model=model)
+        raise
+    finally:
+        close = getattr(stream, "close", None)
+        if close:
+            await close()
+
+
+def parse_compare_args(args):
+    """Split ``/compare`` arguments into ``(models, message)``.
+
+    Models are given comma separated as the first argument; the rest of the
+    line is the message sent to all of them.
+    """
+
+    if not args:
+        return [], ""
+    models = [m.strip() for m in args[0].split(",") if m.strip()]
+    return models, " ".join(args[1:]).strip()
+
+
+def _response_usage(response):
+    """Return the token usage reported by a completion or streamed chunk, if any."""
+
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        extra = getattr(response, "x_groq", None)
+        usage = extra.get("usage") if isinstance(extra, dict) else getattr(extra, "usage", None)
+    if usage is None:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+    return {k: usage.get(k) for k in ("prompt_tokens", "completion_tokens", "total_tokens")}
+
+
+def record_upstream(model, kind, start, usage=None):
+    """Record the duration and token usage of a Groq request started at ``start``."""
+
+    UPSTREAM_SECONDS.observe(time.perf_counter() - start, model=model, kind=kind)
+    if usage:
+        for key, label in (("prompt_tokens", "prompt"), ("completion_tokens", "completion")):
+            if usage.get(key):
+                UPSTREAM_TOKENS.inc(usage[key], model=model, type=label)
+
+
+def _comparison_result(model, parts, start, ttft, usage, error):
+    if error:
+        UPSTREAM_ERRORS.inc(model=model)
+    else:
+        record_upstream(model, "compare", start, usage)
+    if ttft is not None:
+        UPSTREAM_TTFT.observe(ttft, model=model)
+    latency = time.perf_counter() - start
+    answer = "".join(parts)
+    if usage and usage.get("completion_tokens"):
+        generated = usage["completion_tokens"]
+    else:
+        generated = estimate_tokens(answer) - MESSAGE_TOKEN_OVERHEAD if answer else 0
+    generating = latency - (ttft or 0)
+    return {
+        "model": model,
+        "answer": answer,
+        "latency": latency,
+        "ttft": ttft,
+        "tokens_per_second": generated / generating if answer and generating > 0 else None,
+        "usage": usage,
+        "error": error,
+    }
+
+
+def _compare_one(client, messages, model, memory, temperature, top_p):
+    context, _ = build_context(messages, model, memory)
+    start = time.perf_counter()
+    ttft = None
+    parts = []
+    usage = None
+    error = None
+    try:
+        stream = client.chat.completions.create(
+            messages=context, model=model, temperature=temperature, top_p=top_p, stream=True
+        )
+        for chunk in stream:
+            usage = _response_usage(chunk) or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(chunk.choices[0].delta.content)
+    except Exception as e:
+        error = str(e)
+    return _comparison_result(model, parts, start, ttft, usage, error)
+
+
+async def _compare_one_async(client, messages, model, memory, temperature, top_p):
+    context, _ = build_context(messages, model, memory)
+    start = time.perf_counter()
+    ttft = None
+    parts = []
+    usage = None
+    error = None
+    try:
+        stream = await client.chat.completions.create(
+            messages=context, model=model, temperature=temperature, top_p=top_p, stream=True
+        )
+        async for chunk in stream:
+            usage = _response_usage(chunk) or usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(chunk.choices[0].delta.content)
+    except Exception as e:
+        error = str(e)
+    return _comparison_result(model, parts, start, ttft, usage, error)
+
+
+def compare_models(client, messages, models, memory=None, temperature=0.7, top_p=1):
+    """Send the same chat to several models at once and measure each answer.
+
+    Every model gets the history that fits its own context window.  Returns
+    one result per model with the answer, total latency, time to first
+    token, tokens per second, reported usage and any error.  The cache is
+    not used so the timings are real.
+    """
+
+    with ThreadPoolExecutor(max_workers=len(models) or 1) as pool:
+        jobs = [
+            pool.submit(_compare_one, client, messages, m, memory, temperature, top_p)
+            for m in models
+        ]
+        return [job.result() for job in jobs]
+
+
+async def compare_models_async(client, messages, models, memory=None, temperature=0.7, top_p=1,
+                               slot=None):
+    """Async variant of :func:`compare_models`.
+
+    ``slot`` optionally returns the async context manager each request runs
+    in, which gives the client to use instead of ``client``.
+    """
+
+    async def one(model):
+        if slot is None:
+            return await _compare_one_async(client, messages, model, memory, temperature, top_p)
+        async with slot() as slot_client:
+            return await _compare_one_async(slot_client, messages, model, memory, temperature, top_p)
+
+    return list(await asyncio.gather(*(one(m) for m in models)))
+
+
+def format_comparison(number, result):
+    """Return the heading line describing one comparison result."""
+
+    parts = [f"{number}. {result['model']}"]
+    if result["error"]:
+        return f"{parts[0]}: error: {result['error']}"
+    parts.append(f"{result['latency']:.2f}s")
+    if result["ttft"] is not None:
+        parts.append(f"first token {result['ttft']:.2f}s")
+    if result["tokens_per_second"]:
+        parts.append(f"{result['tokens_per_second']:.0f} tok/s")
+    if result["usage"]:
+        parts.append(
+            f"{result['usage'].get('prompt_tokens')} in / {result['usage'].get('completion_tokens')} out tokens"
+        )
+    return " | ".join(parts)
+
+
+# Chat files are journals: a header line holding the chat metadata followed by
+# one JSON record per appended message or later change.  Saving only appends
+# the records describing what changed since the last save, so a turn costs
+# O(new message) bytes of I/O instead of rewriting the whole chat.
+JOURNAL_FORMAT = 1
+# Rewrite a journal from scratch once it holds this many records that no
+# longer describe a live message (replaced messages, metadata updates, ...)
+JOURNAL_COMPACT_SLACK = 100
+# Saves of the same chat queued within this many seconds are written once
+SAVE_COALESCE_SECONDS = float(os.getenv("SAVE_COALESCE_SECONDS", "0.5"))
+
+# Chat files may be compressed; readers tell the format from the magic bytes,
+# so compressed and plain files can sit side by side.  New and compacted
+# files are written with CHAT_COMPRESSION: none, gzip or zstd.
+CHAT_CODECS = ("none", "gzip", "zstd")
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CHAT_COMPRESSION = os.getenv("CHAT_COMPRESSION", "none").strip().lower() or "none"
+if CHAT_COMPRESSION not in CHAT_CODECS:
+    print(f"[Warning] Unknown CHAT_COMPRESSION '{CHAT_COMPRESSION}', chats are not compressed", file=sys.stderr)
+    CHAT_COMPRESSION = "none"
+elif CHAT_COMPRESSION == "zstd" and zstandard is None:
+    print("[Warning] CHAT_COMPRESSION=zstd needs the zstandard package, using gzip", file=sys.stderr)
+    CHAT_COMPRESSION = "gzip"
+# Every append to a compressed journal is a separate small stream that barely
+# compresses, so the file is rewritten as one stream after this many
+JOURNAL_COMPRESSED_APPENDS = 50
+
+# What each journal looked like after this process last wrote or read it,
+# keyed by absolute path.  Used to work out which records to append.
+_journals = {}
+# Serialises journal writes so queued and flushed saves land in order
+_journal_lock = threading.RLock()
+
+# Stands in for the messages of a long chat that were not read into memory;
+# see chat_messages()
+UNLOADED = storage.UNLOADED
+
+# Write-behind state: absolute path -> [latest chat snapshot, first queued time]
+_pending_saves = {}
+_save_cond = threading.Condition()
+_save_worker = None
+_save_error = None
+
+
+def _dump_record(record):
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+def chat_codec(raw):
+    """Return the compression (``none``, ``gzip`` or ``zstd``) of file bytes ``raw``."""
+
+    if raw.startswith(GZIP_MAGIC):
+        return "gzip"
+    if raw.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return "none"
+
+
+def compress_bytes(data, codec):
+    """Compress ``data`` with ``codec`` as one gzip member or zstd frame."""
+
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compressed chats need the zstandard package")
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return data
+
+
+def decompress_bytes(raw):
+    """Return ``(data, intact)`` for the contents of a possibly compressed file.
+
+    A compressed journal is a series of streams, one per append.  Decoding
+    stops at a stream cut short by a crash, and ``intact`` is then False.
+    """
+
+    codec = chat_codec(raw)
+    if codec == "none":
+        return raw, True
+    if codec == "zstd" and zstandard is None:
+        raise RuntimeError("zstd compressed chats need the zstandard package")
+    errors = (zlib.error, EOFError) + ((zstandard.ZstdError,) if zstandard else ())
+    parts = []
+    while raw:
+        if codec == "gzip":
+            stream = zlib.decompressobj(wbits=31)
+        else:
+            stream = zstandard.ZstdDecompressor().decompressobj()
+        try:
+            data = stream.decompress(raw)
+        except errors:
+            return b"".join(parts), False
+        if not stream.eof:
+            return b"".join(parts), False
+        parts.append(data)
+        raw = stream.unused_data
+    return b"".join(parts), True
+
+
+def _remember_journal(filepath, chat_data, records, codec):
+    st = os.stat(filepath)
+    _journals[os.path.abspath(filepath)] = {
+        "messages": [m if m is UNLOADED else dict(m) for m in chat_data["messages"]],
+        "meta": json.loads(json.dumps(storage.chat_meta(chat_data))),
+        "records": records,
+        "codec": codec,
+        "appends": 0,
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        # Whether the catalog holds the offset of every message record
+        "indexed": False,
+    }
+
+
+def compact_chat_file(filepath, chat_data, codec=None):
+    """Rewrite ``filepath`` as a fresh journal holding only live records.
+
+    The file is compressed with ``codec`` (default ``CHAT_COMPRESSION``).
+    The journal is written to a temporary file and renamed over the original,
+    so a crash mid-write never leaves a truncated chat behind.  Returns the
+    ``(index, at, length)`` of every message record of an uncompressed
+    journal, else ``None``.
+    """
+
+    codec = codec or CHAT_COMPRESSION
+    tmp = f"{filepath}.tmp"
+    with _journal_lock:
+        data, placed = _journal_bytes(chat_data)
+        with open(tmp, "wb") as f:
+            f.write(compress_bytes(data, codec))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filepath)
+        _remember_journal(filepath, chat_data, len(chat_data["messages"]), codec)
+        window = chat_data.get("window")
+        if window and codec == "none":
+            # The unloaded messages are now read back from the new file
+            window["source"] = os.path.abspath(filepath)
+    return placed if codec == "none" else None
+
+
+def chat_file_bytes(chat_data, codec=None):
+    """Return ``chat_data`` serialized as a compact journal compressed with ``codec``."""
+
+    return compress_bytes(_journal_bytes(chat_data)[0], codec or CHAT_COMPRESSION)
+
+
+def _journal_bytes(chat_data):
+    """Return the uncompressed compact journal of ``chat_data`` and its message offsets."""
+
+    header = _dump_record({"journal": JOURNAL_FORMAT, "meta": storage.chat_meta(chat_data)}).encode("utf-8")
+    lines = [header]
+    placed = []
+    at = len(header)
+    for i, m in enumerate(chat_messages(chat_data)):
+        line = _dump_record({"op": "add", "msg": m}).encode("utf-8")
+        lines.append(line)
+        placed.append((i, at, len(line) - 1))
+        at += len(line)
+    return b"".join(lines), placed
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def describe_chat_file(filepath):
+    """Return ``(name, model, messages)`` read from a chat file."""
+
+    return _describe_chat(read_chat_file(filepath), filepath)
+
+
+def _describe_chat(data, filepath):
+    fallback = os.path.splitext(os.path.basename(filepath))[0]
+    if isinstance(data, list):
+        return fallback, MODEL, data
+    return data.get("name", fallback), data.get("model", MODEL), data.get("messages", [])
+
+
+def get_archive():
+    """Return the pack file that holds archived chats."""
+
+    global _archive
+    with _archive_lock:
+        if _archive is None:
+            ensure_directories()
+            _archive = archive_pack.ArchivePack(ARCHIVE_DIR)
+        return _archive
+
+
+def archived_name(rel):
+    """Return the pack key of the history path ``rel`` or ``None`` outside the archive."""
+
+    prefix = os.path.basename(ARCHIVE_DIR) + os.sep
+    return rel[len(prefix):] if rel.startswith(prefix) else None
+
+
+def get_catalog():
+    """Return the chat catalog, reconciling it with the disk on first use."""
+
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            ensure_directories()
+            cat = catalog.ChatCatalog(CHAT_HISTORY_DIR, CATALOG_FILE)
+            _reconcile_catalog(cat)
+            _catalog = cat
+        return _catalog
+
+
+def reconcile_catalog():
+    """Rescan the history for chats changed outside this process, e.g. by a migration."""
+
+    _reconcile_catalog(get_catalog())
+
+
+def _reconcile_catalog(cat):
+    pack = get_archive()
+    # Packed chats have no file of their own but are still there
+    cat.reconcile(describe_chat_file, keep=lambda rel: archived_name(rel) in pack)
+    _catalog_archive(cat, pack)
+
+
+def _catalog_archive(cat, pack):
+    """Add packed chats the catalog does not know, e.g. after it was rebuilt."""
+
+    top = os.path.basename(ARCHIVE_DIR)
+    known = {e["file"] for e in cat.entries(top)}
+    for name, archived in pack.names().items():
+        rel = os.path.join(top, name)
+        if rel in known:
+            continue
+        raw = pack.get(name)
+        try:
+            chat_name, model, messages = _describe_chat(load_chat_bytes(raw), name)
+        except Exception:
+            chat_name, model, messages = os.path.splitext(os.path.basename(name))[0], None, []
+        cat.record(rel, chat_name, model, len(messages), len(raw), archived)
+        cat.update_messages(rel, list(enumerate(messages)), cut=0)
+
+
+def history_relpath(filepath):
+    """Return ``filepath`` relative to ``CHAT_HISTORY_DIR`` or ``None`` if outside."""
+
+    rel = os.path.relpath(os.path.abspath(filepath), os.path.abspath(CHAT_HISTORY_DIR))
+    if rel.startswith(os.pardir):
+        return None
+    return rel
+
+
+def _catalog_chat(filepath, chat_data, records, placed=None):
+    """Update the catalog entry and search index after a journal write.
+
+    ``records`` are the journal records just appended, or ``None`` when the
+    file was rewritten and every message has to be indexed again.  ``placed``
+    are the ``(index, at, length)`` of the message records written to an
+    uncompressed journal; the entry only keeps offsets while all are known.
+    """
+
+    rel = history_relpath(filepath)
+    if rel is None:
+        return
+    st = os.stat(filepath)
+    fallback = os.path.splitext(os.path.basename(filepath))[0]
+    cat = get_catalog()
+    state = _journals.get(os.path.abspath(filepath))
+    indexed = (state is not None and placed is not None
+               and (records is None or state["indexed"]))
+    cat.record(
+        rel,
+        chat_data.get("name", fallback),
+        chat_data.get("model", MODEL),
+        len(chat_data["messages"]),
+        st.st_size,
+        st.st_mtime,
+        meta=json.dumps(storage.chat_meta(chat_data)) if indexed else None,
+        records=state["records"] if indexed else None,
     )
-    return completion.choices[0].message.content.strip().strip('"')
+    if state is not None:
+        state["indexed"] = indexed
+    if records is None:
+        if indexed:
+            cat.update_offsets(rel, placed, cut=0)
+        cat.update_messages(rel, list(enumerate(chat_messages(chat_data))), cut=0)
+        return
+    cut = None
+    puts = []
+    added = []
+    for rec in records:
+        if rec["op"] == "cut":
+            cut = rec["n"]
+        elif rec["op"] == "set":
+            puts.append((rec["i"], rec["msg"]))
+        elif rec["op"] == "add":
+            added.append(rec["msg"])
+    if indexed:
+        cat.update_offsets(rel, placed, cut=cut)
+    if cut is None and not puts and not added:
+        return
+    puts.extend(enumerate(added, start=len(chat_data["messages"]) - len(added)))
+    cat.update_messages(rel, puts, cut=cut)
+
+
+def write_chat_file(filepath, chat_data):
+    """Persist ``chat_data`` to ``filepath``, appending to its journal when possible.
+
+    The file is rewritten in full when this process has no record of its
+    current contents (first save, legacy format, or another writer touched
+    it) or when enough dead records have piled up to warrant compaction.
+    """
+
+    with _journal_lock, CHAT_WRITE_SECONDS.time():
+        written, records, placed = _write_journal(filepath, chat_data)
+        if written:
+            _catalog_chat(filepath, chat_data, records, placed)
+
+
+def _write_journal(filepath, chat_data):
+    state = _journals.get(os.path.abspath(filepath))
+    if state is not None:
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            st = None
+        if st is None or st.st_size != state["size"] or st.st_mtime_ns != state["mtime"]:
+            state = None
+    if state is None:
+        return True, None, compact_chat_file(filepath, chat_data)
+    records = storage.chat_changes(state, chat_data)
+    if not records:
+        return False, None, None
+    total = state["records"] + len(records)
+    codec = state["codec"]
+    if (total - len(chat_data["messages"]) > JOURNAL_COMPACT_SLACK
+            or (codec != "none" and state["appends"] >= JOURNAL_COMPRESSED_APPENDS)):
+        return True, None, compact_chat_file(filepath, chat_data)
+    lines = [_dump_record(r).encode("utf-8") for r in records]
+    with open(filepath, "ab") as f:
+        f.write(compress_bytes(b"".join(lines), codec))
+        f.flush()
+        os.fsync(f.fileno())
+    # Bring the snapshot up to date without copying the untouched messages,
+    # noting where the records of changed messages start in the file
+    snapshot = state["messages"]
+    placed = []
+    at = state["size"]
+    for rec, line in zip(records, lines):
+        if rec["op"] == "add":
+            placed.append((len(snapshot), at, len(line) - 1))
+            snapshot.append(dict(rec["msg"]))
+        elif rec["op"] == "set":
+            placed.append((rec["i"], at, len(line) - 1))
+            snapshot[rec["i"]] = dict(rec["msg"])
+        elif rec["op"] == "cut":
+            del snapshot[rec["n"]:]
+        elif rec["op"] == "meta":
+            state["meta"] = json.loads(json.dumps(storage.chat_meta(chat_data)))
+        at += len(line)
+    st = os.stat(filepath)
+    state.update(records=total, appends=state["appends"] + 1, size=st.st_size, mtime=st.st_mtime_ns)
+    return True, records, placed if codec == "none" else None
+
+
+def _replay_journal(data):
+    """Rebuild chat data from journal bytes, stopping at a torn final record.
+
+    Returns ``(chat_data, records, intact, placed)`` where ``placed`` holds
+    the ``(index, at, length)`` of the record each message was read from.
+    """
+
+    lines = data.split(b"\n")
+    header = json.loads(lines[0])
+    chat_data = dict(header.get("meta", {}))
+    messages = []
+    offsets = []
+    records = 0
+    intact = True
+    at = len(lines[0]) + 1
+    for line in lines[1:]:
+        start = at
+        at += len(line) + 1
+        if not line.strip():
+            continue
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            # A crash mid-append leaves a partial last line; ignore it
+            intact = False
+            break
+        records += 1
+        op = rec.get("op")
+        if op == "add":
+            messages.append(rec["msg"])
+            offsets.append((start, len(line)))
+        elif op == "set":
+            messages[rec["i"]] = rec["msg"]
+            offsets[rec["i"]] = (start, len(line))
+        elif op == "cut":
+            del messages[rec["n"]:]
+            del offsets[rec["n"]:]
+        elif op == "meta":
+            chat_data.update(rec.get("set", {}))
+            for k in rec.get("del", []):
+                chat_data.pop(k, None)
+    chat_data["messages"] = messages
+    placed = [(i, start, length) for i, (start, length) in enumerate(offsets)]
+    return chat_data, records, intact, placed
+
+
+def read_chat_file(filepath, track=False):
+    """Return the raw chat stored at ``filepath`` in any supported format.
+
+    Journals are replayed into a dict; older v1.0 JSON objects and legacy
+    message lists are returned exactly as stored.  Gzip and zstd compressed
+    files are decompressed first.  With ``track`` the journal is remembered
+    so the next save of this chat only appends to it.
+    """
+
+    if track:
+        # Read and remember atomically with respect to queued writes
+        with _journal_lock:
+            return _read_chat_file(filepath, track)
+    return _read_chat_file(filepath, track)
+
+
+def _read_chat_file(filepath, track):
+    with open(filepath, "rb") as f:
+        raw = f.read()
+    chat_data, records, intact, placed = _parse_chat_bytes(raw)
+    if track and intact:
+        _remember_journal(filepath, chat_data, records, chat_codec(raw))
+        rel = history_relpath(filepath)
+        if placed is not None and rel is not None:
+            if _journal_entry(rel, filepath) is None:
+                # Record the offsets so the next load only reads the tail
+                _catalog_chat(filepath, chat_data, None, placed)
+            else:
+                _journals[os.path.abspath(filepath)]["indexed"] = True
+    return chat_data
+
+
+def load_chat_bytes(raw):
+    """Return the chat stored in the file contents ``raw``, like :func:`read_chat_file`."""
+
+    return _parse_chat_bytes(raw)[0]
+
+
+def _parse_chat_bytes(raw):
+    """Return ``(chat, records, intact, placed)`` for the contents of a chat file.
+
+    ``intact`` is False unless an undamaged journal, and ``placed`` holds the
+    message offsets of an uncompressed journal, else ``None``.
+    """
+
+    data, whole = decompress_bytes(raw)
+    first, _, _ = data.partition(b"\n")
+    try:
+        header = json.loads(first)
+    except ValueError:
+        header = None
+    if isinstance(header, dict) and "journal" in header:
+        chat_data, records, intact, placed = _replay_journal(data)
+        return chat_data, records, intact and whole, placed if data is raw else None
+    return json.loads(data.decode("utf-8")), None, False, None
+
+
+def _journal_entry(rel, filepath):
+    """Return the catalog's offsets entry for ``rel`` if it matches the file on disk."""
+
+    info = get_catalog().journal(rel)
+    if info is None:
+        return None
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    if st.st_size != info["size"] or st.st_mtime != info["mtime"]:
+        return None
+    return info
+
+
+def _read_records(filepath, rel, start, stop):
+    """Return the messages ``start`` to ``stop`` of ``filepath`` read through its offsets.
+
+    Returns ``None`` when the catalog does not know them all.
+    """
+
+    offsets = get_catalog().offsets(rel, start, stop)
+    if len(offsets) != stop - start:
+        return None
+    if not offsets:
+        return []
+    lo = min(at for _, at, _ in offsets)
+    hi = max(at + length for _, at, length in offsets)
+    with open(filepath, "rb") as f:
+        f.seek(lo)
+        buf = f.read(hi - lo)
+    messages = []
+    for _, at, length in offsets:
+        rec = json.loads(buf[at - lo:at - lo + length])
+        messages.append(rec["msg"])
+    return messages
+
+
+def chat_messages(chat_data, start=0, stop=None):
+    """Return the messages ``start`` to ``stop`` of a chat, reading unloaded ones from disk."""
+
+    messages = chat_data["messages"]
+    stop = len(messages) if stop is None else min(stop, len(messages))
+    start = max(0, min(start, stop))
+    picked = messages[start:stop]
+    missing = [i for i, m in enumerate(picked, start) if m is UNLOADED]
+    if not missing:
+        return picked
+    lo, hi = missing[0], missing[-1] + 1
+    stored = get_storage().window_messages(chat_data["window"]["source"], lo, hi)
+    return [stored[i - lo] if m is UNLOADED else m for i, m in enumerate(picked, start)]
+
+
+def _load_window(filepath):
+    """Load only the system prompt and the last ``CHAT_WINDOW`` messages of a chat.
+
+    Works for uncompressed journals whose offsets the catalog holds; returns
+    ``None`` otherwise, or when the chat is short enough to load whole.
+    """
+
+    rel = history_relpath(filepath)
+    if rel is None:
+        return None
+    with _journal_lock:
+        info = _journal_entry(rel, filepath)
+        if info is None or info["messages"] <= CHAT_WINDOW + 1:
+            return None
+        count = info["messages"]
+        first = count - CHAT_WINDOW
+        head = _read_records(filepath, rel, 0, 1)
+        tail = _read_records(filepath, rel, first, count)
+        if head is None or tail is None:
+            return None
+        chat_data = json.loads(info["meta"])
+        chat_data["messages"] = head + [UNLOADED] * (first - 1) + tail
+        chat_data["window"] = {"source": os.path.abspath(filepath), "first": first}
+        _remember_journal(filepath, chat_data, info["records"], "none")
+        _journals[os.path.abspath(filepath)]["indexed"] = True
+        return chat_data
+
+
+def recompress_chat_file(filepath, codec=None):
+    """Rewrite a chat file as a compact journal compressed with ``codec``.
+
+    Returns the file size before and after, or ``None`` for legacy chats
+    stored as a bare message list, which need converting first.
+    """
+
+    flush_saves(filepath)
+    with _journal_lock:
+        before = os.path.getsize(filepath)
+        chat_data = read_chat_file(filepath)
+        if not isinstance(chat_data, dict) or "messages" not in chat_data:
+            return None
+        compact_chat_file(filepath, chat_data, codec)
+        _catalog_chat(filepath, chat_data, [])
+        return before, os.path.getsize(filepath)
+
+
+def start_save_worker():
+    """Start the background thread that performs queued chat saves.
+
+    Once running, :func:`persist_chat_file` only queues saves; pending saves
+    are flushed automatically when the interpreter exits.
+    """
+
+    global _save_worker
+    with _save_cond:
+        if _save_worker is not None and _save_worker.is_alive():
+            return
+        first_start = _save_worker is None
+        _save_worker = threading.Thread(target=_save_loop, name="chat-save-worker", daemon=True)
+        _save_worker.start()
+    if first_start:
+        atexit.register(flush_saves)
+
+
+def queue_save(filepath, chat_data):
+    """Queue ``chat_data`` to be written to ``filepath`` by the save worker.
+
+    Repeated saves of one chat inside ``SAVE_COALESCE_SECONDS`` collapse into
+    a single write of the most recent state.
+    """
+
+    # Copy the containers so later appends do not race the worker's write
+    snapshot = dict(chat_data)
+    snapshot["messages"] = list(chat_data["messages"])
+    key = os.path.abspath(filepath)
+    with _save_cond:
+        entry = _pending_saves.get(key)
+        if entry:
+            entry[0] = snapshot
+        else:
+            _pending_saves[key] = [snapshot, time.monotonic()]
+        _save_cond.notify()
+
+
+def persist_chat_file(filepath, chat_data):
+    """Save ``chat_data`` through the save worker if running, else immediately."""
+
+    if _save_worker is not None and _save_worker.is_alive():
+        queue_save(filepath, chat_data)
+    else:
+        write_chat_file(filepath, chat_data)
+
+
+def _save_loop():
+    while True:
+        with _save_cond:
+            while not _pending_saves:
+                _save_cond.wait()
+            oldest = min(e[1] for e in _pending_saves.values())
+            delay = oldest + SAVE_COALESCE_SECONDS - time.monotonic()
+            if delay > 0:
+                _save_cond.wait(delay)
+                continue
+        _write_pending()
+
+
+def _write_pending(paths=None, force=False):
+    """Write queued saves that are due, or all of ``paths`` when forced."""
+
+    global _save_error
+    with _journal_lock:
+        with _save_cond:
+            now = time.monotonic()
+            batch = []
+            for key, (data, queued) in list(_pending_saves.items()):
+                if force and (paths is None or key in paths):
+                    batch.append((key, data))
+                elif not force and now - queued >= SAVE_COALESCE_SECONDS:
+                    batch.append((key, data))
+            for key, _ in batch:
+                del _pending_saves[key]
+        for key, data in batch:
+            try:
+                write_chat_file(key, data)
+            except Exception as e:
+                _save_error = f"{key}: {e}"
+                print(f"[Error] Could not save chat to {key}: {e}", file=sys.stderr)
+                with _save_cond:
+                    # Retry later unless a newer snapshot was queued meanwhile
+                    _pending_saves.setdefault(key, [data, time.monotonic()])
+
+
+def flush_saves(filepath=None):
+    """Write queued saves now, either all of them or only ``filepath``."""
+
+    paths = None if filepath is None else {os.path.abspath(filepath)}
+    _write_pending(paths, force=True)
+
+
+def save_status():
+    """Return the number of queued saves and the age of the oldest in seconds."""
+
+    with _save_cond:
+        if not _pending_saves:
+            return {"pending_saves": 0, "save_lag": 0.0, "save_error": _save_error}
+        oldest = min(e[1] for e in _pending_saves.values())
+        return {
+            "pending_saves": len(_pending_saves),
+            "save_lag": time.monotonic() - oldest,
+            "save_error": _save_error,
+        }
 
 
 def save_chat_to_file(filename, chat_data):
-    """Write ``chat_data`` to ``filename`` inside ``CHAT_HISTORY_DIR``."""
+    """Save ``chat_data`` as ``filename`` below the history folder.
 
-    ensure_directories()
-    filepath = os.path.join(CHAT_HISTORY_DIR, filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, "w") as f:
-        json.dump(chat_data, f, indent=2)
-    return True, filepath
+    Returns ``(True, location)`` where location is where the chat storage
+    put it.
+    """
+
+    with CHAT_SAVE_SECONDS.time():
+        count_new_tokens(chat_data)
+        location = get_storage().save(filename, chat_data)
+    return True, location
+
+
+def count_new_tokens(chat_data):
+    """Cache the token count on the messages appended since the last count.
+
+    Run before a save so the count is written with a message's first
+    record; messages that already have one end the backwards scan.
+    """
+
+    for m in reversed(chat_data["messages"]):
+        if m is UNLOADED or "tokens" in m:
+            break
+        message_tokens(m)
 
 
 def load_chat_from_file(filename):
-    """Load chat data from disk, searching the history folders."""
+    """Load a saved chat, searching the history folders for a bare file name."""
 
-    ensure_directories()
-    filepath = os.path.join(CHAT_HISTORY_DIR, filename)
-    if not os.path.exists(filepath):
-        alt_auto = os.path.join(AUTOSAVE_DIR, filename)
-        alt_user = os.path.join(USERCHAT_DIR, filename)
-        alt_arch = os.path.join(ARCHIVE_DIR, filename)
-        if os.path.exists(alt_auto):
-            filepath = alt_auto
-        elif os.path.exists(alt_user):
-            filepath = alt_user
-        elif os.path.exists(alt_arch):
-            filepath = alt_arch
-        else:
+    with CHAT_LOAD_SECONDS.time():
+        data, rel = get_storage().load(filename)
+        if data is None:
             return None, None
+        return chat_from_data(data, rel)
+
+
+def chat_from_data(data, rel):
+    """Return ``(chat_data, rel)`` for stored chat ``data`` in any format version.
 
-    with open(filepath, "r") as f:
-        data = json.load(f)
+    Legacy message lists are wrapped and missing metadata filled in; returns
+    ``(None, None)`` for data that is not a chat.
+    """
+
+    fallback = os.path.splitext(os.path.basename(rel))[0]
     if isinstance(data, list):
         chat_data = {
-            "name": os.path.splitext(os.path.basename(filepath))[0],
+            "name": fallback,
             "version": "0",
             "model": MODEL,
             "messages": data,
             "summary": "",
         }
     elif isinstance(data, dict) and "messages" in data:
-        data.setdefault("name", os.path.splitext(os.path.basename(filepath))[0])
+        data.setdefault("name", fallback)
         data.setdefault("model", MODEL)
         data.setdefault("version", CHAT_VERSION)
         data.setdefault("summary", "")
         chat_data = data
     else:
         return None, None
-    return chat_data, os.path.relpath(filepath, CHAT_HISTORY_DIR)
+    return chat_data, rel
+
+
+def search_all_chats(text, dirs=None, limit=50):
+    """Search every saved chat and return ranked matches."""
+
+    return get_storage().search(text, dirs=dirs, limit=limit)
+
+
+# Where chats are kept: "files" (journal files below CHAT_HISTORY_DIR) or
+# "sqlite" (one database with a row per message), see storage.py
+STORAGE_BACKENDS = ("files", "sqlite")
+CHAT_STORAGE = os.getenv("CHAT_STORAGE", "files").strip().lower() or "files"
+if CHAT_STORAGE not in STORAGE_BACKENDS:
+    print(f"[Warning] Unknown CHAT_STORAGE '{CHAT_STORAGE}', chats are stored as files", file=sys.stderr)
+    CHAT_STORAGE = "files"
+STORAGE_FILE = os.path.join(CHAT_HISTORY_DIR, "chats.sqlite3")
+
+_storages = {}
+_storage_lock = threading.Lock()
+
+
+def get_storage(kind=None):
+    """Return the chat storage backend ``kind`` (default ``CHAT_STORAGE``)."""
+
+    kind = kind or CHAT_STORAGE
+    with _storage_lock:
+        if kind not in _storages:
+            if kind == "sqlite":
+                ensure_directories()
+                _storages[kind] = storage.SQLiteStorage(STORAGE_FILE, window=CHAT_WINDOW)
+            else:
+                _storages[kind] = FileStorage()
+        return _storages[kind]
+
+
+class FileStorage(storage.ChatStorage):
+    """Chats as journal files below ``CHAT_HISTORY_DIR``.
+
+    Saves go through the write-behind queue once the save worker runs,
+    listing and search through the catalog, and archived chats live in the
+    archive pack.
+    """
+
+    def save(self, rel, chat_data):
+        ensure_directories()
+        filepath = os.path.join(CHAT_HISTORY_DIR, rel)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        persist_chat_file(filepath, chat_data)
+        return filepath
+
+    def load(self, name, full=False):
+        ensure_directories()
+        # A queued save may not have reached the disk yet
+        flush_saves()
+        filepath = None
+        for folder in storage.CHAT_FOLDERS:
+            path = os.path.join(CHAT_HISTORY_DIR, folder, name)
+            if os.path.exists(path):
+                filepath = path
+                break
+        if filepath is None:
+            return self._load_archived(name)
+        rel = os.path.relpath(filepath, CHAT_HISTORY_DIR)
+        if full:
+            return read_chat_file(filepath), rel
+        # Long chats keep only their most recent messages in memory
+        data = _load_window(filepath)
+        if data is None:
+            data = read_chat_file(filepath, track=True)
+            # Reading the whole journal recorded its offsets
+            data = _load_window(filepath) or data
+        return data, rel
+
+    def _load_archived(self, name):
+        """Load a chat from the archive pack, by history path, archive-relative or bare name.
+
+        A bare file name matches the most recently archived chat of that name
+        in any archive folder.
+        """
+
+        packed = archived_name(name)
+        packed = name if packed is None else packed
+        pack = get_archive()
+        raw = pack.get(packed)
+        if raw is None and os.path.basename(name) == name:
+            archived = pack.names()
+            matches = [n for n in archived if os.path.basename(n) == name]
+            if matches:
+                packed = max(matches, key=archived.get)
+                raw = pack.get(packed)
+        if raw is None:
+            return None, None
+        return load_chat_bytes(raw), os.path.join(os.path.basename(ARCHIVE_DIR), packed)
+
+    def window_messages(self, source, start, stop):
+        with _journal_lock:
+            rel = history_relpath(source)
+            stored = None
+            if rel is not None and _journal_entry(rel, source) is not None:
+                stored = _read_records(source, rel, start, stop)
+            if stored is None:
+                stored = _read_chat_file(source, False)["messages"][start:stop]
+        if len(stored) != stop - start:
+            raise RuntimeError(f"{source} no longer holds messages {start} to {stop}")
+        return stored
+
+    def get(self, rel):
+        return get_catalog().get(rel)
+
+    def entries(self, top=None):
+        return get_catalog().entries(top)
+
+    def dirs(self):
+        if not os.path.exists(CHAT_HISTORY_DIR):
+            return []
+        return sorted(
+            d for d in os.listdir(CHAT_HISTORY_DIR)
+            if os.path.isdir(os.path.join(CHAT_HISTORY_DIR, d))
+        )
+
+    def search(self, text, dirs=None, limit=50):
+        # Queued saves are not in the index until they are written
+        flush_saves()
+        return get_catalog().search(text, dirs=dirs, limit=limit)
+
+    def archive(self, rel):
+        src = os.path.join(CHAT_HISTORY_DIR, rel)
+        # Write any queued save first so it cannot recreate the file after the move
+        flush_saves(src)
+        if not os.path.exists(src) or rel.startswith("archive/"):
+            return False
+        try:
+            data = read_chat_file(src)
+            data["archived_from"] = rel
+            pack = get_archive()
+            name = storage.archived_copy_name(
+                rel, lambda n: n in pack or os.path.exists(os.path.join(ARCHIVE_DIR, n))
+            )
+            pack.put(name, chat_file_bytes(data))
+            os.remove(src)
+            get_catalog().move(rel, os.path.join("archive", name))
+            return True
+        except Exception:
+            return False
+
+    def restore(self, rel):
+        subpath = rel[len("archive/"):] if rel.startswith("archive/") else rel
+        src = os.path.join(ARCHIVE_DIR, subpath)
+        flush_saves(src)
+        pack = get_archive()
+        try:
+            # A chat archived as a plain file, or written to after loading it
+            # from the archive, takes precedence over its packed copy
+            if os.path.exists(src):
+                data = read_chat_file(src)
+            else:
+                raw = pack.get(subpath)
+                if raw is None:
+                    return False
+                data = load_chat_bytes(raw)
+            dest_rel = data.get("archived_from", os.path.join("userchat", os.path.basename(rel)))
+            dest = os.path.join(CHAT_HISTORY_DIR, dest_rel)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            data.pop("archived_from", None)
+            write_chat_file(dest, data)
+            if os.path.exists(src):
+                os.remove(src)
+            pack.delete(subpath)
+            get_catalog().remove(os.path.join("archive", subpath))
+            return True
+        except Exception:
+            return False
+
+    def delete(self, rel):
+        subpath = rel[len("archive/"):] if rel.startswith("archive/") else rel
+        path = os.path.join(ARCHIVE_DIR, subpath)
+        flush_saves(path)
+        try:
+            found = get_archive().delete(subpath)
+            if os.path.exists(path):
+                os.remove(path)
+                found = True
+            if found:
+                get_catalog().remove(os.path.join("archive", subpath))
+            return found
+        except Exception:
+            return False
+
+    def clear_archive(self):
+        """Remove every chat from the archive.
+
+        The pack is dropped as a whole; only chats still archived as plain
+        files from before the pack existed are removed one by one.
+        """
+        success = True
+        flush_saves()
+        get_archive().clear()
+        for root, _, files in os.walk(ARCHIVE_DIR):
+            for fname in files:
+                if not fname.endswith('.chat'):
+                    continue
+                try:
+                    os.remove(os.path.join(root, fname))
+                except Exception:
+                    success = False
+        if success:
+            get_catalog().remove_dir('archive')
+        else:
+            get_catalog().reconcile(describe_chat_file)
+        return success
+
+    def flush(self, rel=None):
+        flush_saves(None if rel is None else os.path.join(CHAT_HISTORY_DIR, rel))
+
+
+def parse_search_args(args):
+    """Split ``/search`` arguments into ``(all_chats, dirs, term)``.
+
+    ``--all`` searches every saved chat instead of the current one and each
+    ``--dir <name>`` limits that search to a history subdirectory.
+    """
+
+    all_chats = False
+    dirs = []
+    words = []
+    i = 0
+    while i < len(args):
+        if args[i] == "--all":
+            all_chats = True
+        elif args[i] == "--dir" and i + 1 < len(args):
+            all_chats = True
+            dirs.append(args[i + 1])
+            i += 1
+        else:
+            words.append(args[i])
+        i += 1
+    return all_chats, dirs, " ".join(words)
+
+
+def format_search_hit(hit):
+    """Render a cross-chat search result as a single line."""
+
+    return f"{hit['name']} ({hit['file']}) #{hit['index']}: {hit['role']} - {hit['snippet']}"
 
 
 def ensure_prompts_dir():
@@ -207,12 +1849,12 @@ def export_chat(chat_data, name):
     if name.endswith('.md'):
         with open(path, 'w') as f:
             f.write(f"# {chat_data['name']}\n\n")
-            for m in chat_data['messages']:
+            for m in chat_messages(chat_data):
                 f.write(f"**{m['role']}**: {m['content']}\n\n")
     else:
         if not name.endswith('.txt'):
             path += '.txt'
         with open(path, 'w') as f:
-            for m in chat_data['messages']:
+            for m in chat_messages(chat_data):
                 f.write(f"{m['role'].capitalize()}: {m['content']}\n\n")
     return path
@@ -0,0 +1,175 @@
+"""Minimal Prometheus-style metrics: counters, gauges and histograms.
+
+Metrics register themselves when created and :func:`render` returns them in
+the Prometheus text exposition format served by ``/metrics``.  Every metric
+is safe to update from the save worker and other threads.
+"""
+
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram buckets in seconds, from fast disk writes to slow answers
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, or is read from ``function`` when rendered."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count the enclosed block as in progress."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [f"{self.name} {_number(self.function())}"]
+            except Exception:
+                return []
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, usually durations in seconds."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the enclosed block takes.
+
+        Labels may be filled in inside the block through the yielded dict.
+        """
+        labels = dict(labels)
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._values.items())
+        lines = []
+        for key, (counts, total, value_sum) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _labels(self.labelnames, key, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            le = _labels(self.labelnames, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{le} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(value_sum)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {total}")
+        return lines
+
+
+def render():
+    """Return every registered metric in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.header())
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
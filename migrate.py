@@ -0,0 +1,294 @@
+"""Bulk migrations of the chat history behind ``cli.py convert``, ``sort`` and ``storage``.
+
+Files are processed by a pool of worker processes, each file is rewritten
+through a temporary file and a rename, and every finished file is recorded
+in a checkpoint so an interrupted run picks up where it stopped.  With
+``dry_run`` nothing is written and the result only reports what would change.
+
+Format upgrades are registered with :func:`migration`; a chat is taken from
+its stored version to ``CHAT_VERSION`` one registered step at a time, so a new
+format version only needs one more step.  A version without a registered
+step is taken to predate 1.0 and upgraded from ``"0"``, as ``convert`` always
+did for any version other than the current one.
+
+:func:`copy_storage` copies every chat from one storage backend to another.
+"""
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import logic
+
+# Fewer files than this are migrated in-process; starting workers costs more
+POOL_MIN_FILES = 200
+# Files handed to a worker at a time
+CHUNK_SIZE = 32
+# Seconds between progress lines and checkpoint flushes
+PROGRESS_INTERVAL = 0.5
+
+# Upgrade steps keyed by the version they start from: (to_version, func)
+MIGRATIONS = {}
+
+
+def migration(from_version, to_version):
+    """Register ``func(chat_data, path)`` as the upgrade from ``from_version``.
+
+    The function receives a chat dict at ``from_version`` and returns it at
+    ``to_version``; it must not write any file.
+    """
+
+    def register(func):
+        MIGRATIONS[from_version] = (to_version, func)
+        return func
+
+    return register
+
+
+def chat_version(data):
+    """Return the format version of raw chat data; bare message lists are ``"0"``."""
+
+    if isinstance(data, list):
+        return "0"
+    return data.get("version", "0")
+
+
+def upgrade(data, path, target=None):
+    """Return ``data`` migrated step by step to ``target`` (default ``CHAT_VERSION``)."""
+
+    target = target or logic.CHAT_VERSION
+    chat_data = {"messages": data} if isinstance(data, list) else data
+    version = chat_version(data)
+    if version != target and version not in MIGRATIONS:
+        # An unknown version string from before versions were tracked
+        version = "0"
+    while version != target:
+        if version not in MIGRATIONS:
+            raise ValueError(f"no migration from version {version} to {target}")
+        version, func = MIGRATIONS[version]
+        chat_data = func(chat_data, path)
+        chat_data["version"] = version
+    return chat_data
+
+
+@migration("0", "1.0")
+def _add_metadata(chat_data, path):
+    """Version 1.0 stores the chat name and model next to the messages."""
+    chat_data.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    chat_data.setdefault("model", logic.MODEL)
+    return chat_data
+
+
+# --- per-file work, run inside the worker processes ---
+
+def convert_file(path, dry_run=False):
+    """Upgrade one chat file in place and return ``(result, detail)``."""
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+        data = logic.load_chat_bytes(raw)
+        if not isinstance(data, (list, dict)):
+            return "error", "unknown format"
+        if chat_version(data) == logic.CHAT_VERSION:
+            return "current", None
+        chat_data = upgrade(data, path)
+        if not dry_run:
+            # Keep the file's compression; the journal is renamed into place
+            logic.compact_chat_file(path, chat_data, logic.chat_codec(raw))
+        return "converted", None
+    except Exception as e:
+        return "error", str(e)
+
+
+def sort_file(path, dry_run=False):
+    """Move one chat into ``autosave`` or ``userchat`` and return ``(result, detail)``."""
+    fname = os.path.basename(path)
+    target = logic.AUTOSAVE_DIR if fname.startswith("autosave-") else logic.USERCHAT_DIR
+    dest = os.path.join(target, fname)
+    try:
+        if not os.path.exists(path):
+            return "current", None  # Moved by an earlier, interrupted run
+        if not dry_run:
+            os.replace(path, dest)
+        return "moved", dest
+    except Exception as e:
+        return "error", str(e)
+
+
+def _work(task):
+    kind, path, dry_run = task
+    return WORKERS[kind](path, dry_run)
+
+
+WORKERS = {"convert": convert_file, "sort": sort_file}
+
+
+def chat_files(kind):
+    """Return the chat files a ``kind`` migration goes through, in a stable order."""
+    paths = []
+    if kind == "sort":
+        for fname in os.listdir(logic.CHAT_HISTORY_DIR):
+            path = os.path.join(logic.CHAT_HISTORY_DIR, fname)
+            if fname.endswith(".chat") and os.path.isfile(path):
+                paths.append(path)
+    else:
+        for root_dir, _, files in os.walk(logic.CHAT_HISTORY_DIR):
+            paths.extend(os.path.join(root_dir, f) for f in files if f.endswith(".chat"))
+    return sorted(paths)
+
+
+# --- checkpoints ---
+
+def checkpoint_path(kind):
+    return os.path.join(logic.CHAT_HISTORY_DIR, f".{kind}.checkpoint")
+
+
+def _read_checkpoint(path, header):
+    """Return the files finished by an earlier run with the same ``header``."""
+    try:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return set()
+    done = set()
+    for n, line in enumerate(lines):
+        try:
+            rec = json.loads(line)
+        except json.JSONDecodeError:
+            break  # Torn last line
+        if n == 0:
+            if rec != header:
+                return set()  # Left by a different migration target
+        else:
+            done.add(rec["file"])
+    return done
+
+
+def _status(kind, finished, total, seconds, stats):
+    rate = finished / seconds if seconds else 0
+    return f"{kind}: {finished}/{total} files, {rate:.0f} files/s, {len(stats['errors'])} errors"
+
+
+def _print_progress(line):
+    print(f"\r{line}", end="", file=sys.stderr, flush=True)
+
+
+def run(kind, dry_run=False, workers=None, progress=_print_progress):
+    """Run the ``convert`` or ``sort`` migration over the chat history.
+
+    ``progress(line)`` receives a status line about twice a second (stderr
+    by default).  Returns a dict with counts per result, the errors as
+    ``(path, message)`` pairs, how many files an earlier run had finished,
+    and the elapsed seconds.
+    """
+
+    logic.ensure_directories()
+    header = {"migration": kind, "target": logic.CHAT_VERSION}
+    ckpt = checkpoint_path(kind)
+    done = set() if dry_run else _read_checkpoint(ckpt, header)
+    paths = [p for p in chat_files(kind) if p not in done]
+    stats = {"files": len(paths), "resumed": len(done), "errors": [], "counts": {}, "interrupted": False}
+    workers = workers or os.cpu_count() or 1
+    tasks = [(kind, p, dry_run) for p in paths]
+
+    log = None
+    if not dry_run:
+        fresh = not done
+        log = open(ckpt, "w" if fresh else "a")
+        if fresh:
+            log.write(json.dumps(header) + "\n")
+    pool = None
+    start = last = time.monotonic()
+    finished = 0
+    try:
+        if workers > 1 and len(tasks) >= POOL_MIN_FILES:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            results = pool.map(_work, tasks, chunksize=CHUNK_SIZE)
+        else:
+            results = map(_work, tasks)
+        for path, (result, detail) in zip(paths, results):
+            finished += 1
+            stats["counts"][result] = stats["counts"].get(result, 0) + 1
+            if result == "error":
+                stats["errors"].append((path, detail))
+            elif log:
+                log.write(json.dumps({"file": path}) + "\n")
+            now = time.monotonic()
+            if now - last >= PROGRESS_INTERVAL:
+                last = now
+                if log:
+                    log.flush()
+                progress(_status(kind, finished, len(paths), now - start, stats))
+    except KeyboardInterrupt:
+        stats["interrupted"] = True
+    finally:
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if log:
+            log.close()
+    stats["done"] = finished
+    stats["seconds"] = time.monotonic() - start
+    progress(_status(kind, finished, len(paths), stats["seconds"], stats))
+    if progress is _print_progress:
+        print(file=sys.stderr)
+    if not dry_run:
+        if not stats["interrupted"] and not stats["errors"]:
+            os.remove(ckpt)
+        if finished:
+            logic.reconcile_catalog()
+    return stats
+
+
+def copy_storage(source, target, dry_run=False, progress=_print_progress):
+    """Copy every chat from the ``source`` storage backend into ``target``.
+
+    Chats the target already holds with as many messages are skipped, so an
+    interrupted copy continues where it stopped.  The source is left as it
+    is.  Returns the same stats as :func:`run`.
+    """
+
+    src = logic.get_storage(source)
+    dst = logic.get_storage(target)
+    kind = f"{source} -> {target}"
+    # Saves still queued for the source would be missing from its listing
+    src.flush()
+    entries = src.entries()
+    stats = {"files": len(entries), "resumed": 0, "errors": [], "counts": {}, "interrupted": False}
+    start = last = time.monotonic()
+    finished = 0
+    try:
+        for entry in entries:
+            rel = entry["file"]
+            finished += 1
+            stored = dst.get(rel)
+            if stored is not None and stored["messages"] == entry["messages"]:
+                stats["resumed"] += 1
+                continue
+            try:
+                data, _ = src.load(rel, full=True)
+                chat_data, _ = logic.chat_from_data(data, rel)
+                if chat_data is None:
+                    raise ValueError("unknown format")
+                if not dry_run:
+                    dst.save(rel, chat_data)
+                result = "copied"
+            except Exception as e:
+                stats["errors"].append((rel, str(e)))
+                result = "error"
+            stats["counts"][result] = stats["counts"].get(result, 0) + 1
+            now = time.monotonic()
+            if now - last >= PROGRESS_INTERVAL:
+                last = now
+                progress(_status(kind, finished, len(entries), now - start, stats))
+    except KeyboardInterrupt:
+        stats["interrupted"] = True
+    finally:
+        dst.flush()
+    stats["done"] = finished
+    stats["seconds"] = time.monotonic() - start
+    progress(_status(kind, finished, len(entries), stats["seconds"], stats))
+    if progress is _print_progress:
+        print(file=sys.stderr)
+    return stats
@@ -0,0 +1,182 @@
+"""Local stand-in for the Groq chat completions API, used by the benchmarks.
+
+Run it with ``python mock_groq.py --port 8001`` and point the app at it with
+``GROQ_BASE_URL=http://127.0.0.1:8001``.  Answers are made up, but the
+timing is configurable: ``--latency`` seconds pass before the first token,
+tokens then arrive at ``--tokens-per-second``, and ``--error-rate`` of the
+requests fail with a server error.  With ``--requests-per-minute`` the mock
+sends Groq's ``x-ratelimit-*`` headers and answers 429 once the budget of
+an API key is used up, and ``--api-keys`` rejects every other key with 401.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+
+# Behaviour of the mock, changed with configure() or the command line
+settings = {
+    "latency": 0.05,
+    "tokens_per_second": 500.0,
+    "error_rate": 0.0,
+    "answer_tokens": 50,
+    "requests_per_minute": 0,
+    # Accepted API keys, empty to accept any
+    "api_keys": [],
+}
+# Requests served, for sanity checks in the benchmarks
+counters = {"requests": 0, "errors": 0, "rate_limited": 0, "rejected": 0}
+# Request budget of each API key, refilled continuously like Groq's limits
+_budgets = {}
+
+
+def configure(**values):
+    """Update the mock's latency, speed, error rate or answer length."""
+    unknown = set(values) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown mock settings: {', '.join(sorted(unknown))}")
+    settings.update(values)
+
+
+def _rate_limit(key):
+    """Take one request from the key's budget and return ``(allowed, headers)``."""
+    limit = settings["requests_per_minute"]
+    if not limit:
+        return True, {}
+    now = time.monotonic()
+    budget = _budgets.setdefault(key, {"level": limit, "updated": now})
+    level = min(limit, budget["level"] + (now - budget["updated"]) * limit / 60)
+    budget["updated"] = now
+    allowed = level >= 1
+    if allowed:
+        level -= 1
+    budget["level"] = level
+    headers = {
+        "x-ratelimit-limit-requests": str(limit),
+        "x-ratelimit-remaining-requests": str(int(level)),
+        "x-ratelimit-reset-requests": f"{(limit - level) * 60 / limit:.2f}s",
+    }
+    if not allowed:
+        headers["retry-after"] = f"{(1 - level) * 60 / limit:.2f}"
+    return allowed, headers
+
+
+def _prompt_tokens(messages):
+    return sum(len(m.get("content") or "") // 4 + 4 for m in messages)
+
+
+def _tokens(count):
+    return [f"token{i} " for i in range(count)]
+
+
+def _usage(body, count):
+    prompt = _prompt_tokens(body.get("messages", []))
+    return {"prompt_tokens": prompt, "completion_tokens": count, "total_tokens": prompt + count}
+
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    """Answer like the chat completions endpoint, streaming or not."""
+    body = await request.json()
+    counters["requests"] += 1
+    key = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if settings["api_keys"] and key not in settings["api_keys"]:
+        counters["rejected"] += 1
+        return JSONResponse(
+            {"error": {"message": "Invalid API Key", "type": "invalid_request_error", "code": "invalid_api_key"}},
+            status_code=401,
+        )
+    allowed, headers = _rate_limit(key)
+    if not allowed:
+        counters["rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers=headers,
+        )
+    if random.random() < settings["error_rate"]:
+        counters["errors"] += 1
+        return JSONResponse(
+            {"error": {"message": "Mock failure", "type": "server_error"}}, status_code=500
+        )
+    count = settings["answer_tokens"]
+    if body.get("max_tokens"):
+        count = min(count, body["max_tokens"])
+    tokens = _tokens(count)
+    interval = 1 / settings["tokens_per_second"] if settings["tokens_per_second"] else 0
+    model = body.get("model", "mock")
+    created = int(time.time())
+    completion_id = f"chatcmpl-mock-{counters['requests']}"
+
+    if not body.get("stream"):
+        await asyncio.sleep(settings["latency"] + interval * count)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": _usage(body, count),
+        }, headers=headers)
+
+    async def frames():
+        await asyncio.sleep(settings["latency"])
+        for token in tokens:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+            if interval:
+                await asyncio.sleep(interval)
+        last = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "x_groq": {"id": completion_id, "usage": _usage(body, count)},
+        }
+        yield f"data: {json.dumps(last)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(frames(), media_type="text/event-stream", headers=headers)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=settings["latency"])
+    parser.add_argument("--tokens-per-second", type=float, default=settings["tokens_per_second"])
+    parser.add_argument("--error-rate", type=float, default=settings["error_rate"])
+    parser.add_argument("--answer-tokens", type=int, default=settings["answer_tokens"])
+    parser.add_argument("--requests-per-minute", type=int, default=settings["requests_per_minute"])
+    parser.add_argument("--api-keys", default="", help="comma separated keys to accept")
+    args = parser.parse_args()
+    configure(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        answer_tokens=args.answer_tokens,
+        requests_per_minute=args.requests_per_minute,
+        api_keys=[k for k in args.api_keys.split(",") if k],
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
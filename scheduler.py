@@ -0,0 +1,491 @@
+"""Scheduler for upstream Groq requests shared by every web session.
+
+Requests wait in per-session queues and are started in round-robin order,
+interactive turns before background work such as summaries and naming, so
+one busy session cannot starve the others.  A request only starts when a
+concurrency slot is free and one of the configured API keys has request and
+token budget left.  The budgets are token buckets that follow Groq's
+``x-ratelimit-*`` response headers, and rate limited or failed requests are
+retried with jittered exponential backoff.  Identical requests running at
+the same time can share one upstream call.
+"""
+
+import asyncio
+import math
+import random
+import re
+import time
+from collections import OrderedDict, deque
+
+import groq
+
+# Priorities, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Status codes worth retrying besides 5xx: timeout, conflict, rate limit and
+# Groq's "over capacity"
+RETRY_STATUSES = {408, 409, 429, 498}
+
+
+def parse_duration(value):
+    """Return the seconds in a Groq reset header such as ``2m59.56s`` or ``120ms``."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def retry_after(error):
+    """Return the delay the server asked for with a failed request, if any."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    return parse_duration(headers.get("retry-after")) or (
+        parse_duration(headers.get("x-ratelimit-reset-requests"))
+        if _header_number(headers, "x-ratelimit-remaining-requests") == 0
+        else None
+    )
+
+
+def is_retryable(error):
+    """Return True for errors a later attempt may not run into."""
+    if isinstance(error, groq.APIConnectionError):
+        return True
+    if isinstance(error, groq.APIStatusError):
+        return error.status_code in RETRY_STATUSES or error.status_code >= 500
+    return False
+
+
+def backoff_delay(attempt, base=0.5, cap=20.0, error=None):
+    """Return how long to wait before retry number ``attempt`` (from 0).
+
+    Uses full jitter on an exponential backoff, or the server's requested
+    delay plus a little jitter so waiting clients do not retry in lockstep.
+    """
+    asked = retry_after(error) if error is not None else None
+    if asked is not None:
+        return asked + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """Budget refilled at a steady rate, e.g. requests or tokens per minute.
+
+    A bucket without a capacity is unlimited until the first rate-limit
+    headers describe it.
+    """
+
+    def __init__(self, per_minute=None):
+        self.capacity = per_minute or None
+        self.rate = per_minute / 60 if per_minute else 0.0
+        self.level = self.capacity or 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now=None):
+        """Return seconds until ``amount`` can be taken, 0 if it can be now."""
+        if self.capacity is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        # Requests larger than the whole bucket go once it is full
+        needed = min(amount, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        if self.rate <= 0:
+            return 1.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill(time.monotonic())
+        if self.capacity is not None:
+            self.level -= amount
+
+    def sync(self, limit, remaining, reset):
+        """Adopt the limit, remaining budget and reset time from response headers."""
+        now = time.monotonic()
+        self._refill(now)
+        if limit:
+            self.capacity = limit
+        if remaining is None or self.capacity is None:
+            return
+        self.level = min(remaining, self.capacity)
+        # Groq reports when the bucket will be full again, which gives the refill rate
+        if reset and remaining < self.capacity:
+            self.rate = max(self.rate, (self.capacity - remaining) / reset)
+
+    def stats(self):
+        if self.capacity is None:
+            return None
+        self._refill(time.monotonic())
+        return {"limit": self.capacity, "remaining": round(self.level, 1)}
+
+
+class UnavailableError(RuntimeError):
+    """Raised when no API key can serve a request in reasonable time."""
+
+
+class ApiKey:
+    """One Groq API key with its own client, budgets and health."""
+
+    def __init__(self, key, requests_per_minute=0, tokens_per_minute=0, max_wait=60.0):
+        self.key = key
+        self.client = None
+        self.max_wait = max_wait
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        # Why the key was taken out of rotation, None while it is healthy
+        self.disabled = None
+        self.active = 0
+        self.started = 0
+
+    @property
+    def label(self):
+        """The key shortened so it can be shown in /info."""
+        return f"...{self.key[-4:]}"
+
+    async def observe(self, response):
+        """Update the key's budgets and health from a response; an httpx hook."""
+        headers = response.headers
+        self.requests.sync(
+            _header_number(headers, "x-ratelimit-limit-requests"),
+            _header_number(headers, "x-ratelimit-remaining-requests"),
+            parse_duration(headers.get("x-ratelimit-reset-requests")),
+        )
+        self.tokens.sync(
+            _header_number(headers, "x-ratelimit-limit-tokens"),
+            _header_number(headers, "x-ratelimit-remaining-tokens"),
+            parse_duration(headers.get("x-ratelimit-reset-tokens")),
+        )
+        if response.status_code in (401, 403):
+            self.disabled = f"rejected with status {response.status_code}"
+        elif response.status_code == 429:
+            # A long wait means a quota is used up; the key sits out until it resets
+            self.pause(parse_duration(headers.get("retry-after")) or 1.0)
+
+    def pause(self, seconds):
+        """Keep the key out of rotation for ``seconds``, e.g. after a 429."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait_time(self, tokens, now):
+        """Return seconds until the key can take a request of ``tokens``."""
+        if self.disabled:
+            return math.inf
+        return max(
+            self.paused_until - now,
+            self.requests.wait_time(1, now),
+            self.tokens.wait_time(tokens, now),
+        )
+
+    def headroom(self):
+        """Return the smallest share of the key's budgets still left."""
+        shares = [b.level / b.capacity for b in (self.requests, self.tokens) if b.capacity]
+        return min(shares, default=1.0)
+
+    def stats(self):
+        paused = self.paused_until - time.monotonic()
+        return {
+            "key": self.label,
+            "active": self.active,
+            "started": self.started,
+            "disabled": self.disabled,
+            "paused": round(paused, 1) if paused > 0 else 0,
+            "requests": self.requests.stats(),
+            "tokens": self.tokens.stats(),
+        }
+
+
+class _Waiter:
+    __slots__ = ("future", "tokens")
+
+    def __init__(self, future, tokens):
+        self.future = future
+        self.tokens = tokens
+
+
+class Scheduler:
+    """Fair, rate-limit aware gate in front of a pool of async Groq clients.
+
+    ``max_concurrency`` requests run at once.  Each API key added with
+    :meth:`set_keys` gets its own client and budgets, and a request goes to
+    the key with the most quota left.  ``requests_per_minute`` and
+    ``tokens_per_minute`` seed each key's budgets; left at 0 they are
+    learned from the response headers.  A key the API rejects is taken out
+    of rotation, and one whose quota is used up sits out until it resets.
+    A failed request is retried up to ``max_retries`` times, on another key
+    when its own is out, but never waits longer than ``max_wait`` seconds
+    for a key.
+    """
+
+    def __init__(self, max_concurrency=8, requests_per_minute=0, tokens_per_minute=0,
+                 max_retries=4, backoff_base=0.5, backoff_cap=20.0, max_wait=60.0):
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_wait = max_wait
+        self.keys = []
+        # priority -> session -> waiters; sessions rotate after each grant
+        self._queues = {}
+        self._active = 0
+        self._timer = None
+        # Shared calls by key, see run()
+        self._inflight = {}
+        self._stats = {"started": 0, "retries": 0, "rate_limited": 0, "failed": 0, "coalesced": 0}
+
+    # --- keys ---
+
+    def set_keys(self, keys, make_client):
+        """Use the API ``keys``, creating clients with ``make_client(key, on_response)``.
+
+        Keys that stay keep their client, budgets and health; requests
+        already running on a dropped key finish normally.
+        """
+        current = {k.key: k for k in self.keys}
+        pool = []
+        for key in dict.fromkeys(keys):
+            entry = current.get(key)
+            if entry is None:
+                entry = ApiKey(key, self.requests_per_minute, self.tokens_per_minute, self.max_wait)
+                entry.client = make_client(key, entry.observe)
+            pool.append(entry)
+        self.keys = pool
+        if self._queues:
+            self._dispatch()
+
+    def _pick(self, tokens, now):
+        """Return ``(wait, key)`` for the key that can take a request soonest."""
+        best = (math.inf, None)
+        best_rank = None
+        for key in self.keys:
+            wait = key.wait_time(tokens, now)
+            rank = (max(wait, 0), -key.headroom(), key.active)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = (wait, key), rank
+        return best
+
+    # --- queueing ---
+
+    async def acquire(self, session=None, priority=INTERACTIVE, tokens=0):
+        """Wait for this request's turn, a free slot and a key with budget.
+
+        Returns the :class:`ApiKey` to use; pass it to :meth:`release`.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(priority, OrderedDict()).setdefault(session, deque())
+        waiter = _Waiter(future, tokens)
+        queue.append(waiter)
+        self._dispatch()
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as the caller gave up
+                self.release(future.result())
+            else:
+                self._forget(priority, session, waiter)
+            raise
+
+    def release(self, key):
+        """Free the slot and key taken by :meth:`acquire`."""
+        key.active -= 1
+        self._active -= 1
+        self._dispatch()
+
+    def _forget(self, priority, session, waiter):
+        sessions = self._queues.get(priority, {})
+        queue = sessions.get(session)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del sessions[session]
+        self._dispatch()
+
+    def _pop(self, priority, session):
+        sessions = self._queues[priority]
+        waiter = sessions[session].popleft()
+        if sessions[session]:
+            sessions.move_to_end(session)
+        else:
+            del sessions[session]
+        return waiter
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._active < self.max_concurrency:
+            head = self._next_waiter()
+            if head is None:
+                return
+            priority, session, waiter = head
+            wait, key = self._pick(waiter.tokens, time.monotonic())
+            if wait > self.max_wait:
+                self._pop(priority, session)
+                self._stats["failed"] += 1
+                waiter.future.set_exception(UnavailableError(
+                    "No Groq API key is available: every key is rate limited or was rejected"
+                ))
+                continue
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            self._pop(priority, session)
+            key.requests.take(1)
+            key.tokens.take(waiter.tokens)
+            key.active += 1
+            key.started += 1
+            self._active += 1
+            self._stats["started"] += 1
+            waiter.future.set_result(key)
+
+    def _next_waiter(self):
+        for priority in sorted(self._queues):
+            sessions = self._queues[priority]
+            for session, queue in list(sessions.items()):
+                # Drop waiters whose callers have gone away
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                if queue:
+                    return priority, session, queue[0]
+                del sessions[session]
+        return None
+
+    # --- running requests ---
+
+    def _retry_delay(self, error, attempt, key):
+        status = getattr(error, "status_code", None)
+        if status == 429:
+            self._stats["rate_limited"] += 1
+        if attempt >= self.max_retries:
+            self._stats["failed"] += 1
+            return None
+        now = time.monotonic()
+        if key.wait_time(0, now) > self.max_wait:
+            # The key was rejected or its quota is gone; go straight to another one
+            if any(k.wait_time(0, now) <= self.max_wait for k in self.keys if k is not key):
+                self._stats["retries"] += 1
+                return 0
+            self._stats["failed"] += 1
+            return None
+        delay = backoff_delay(attempt, self.backoff_base, self.backoff_cap, error)
+        if not is_retryable(error) or delay > self.max_wait:
+            self._stats["failed"] += 1
+            return None
+        self._stats["retries"] += 1
+        return delay
+
+    async def run(self, call, session=None, priority=INTERACTIVE, tokens=0, key=None):
+        """Await ``call(client)`` in turn, retrying failures that may be temporary.
+
+        The slot is given back while waiting to retry so others can go first.
+        Calls with the same ``key`` made while one is running wait for that
+        one and get its result (or error) instead of calling again.  A caller
+        that gives up does not cancel the call for the others.
+        """
+        if key is None:
+            return await self._run(call, session, priority, tokens)
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(
+                self._run(call, session, priority, tokens)
+            )
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            self._stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # Mark the error as seen in case every caller gave up
+            task.exception()
+
+    async def _run(self, call, session, priority, tokens):
+        attempt = 0
+        while True:
+            key = await self.acquire(session, priority, tokens)
+            try:
+                return await call(key.client)
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, key)
+                if delay is None:
+                    raise
+            finally:
+                self.release(key)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def stream(self, make_stream, session=None, priority=INTERACTIVE, tokens=0):
+        """Yield from ``make_stream(client)`` in turn, holding the slot until it ends.
+
+        Failures are retried only until the first item arrives; after that
+        the caller has already used part of the answer.
+        """
+        attempt = 0
+        while True:
+            key = await self.acquire(session, priority, tokens)
+            started = False
+            try:
+                async for item in make_stream(key.client):
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                delay = None if started else self._retry_delay(e, attempt, key)
+                if delay is None:
+                    raise
+            finally:
+                self.release(key)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def slot(self, session=None, priority=INTERACTIVE, tokens=0):
+        """Return an async context manager giving a client, without retries."""
+        return _Slot(self, session, priority, tokens)
+
+    def stats(self):
+        """Return queue lengths, per-key budgets and retry counters."""
+        stats = dict(self._stats)
+        stats["active"] = self._active
+        stats["queued"] = sum(len(q) for s in self._queues.values() for q in s.values())
+        stats["keys"] = [k.stats() for k in self.keys]
+        return stats
+
+
+class _Slot:
+    def __init__(self, scheduler, session, priority, tokens):
+        self.args = (session, priority, tokens)
+        self.scheduler = scheduler
+        self.key = None
+
+    async def __aenter__(self):
+        self.key = await self.scheduler.acquire(*self.args)
+        return self.key.client
+
+    async def __aexit__(self, *exc):
+        self.scheduler.release(self.key)
@@ -1,25 +1,42 @@
 """FastAPI server exposing the GroqChat web interface and REST API."""
 
-from fastapi import FastAPI, BackgroundTasks, Request, HTTPException
-from fastapi.responses import HTMLResponse, Response
+from fastapi import FastAPI, BackgroundTasks, Request
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
 import json
-import shutil
-from datetime import datetime
 import subprocess
 import sys
 import threading
 import secrets
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import aclosing, asynccontextmanager
 from dotenv import load_dotenv, set_key
 
 # Load variables from .env first and fall back to system environment values
-load_dotenv(override=True)
+if os.getenv("LOAD_DOTENV", "true").lower() == "true":
+    load_dotenv(override=True)
 
+import completion_cache
 import logic
+import metrics
+import scheduler
+import session_store
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    """Run chat saves and naming in the background and flush saves on shutdown."""
+    logic.start_save_worker()
+    namer = asyncio.create_task(name_chats())
+    yield
+    namer.cancel()
+    logic.flush_saves()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -33,37 +50,195 @@ DEV_MODE = os.getenv("DEV_MODE", "true").lower() == "true"
 ENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env')
 
 
+HTTP_REQUESTS = metrics.Counter(
+    "groqchat_http_requests_total", "HTTP requests answered.", ("method", "route", "status")
+)
+HTTP_SECONDS = metrics.Histogram(
+    "groqchat_http_request_seconds", "Time to answer HTTP requests.", ("method", "route")
+)
+IN_FLIGHT = metrics.Gauge("groqchat_requests_in_flight", "HTTP requests being answered.")
+STREAMS_IN_FLIGHT = metrics.Gauge("groqchat_streams_in_flight", "Answers streaming to clients.")
+MESSAGE_SECONDS = metrics.Histogram(
+    "groqchat_message_seconds", "Time to answer a chat message.", ("model", "mode")
+)
+MESSAGE_ERRORS = metrics.Counter(
+    "groqchat_message_errors_total", "Chat messages that could not be answered.", ("model", "mode")
+)
+COMMAND_SECONDS = metrics.Histogram(
+    "groqchat_command_seconds", "Time to run a slash command.", ("command",)
+)
+COMMANDS = metrics.Counter(
+    "groqchat_commands_total", "Slash commands run, by outcome.", ("command", "outcome")
+)
+SUMMARY_SECONDS = metrics.Histogram(
+    "groqchat_summary_seconds", "Time to summarize a chat.", ("model",)
+)
+LIST_CHATS_SECONDS = metrics.Histogram(
+    "groqchat_list_chats_seconds", "Time to list the saved chats."
+)
+# Commands get their own label; anything else is counted as "unknown" so
+# typos cannot create new series
+COMMAND_NAMES = {
+    "/new", "/save", "/load", "/chats", "/system", "/prompt", "/summary",
+    "/search", "/export", "/update", "/model", "/compare", "/info",
+}
+
+
 @app.middleware("http")
 async def verify_app_key(request: Request, call_next):
-    """Optional header based authentication for production deployments."""
+    """Optional header based authentication for production deployments.
+
+    The key is sent as ``X-App-Key`` or, for scrapers of ``/metrics``, as
+    ``Authorization: Bearer <key>``.
+    """
     if not DEV_MODE:
         required_key = os.getenv("APP_KEY", "your_app_key")
-        if required_key and request.headers.get("x-app-key") != required_key:
-            raise HTTPException(status_code=403, detail="Invalid or missing app key")
+        bearer = request.headers.get("authorization", "")
+        bearer = bearer[7:] if bearer.lower().startswith("bearer ") else None
+        if required_key and required_key not in (request.headers.get("x-app-key"), bearer):
+            return JSONResponse({"detail": "Invalid or missing app key"}, status_code=403)
     response = await call_next(request)
     return response
 
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    """Count requests and time them per route for ``/metrics``."""
+    start = time.perf_counter()
+    status = 500
+    with IN_FLIGHT.track():
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # The route template keeps paths with ids from creating new series
+            route = request.scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            HTTP_SECONDS.observe(time.perf_counter() - start, method=request.method, route=route)
+            HTTP_REQUESTS.inc(method=request.method, route=route, status=status)
+
 # Prepare the chat environment and start a default session on startup
 logic.ensure_directories()
-client = logic.setup_client()
+# Every Groq call goes through the scheduler, which caps how many run at
+# once, takes sessions in turn so a burst from one user cannot starve the
+# others, and spreads requests over the pool of API keys (one async client
+# each) by their remaining quota, retrying with backoff.
+upstream = scheduler.Scheduler(
+    max_concurrency=logic.MAX_CONCURRENT_REQUESTS,
+    requests_per_minute=logic.REQUESTS_PER_MINUTE,
+    tokens_per_minute=logic.TOKENS_PER_MINUTE,
+    max_retries=logic.MAX_RETRIES,
+)
+
+
+def make_client(api_key, on_response):
+    """Return the async client used for one key of the pool."""
+    return logic.setup_async_client(api_key=api_key, on_response=on_response)
+
+
+upstream.set_keys(logic.api_keys(), make_client)
+# Model of new chats; each chat keeps its own in chat_data['model']
 MODEL = logic.MODEL
+metrics.Gauge(
+    "groqchat_upstream_queued", "Groq requests waiting for the scheduler.",
+    function=lambda: upstream.stats()["queued"],
+)
+metrics.Gauge(
+    "groqchat_api_keys_available", "API keys in rotation (not rejected or out of quota).",
+    function=lambda: sum(1 for k in upstream.stats()["keys"] if not k["disabled"] and not k["paused"]),
+)
+metrics.Gauge(
+    "groqchat_upstream_active", "Groq requests started by the scheduler and not yet finished.",
+    function=lambda: upstream.stats()["active"],
+)
+
+# Session limits: live sessions, total message bytes across them, and how
+# long an idle session is kept in memory
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))
+# Last context packing decision per chat file, reported by /info
+context_reports = {}
+# Running-summary jobs in flight, keyed by chat file
+memory_jobs = {}
+# Answers of the last /compare per chat file, waiting for one to be kept
+comparisons = {}
+# New chats waiting for a generated name; the naming task collects chats
+# queued within NAME_BATCH_WAIT seconds into one request
+naming_queue = asyncio.Queue()
+naming_pending = set()
+NAME_BATCH_SIZE = 8
+NAME_BATCH_WAIT = 0.25
+# Answers to messages sent with an idempotency key, remembered per session
+# so a retried POST gets the original answer instead of adding a second turn
+IDEMPOTENCY_KEYS = 64
+# Most messages returned by one /api/chat/messages page
+MESSAGE_PAGE_LIMIT = 500
+
+
+def persist_session(sess):
+    """Save an evicted session's chat so it can be resumed from disk."""
+    chat_data = sess["chat_data"]
+    context_reports.pop(sess["active"], None)
+    comparisons.pop(sess["active"], None)
+    # A chat holding only the system prompt was never written, keep it that way
+    if len(chat_data.get("messages", [])) > 1:
+        logic.save_chat_to_file(sess["active"], chat_data)
+
 
 # Per-client session storage
-sessions = {}
+sessions = session_store.SessionStore(
+    max_sessions=SESSION_MAX,
+    max_bytes=SESSION_MAX_BYTES,
+    ttl=SESSION_TTL,
+    on_evict=persist_session,
+)
+metrics.Gauge("groqchat_sessions", "Live web sessions.", function=lambda: len(sessions))
+metrics.Gauge(
+    "groqchat_session_bytes", "Message bytes held by live sessions.",
+    function=lambda: sessions.stats()["bytes"],
+)
 
 
-def get_session(request: Request, response: Response):
-    """Return session state for the requesting client."""
+def get_session(request: Request, response: Response, create=True):
+    """Return session state for the requesting client.
+
+    A client whose session was evicted gets its chat back from disk.  With
+    ``create`` false a client without a session is answered from a
+    throwaway chat and no session or cookie is created; the returned id is
+    then ``None``.
+    """
     sid = request.cookies.get("session_id")
-    if not sid or sid not in sessions:
-        sid = secrets.token_hex(16)
-        chat_data, active_filename = logic.get_new_session_state()
-        sessions[sid] = {"chat_data": chat_data, "active": active_filename}
-        response.set_cookie("session_id", sid)
-    return sid, sessions[sid]
+    sess = sessions.get(sid)
+    if sess is not None:
+        return sid, sess
+    evicted = sessions.evicted_file(sid)
+    if evicted:
+        chat_data, active_filename = logic.load_chat_from_file(evicted)
+        if chat_data is not None:
+            return sid, sessions.add(sid, chat_data, active_filename, resumed=True)
+    chat_data, active_filename = logic.get_new_session_state()
+    if not create:
+        return None, {"chat_data": chat_data, "active": active_filename}
+    sid = secrets.token_hex(16)
+    response.set_cookie("session_id", sid)
+    return sid, sessions.add(sid, chat_data, active_filename)
+
+
+def chat_model(chat_data):
+    """Return the model a chat talks to."""
+
+    return chat_data.get('model') or MODEL
+
 
+def upstream_tokens(messages, max_tokens=None):
+    """Estimate how many tokens a request takes from the per-minute budget."""
 
-def summarize(messages):
+    return sum(logic.estimate_tokens(m.get("content")) for m in messages) + (max_tokens or 0)
+
+
+async def summarize(messages, session=None, model=None):
     """Return a short summary of the most recent conversation history."""
 
     recent = messages[-logic.SUMMARY_HISTORY_LIMIT:]
@@ -74,14 +249,22 @@ def summarize(messages):
         {"role": "system", "content": logic.SUMMARY_SYSTEM_PROMPT},
         {"role": "user", "content": f"Summarize the following conversation:\n{convo}"},
     ]
-    completion = client.chat.completions.create(
-        messages=summary_messages,
-        model=MODEL,
-        temperature=0.7,
-        top_p=1,
-        max_tokens=logic.SUMMARY_MAX_TOKENS,
-    )
-    return completion.choices[0].message.content
+    model = model or MODEL
+    with SUMMARY_SECONDS.time(model=model):
+        return await upstream.run(
+            lambda client: logic.cached_completion_async(
+                client,
+                summary_messages,
+                model,
+                temperature=0.7,
+                top_p=1,
+                max_tokens=logic.SUMMARY_MAX_TOKENS,
+            ),
+            session,
+            scheduler.INTERACTIVE,
+            upstream_tokens(summary_messages, logic.SUMMARY_MAX_TOKENS),
+            completion_cache.completion_key(model, summary_messages, 0.7, 1, logic.SUMMARY_MAX_TOKENS),
+        )
 
 
 def search_messages(messages, term):
@@ -99,126 +282,42 @@ def list_chats():
     """Return a mapping of chat directories to available chat files."""
 
     data = {}
-    if not os.path.exists(logic.CHAT_HISTORY_DIR):
-        return data
-    for d in os.listdir(logic.CHAT_HISTORY_DIR):
-        path = os.path.join(logic.CHAT_HISTORY_DIR, d)
-        if os.path.isdir(path):
-            chats = []
-            if d == 'archive':
-                for root, _, files in os.walk(path):
-                    for fname in files:
-                        if not fname.endswith('.chat'):
-                            continue
-                        fpath = os.path.join(root, fname)
-                        rel = os.path.relpath(fpath, logic.CHAT_HISTORY_DIR)
-                        try:
-                            with open(fpath, 'r') as f:
-                                j = json.load(f)
-                            name = j.get('name', os.path.splitext(fname)[0]) if isinstance(j, dict) else os.path.splitext(fname)[0]
-                        except Exception:
-                            name = os.path.splitext(fname)[0]
-                        chats.append({'file': rel, 'name': name})
-            else:
-                for fname in os.listdir(path):
-                    if not fname.endswith('.chat'):
-                        continue
-                    fpath = os.path.join(path, fname)
-                    try:
-                        with open(fpath, 'r') as f:
-                            j = json.load(f)
-                        name = j.get('name', os.path.splitext(fname)[0]) if isinstance(j, dict) else os.path.splitext(fname)[0]
-                    except Exception:
-                        name = os.path.splitext(fname)[0]
-                    chats.append({'file': os.path.join(d, fname), 'name': name})
-            data[d] = chats
+    with LIST_CHATS_SECONDS.time():
+        # Names come from the storage index so no chat has to be opened
+        store = logic.get_storage()
+        for d in store.dirs():
+            data[d] = [{'file': e['file'], 'name': e['name']} for e in store.entries(d)]
     return data
 
 
-def archive_file(relpath: str) -> bool:
-    """Move a chat file to the archive and record its original location."""
-    src = os.path.join(logic.CHAT_HISTORY_DIR, relpath)
-    if not os.path.exists(src) or relpath.startswith("archive/"):
-        return False
-    try:
-        with open(src, "r") as f:
-            data = json.load(f)
-        data["archived_from"] = relpath
-        with open(src, "w") as f:
-            json.dump(data, f, indent=2)
-        subdir = os.path.dirname(relpath)
-        dest_dir = os.path.join(logic.ARCHIVE_DIR, subdir)
-        os.makedirs(dest_dir, exist_ok=True)
-        dest = os.path.join(dest_dir, os.path.basename(relpath))
-        if os.path.exists(dest):
-            base, ext = os.path.splitext(os.path.basename(relpath))
-            ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-            dest = os.path.join(dest_dir, f"{base}-{ts}{ext}")
-        shutil.move(src, dest)
-        return True
-    except Exception:
-        return False
-
-
-def restore_file(relpath: str) -> bool:
-    """Restore a chat from the archive to its original location."""
-    subpath = relpath[len("archive/"):] if relpath.startswith("archive/") else relpath
-    src = os.path.join(logic.ARCHIVE_DIR, subpath)
-    if not os.path.exists(src):
-        return False
-    try:
-        with open(src, "r") as f:
-            data = json.load(f)
-        dest_rel = data.get("archived_from", os.path.join("userchat", os.path.basename(relpath)))
-        dest = os.path.join(logic.CHAT_HISTORY_DIR, dest_rel)
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
-        data.pop("archived_from", None)
-        with open(src, "w") as f:
-            json.dump(data, f, indent=2)
-        shutil.move(src, dest)
-        return True
-    except Exception:
-        return False
-
-
-def delete_file(relpath: str) -> bool:
-    """Delete a chat file from the archive."""
-    subpath = relpath[len("archive/"):] if relpath.startswith("archive/") else relpath
-    path = os.path.join(logic.ARCHIVE_DIR, subpath)
-    if not os.path.exists(path):
-        return False
-    try:
-        os.remove(path)
-        return True
-    except Exception:
-        return False
+async def handle_command(user_input, chat_data, messages, active_filename, fresh=False):
+    """Process a slash command from the UI and return a response dict along with updated state.
 
+    ``fresh`` bypasses the completion cache for commands that call the model.
+    """
 
-def clear_archive() -> bool:
-    """Remove all chat files from the archive directory."""
-    success = True
-    if not os.path.exists(logic.ARCHIVE_DIR):
-        return True
-    for root, _, files in os.walk(logic.ARCHIVE_DIR):
-        for fname in files:
-            if not fname.endswith('.chat'):
-                continue
-            path = os.path.join(root, fname)
-            try:
-                os.remove(path)
-            except Exception:
-                success = False
-    return success
+    cmd = user_input.split()[0] if user_input.split() else user_input
+    command = cmd if cmd in COMMAND_NAMES else "unknown"
+    outcome = "error"
+    with COMMAND_SECONDS.time(command=command):
+        try:
+            result = await run_command(user_input, chat_data, messages, active_filename, fresh)
+            outcome = "error" if "error" in result[0] else "ok"
+            return result
+        finally:
+            COMMANDS.inc(command=command, outcome=outcome)
 
 
-def handle_command(user_input, chat_data, messages, active_filename):
-    """Process a slash command from the UI and return a response dict along with updated state."""
+async def run_command(user_input, chat_data, messages, active_filename, fresh=False):
+    """Run the slash command in ``user_input``; see :func:`handle_command`."""
 
-    global MODEL
     parts = user_input.split()
     cmd = parts[0]
     if cmd == '/new':
+        model = chat_model(chat_data)
         chat_data, active_filename = logic.get_new_session_state()
+        # The new chat keeps the model this session picked
+        chat_data['model'] = model
         messages = chat_data['messages']
         return {
             "system": (
@@ -286,15 +385,20 @@ def handle_command(user_input, chat_data, messages, active_filename):
                 return {"error": f"Prompt {name} not found"}, chat_data, active_filename
             messages.append({"role": "user", "content": text})
             logic.save_chat_to_file(active_filename, chat_data)
-            completion = client.chat.completions.create(
-                messages=messages[-logic.HISTORY_LIMIT:],
-                model=MODEL,
-                temperature=0.7,
-                top_p=1,
+            context = build_context(chat_data, active_filename)
+            model = chat_model(chat_data)
+            assistant_response = await upstream.run(
+                lambda client: logic.cached_completion_async(
+                    client, context, model, temperature=0.7, top_p=1, fresh=fresh
+                ),
+                active_filename,
+                scheduler.INTERACTIVE,
+                upstream_tokens(context),
+                completion_cache.completion_key(model, context, 0.7, 1, None),
             )
-            assistant_response = completion.choices[0].message.content
             messages.append({"role": "assistant", "content": assistant_response})
             logic.save_chat_to_file(active_filename, chat_data)
+            schedule_memory_update(chat_data, active_filename)
             return {"assistant": assistant_response}, chat_data, active_filename
         elif action in ('sys', 'system'):
             if len(parts) < 3:
@@ -309,15 +413,18 @@ def handle_command(user_input, chat_data, messages, active_filename):
         else:
             return {"error": "Unknown prompt command"}, chat_data, active_filename
     elif cmd == '/summary':
-        s = summarize(messages)
+        s = await summarize(messages, active_filename, chat_model(chat_data))
         chat_data['summary'] = s
         logic.save_chat_to_file(active_filename, chat_data)
         return {"summary": s}, chat_data, active_filename
     elif cmd == '/search':
-        if len(parts) < 2:
-            return {"error": "Usage: /search <term>"}, chat_data, active_filename
-        term = " ".join(parts[1:])
-        return {"results": search_messages(messages, term)}, chat_data, active_filename
+        all_chats, dirs, term = logic.parse_search_args(parts[1:])
+        if not term:
+            return {"error": "Usage: /search [--all] [--dir <name>] <term>"}, chat_data, active_filename
+        if all_chats:
+            hits = logic.search_all_chats(term, dirs=dirs or None)
+            return {"results": [logic.format_search_hit(h) for h in hits]}, chat_data, active_filename
+        return {"results": search_messages(logic.chat_messages(chat_data), term)}, chat_data, active_filename
     elif cmd == '/export':
         name = parts[1] if len(parts) > 1 else ''
         path = logic.export_chat(chat_data, name)
@@ -329,74 +436,434 @@ def handle_command(user_input, chat_data, messages, active_filename):
             update_path = os.path.join(script_dir, 'update.py')
             subprocess.run([sys.executable, update_path], cwd=script_dir)
             server_path = os.path.join(script_dir, 'server.py')
+            logic.flush_saves()
             os.execl(sys.executable, sys.executable, server_path)
 
         threading.Thread(target=do_update, daemon=True).start()
         return {"system": "Updating server..."}, chat_data, active_filename
     elif cmd == '/model':
         if len(parts) == 1:
-            return {"system": f"Current model: {MODEL}"}, chat_data, active_filename
+            return {"system": f"Current model: {chat_model(chat_data)}"}, chat_data, active_filename
         if parts[1] == 'select':
             return {"models": logic.AVAILABLE_MODELS}, chat_data, active_filename
-        MODEL = parts[1]
-        chat_data['model'] = MODEL
-        return {"system": f"Model set to {MODEL}"}, chat_data, active_filename
+        chat_data['model'] = parts[1]
+        return {"system": f"Model set to {parts[1]}"}, chat_data, active_filename
+    elif cmd == '/compare':
+        args = user_input.split(None, 2)[1:]
+        if not args:
+            return {"error": "Usage: /compare model1,model2 <message> or /compare pick <number|model>"}, chat_data, active_filename
+        if args[0] == 'pick':
+            return pick_comparison(chat_data, active_filename, args[1] if len(args) > 1 else ''), chat_data, active_filename
+        models, text = logic.parse_compare_args(args)
+        return await run_comparison(chat_data, active_filename, models, text), chat_data, active_filename
     elif cmd == '/info':
-        path = os.path.join(logic.CHAT_HISTORY_DIR, active_filename)
-        mtime = "unknown"
-        try:
-            mtime = os.path.getmtime(path)
-        except Exception:
-            pass
+        entry = logic.get_storage().get(active_filename)
+        mtime = entry["mtime"] if entry else "unknown"
         return {
             "file": active_filename,
             "model": chat_data['model'],
             "messages": len(messages)-1,
             "mtime": mtime,
+            "context": context_reports.get(active_filename),
+            "cache": logic.completions.stats(),
+            "sessions": sessions.stats(),
+            "upstream": upstream.stats(),
+            "archive": logic.get_archive().stats(),
+            **logic.save_status(),
         }, chat_data, active_filename
     else:
         return {"error": f"Unknown command {cmd}"}, chat_data, active_filename
 
 
-def process_message(text, chat_data, messages, active_filename):
-    """Handle a user message or command and return the response along with updated state."""
+async def process_message(text, chat_data, messages, active_filename, fresh=False):
+    """Handle a user message or command and return the response along with updated state.
+
+    ``fresh`` bypasses the completion cache so the model is always asked.
+    """
 
     if text.startswith('/'):
-        return handle_command(text, chat_data, messages, active_filename)
+        return await handle_command(text, chat_data, messages, active_filename, fresh)
     messages.append({"role": "user", "content": text})
     logic.save_chat_to_file(active_filename, chat_data)
-    context = messages[-logic.HISTORY_LIMIT:]
-    if context[0]['role'] != 'system':
-        context = [messages[0]] + context
-    chat_completion = client.chat.completions.create(
-        messages=context,
-        model=MODEL,
-        temperature=0.7,
-        top_p=1,
-    )
-    assistant_response = chat_completion.choices[0].message.content
+    model = chat_model(chat_data)
+    try:
+        with MESSAGE_SECONDS.time(model=model, mode="plain"):
+            context = build_context(chat_data, active_filename)
+            assistant_response = await upstream.run(
+                lambda client: logic.cached_completion_async(
+                    client, context, model, temperature=0.7, top_p=1, fresh=fresh
+                ),
+                active_filename,
+                scheduler.INTERACTIVE,
+                upstream_tokens(context),
+                completion_cache.completion_key(model, context, 0.7, 1, None),
+            )
+    except Exception:
+        MESSAGE_ERRORS.inc(model=model, mode="plain")
+        raise
     messages.append({"role": "assistant", "content": assistant_response})
     logic.save_chat_to_file(active_filename, chat_data)
-    if len(messages) == 3 and chat_data['name'].startswith('Chat '):
-        new_name = logic.generate_chat_name(client, messages)
-        if new_name:
-            chat_data['name'] = new_name
+    naming = maybe_name_chat(chat_data, messages, active_filename)
+    schedule_memory_update(chat_data, active_filename)
+    return {"assistant": assistant_response, "naming": naming}, chat_data, active_filename
+
+
+async def run_comparison(chat_data, active_filename, models, text):
+    """Ask every model in ``models`` for an answer to ``text`` at the same time.
+
+    The chat is left unchanged until one answer is kept with
+    :func:`pick_comparison`.  Without ``text`` the models answer the last
+    user message of the chat.
+    """
+
+    messages = chat_data['messages']
+    if not models:
+        return {"error": "Name at least one model, e.g. /compare llama3-8b-8192,mixtral-8x7b hello"}
+    if text:
+        request = messages + [{"role": "user", "content": text}]
+    elif messages[-1]['role'] == 'user':
+        request = messages
+    else:
+        return {"error": "Add a message to send to the models"}
+    memory = chat_data.get("memory") if logic.ROLLING_SUMMARY else None
+    start = time.perf_counter()
+    tokens = upstream_tokens(request)
+    results = await logic.compare_models_async(
+        None, request, models, memory,
+        slot=lambda: upstream.slot(active_filename, scheduler.INTERACTIVE, tokens),
+    )
+    comparisons[active_filename] = {"message": text, "results": results}
+    return {"comparison": results, "elapsed": time.perf_counter() - start}
+
+
+def pick_comparison(chat_data, active_filename, choice):
+    """Keep one answer of the last comparison, by number or model name."""
+
+    pending = comparisons.get(active_filename)
+    if not pending:
+        return {"error": "There is no comparison to pick from"}
+    results = pending["results"]
+    if choice.isdigit() and 1 <= int(choice) <= len(results):
+        result = results[int(choice) - 1]
+    else:
+        result = next((r for r in results if r["model"] == choice), None)
+    if result is None or not result["answer"]:
+        return {"error": f"No answer to keep for '{choice}'"}
+    del comparisons[active_filename]
+    messages = chat_data['messages']
+    if pending["message"]:
+        messages.append({"role": "user", "content": pending["message"]})
+    messages.append({"role": "assistant", "content": result["answer"], "model": result["model"]})
+    logic.save_chat_to_file(active_filename, chat_data)
+    naming = maybe_name_chat(chat_data, messages, active_filename)
+    schedule_memory_update(chat_data, active_filename)
+    return {"system": f"Kept the answer from {result['model']}", "naming": naming}
+
+
+def build_context(chat_data, active_filename):
+    """Return the history sent to the model and remember what was left out."""
+
+    memory = chat_data.get('memory') if logic.ROLLING_SUMMARY else None
+    context, report = logic.build_context(chat_data['messages'], chat_model(chat_data), memory)
+    context_reports[active_filename] = report
+    return context
+
+
+def schedule_memory_update(chat_data, active_filename):
+    """Fold messages that left the context window into the running summary.
+
+    Runs as a background task so the answer is returned without waiting.
+    """
+
+    report = context_reports.get(active_filename)
+    if not logic.ROLLING_SUMMARY or not report or active_filename in memory_jobs:
+        return
+    job = logic.memory_update_request(chat_data, report['first_index'], chat_model(chat_data))
+    if job is None:
+        return
+    memory_jobs[active_filename] = asyncio.create_task(
+        run_memory_update(chat_data, active_filename, *job)
+    )
+
+
+async def run_memory_update(chat_data, active_filename, request, upto):
+    """Summarize ``request`` and store it as the chat's memory checkpoint."""
+
+    try:
+        model = chat_model(chat_data)
+        summary = await upstream.run(
+            lambda client: logic.cached_completion_async(
+                client,
+                request,
+                model,
+                temperature=0.3,
+                top_p=1,
+                max_tokens=logic.ROLLING_SUMMARY_MAX_TOKENS,
+            ),
+            active_filename,
+            scheduler.BACKGROUND,
+            upstream_tokens(request, logic.ROLLING_SUMMARY_MAX_TOKENS),
+            completion_cache.completion_key(model, request, 0.3, 1, logic.ROLLING_SUMMARY_MAX_TOKENS),
+        )
+        if logic.apply_memory(chat_data, upto, summary):
             logic.save_chat_to_file(active_filename, chat_data)
-    return {"assistant": assistant_response}, chat_data, active_filename
+    except Exception as e:
+        print(f"[Error] Could not update running summary for {active_filename}: {e}", file=sys.stderr)
+    finally:
+        memory_jobs.pop(active_filename, None)
 
 
-def get_chat_state(chat_data, active_filename):
-    """Return chat data with the active filename."""
-    data = dict(chat_data)
-    data["file"] = active_filename
-    return data
+def maybe_name_chat(chat_data, messages, active_filename):
+    """Queue a chat for naming after its first exchange.
+
+    Returns True if a name is on its way; it is saved with the chat and
+    reaches the UI with the next chat update.
+    """
+
+    if len(messages) != 3 or not chat_data['name'].startswith('Chat '):
+        return False
+    if active_filename not in naming_pending:
+        naming_pending.add(active_filename)
+        naming_queue.put_nowait((chat_data, active_filename))
+    return True
+
+
+async def name_chats():
+    """Background task naming queued chats, several per request."""
+
+    while True:
+        batch = [await naming_queue.get()]
+        deadline = time.monotonic() + NAME_BATCH_WAIT
+        while len(batch) < NAME_BATCH_SIZE:
+            try:
+                batch.append(await asyncio.wait_for(naming_queue.get(), deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+        conversations = [chat_data['messages'][:3] for chat_data, _ in batch]
+        try:
+            names = await upstream.run(
+                lambda client: logic.generate_chat_names_async(client, conversations),
+                None,
+                scheduler.BACKGROUND,
+                upstream_tokens([m for c in conversations for m in c]),
+            )
+        except Exception as e:
+            print(f"[Error] Could not generate chat names: {e}", file=sys.stderr)
+            names = [None] * len(batch)
+        for (chat_data, active_filename), name in zip(batch, names):
+            naming_pending.discard(active_filename)
+            # Keep names the user set while the request was running
+            if name and chat_data['name'].startswith('Chat '):
+                chat_data['name'] = name
+                try:
+                    logic.save_chat_to_file(active_filename, chat_data)
+                except Exception as e:
+                    print(f"[Error] Could not save the name of {active_filename}: {e}", file=sys.stderr)
+
+
+def idempotency_key(request: Request, data: dict):
+    """Return the request's ``Idempotency-Key`` header or ``idempotency_key`` field."""
+
+    key = request.headers.get('idempotency-key') or data.get('idempotency_key')
+    return str(key)[:200] if key else None
+
+
+def idempotent_request(sess, key):
+    """Return ``(future, first)`` for the answer to the request ``key``.
+
+    ``first`` is False when the session has seen the key before; the
+    future then holds, or will hold, the original answer.  Failed requests
+    are forgotten so the client can try again.
+    """
+
+    seen = sess.setdefault("requests", OrderedDict())
+    future = seen.get(key)
+    if future is not None:
+        seen.move_to_end(key)
+        return future, False
+    future = seen[key] = asyncio.get_running_loop().create_future()
+    while len(seen) > IDEMPOTENCY_KEYS:
+        seen.popitem(last=False)
+
+    def forget(f):
+        if f.exception() is not None and seen.get(key) is f:
+            del seen[key]
+
+    future.add_done_callback(forget)
+    return future, True
+
+
+async def answer_once(sess, key, answer):
+    """Return ``await answer()``, or the original answer if ``key`` was seen."""
+
+    if key is None:
+        return await answer()
+    future, first = idempotent_request(sess, key)
+    if not first:
+        return await asyncio.shield(future)
+    try:
+        res = await answer()
+    except BaseException as e:
+        future.set_exception(e if isinstance(e, Exception) else RuntimeError("The request did not finish"))
+        raise
+    future.set_result(res)
+    return res
+
+
+async def replay_answer(future, sess, since):
+    """Yield the ``done`` event of a streamed request that was sent before."""
+
+    try:
+        res = await asyncio.shield(future)
+    except Exception as e:
+        yield sse_event("error", {"error": str(e)})
+        return
+    yield sse_event("done", {"result": res, "chat": session_store.chat_state(sess, since)})
+
+
+def sse_event(event, data):
+    """Format a Server-Sent Events frame carrying JSON ``data``."""
+
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_message(text, sid, sess, fresh=False, since=None, answered=None):
+    """Yield SSE frames for a chat turn while the model streams its answer.
+
+    The chat is saved once the stream finishes or the client disconnects, so
+    an aborted answer is kept with whatever text arrived before the abort.
+    The session is kept from eviction while the answer streams in.  The
+    final ``done`` event carries the chat changes after revision ``since``.
+    The result, or what was kept of it, is also set on the ``answered``
+    future so a retry of the request can be given the same answer.
+    """
+
+    chat_data = sess["chat_data"]
+    model = chat_model(chat_data)
+    active_filename = sess["active"]
+    messages = chat_data["messages"]
+    start = time.perf_counter()
+    ttft = None
+    parts = []
+    finished = False
+    sess["busy"] += 1
+    STREAMS_IN_FLIGHT.inc()
+    try:
+        messages.append({"role": "user", "content": text})
+        logic.save_chat_to_file(active_filename, chat_data)
+        context = build_context(chat_data, active_filename)
+        tokens = upstream.stream(
+            lambda client: logic.stream_completion_async(client, context, model, fresh=fresh),
+            active_filename,
+            scheduler.INTERACTIVE,
+            upstream_tokens(context),
+        )
+        async with aclosing(tokens):
+            async for token in tokens:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                    yield sse_event("start", {"ttft": ttft})
+                parts.append(token)
+                yield sse_event("token", {"token": token})
+        finished = True
+    except Exception as e:
+        MESSAGE_ERRORS.inc(model=model, mode="stream")
+        yield sse_event("error", {"error": str(e)})
+    finally:
+        MESSAGE_SECONDS.observe(time.perf_counter() - start, model=model, mode="stream")
+        STREAMS_IN_FLIGHT.dec()
+        assistant_response = "".join(parts)
+        try:
+            if assistant_response:
+                messages.append({"role": "assistant", "content": assistant_response})
+                logic.save_chat_to_file(active_filename, chat_data)
+            elif messages and messages[-1]["role"] == "user":
+                # Nothing came back, drop the user message so retries do not duplicate it
+                messages.pop()
+                logic.save_chat_to_file(active_filename, chat_data)
+        except Exception as e:
+            print(f"[Error] Could not save {active_filename}: {e}", file=sys.stderr)
+        sess["busy"] -= 1
+        sessions.update(sid)
+        if answered is not None and not finished:
+            # Cut short: a retry gets the part that was kept, not a second turn
+            if assistant_response:
+                answered.set_result({
+                    "assistant": assistant_response,
+                    "naming": False,
+                    "ttft": ttft,
+                    "elapsed": time.perf_counter() - start,
+                })
+            else:
+                answered.set_exception(RuntimeError("The message was not answered"))
+    naming = False
+    if finished:
+        naming = maybe_name_chat(chat_data, messages, active_filename)
+        schedule_memory_update(chat_data, active_filename)
+    result = {
+        "assistant": assistant_response,
+        "naming": naming,
+        "ttft": ttft,
+        "elapsed": time.perf_counter() - start,
+    }
+    if answered is not None and finished:
+        # A stream cut short completed the future above
+        answered.set_result(result)
+    yield sse_event("done", {"result": result, "chat": session_store.chat_state(sess, since)})
+
+
+def parse_since(value):
+    """Return the client's last seen chat revision, or ``None`` for a full state."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
 @app.get('/api/chat')
 async def get_chat(request: Request, response: Response):
-    """Return the current chat including pending messages."""
-    _, sess = get_session(request, response)
-    return get_chat_state(sess["chat_data"], sess["active"])
+    """Return the current chat including pending messages.
+
+    With ``since=<rev>`` only the messages and fields changed after that
+    revision are returned.  The revision is sent as the ETag, so a client
+    repeating it in ``If-None-Match`` gets a 304 when nothing changed.
+    """
+    _, sess = get_session(request, response, create=False)
+    state = session_store.chat_state(sess, parse_since(request.query_params.get('since')))
+    etag = f'"{state["rev"]}"'
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return state
+
+
+@app.get('/api/chat/messages')
+async def get_chat_messages(request: Request, response: Response):
+    """Return a page of the current chat's messages.
+
+    Query parameters: ``offset`` of the first message and ``limit`` (at most
+    ``MESSAGE_PAGE_LIMIT``).  Messages of a long chat that are not held in
+    memory are read from its file, so the client can page back through it.
+    """
+    _, sess = get_session(request, response, create=False)
+    try:
+        offset = max(int(request.query_params.get('offset', 0)), 0)
+        limit = min(max(int(request.query_params.get('limit', 100)), 1), MESSAGE_PAGE_LIMIT)
+    except ValueError:
+        offset, limit = 0, 100
+    chat_data = sess["chat_data"]
+    return {
+        "offset": offset,
+        "length": len(chat_data["messages"]),
+        "messages": logic.chat_messages(chat_data, offset, offset + limit),
+    }
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """Serve timings and counters in the Prometheus text format."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get('/api/chats')
@@ -405,51 +872,71 @@ async def get_chats():
     return list_chats()
 
 
+@app.get('/api/search')
+async def api_search(request: Request):
+    """Search messages across every saved chat.
+
+    Query parameters: ``q`` (words must all match, "double quotes" match a
+    phrase), repeated ``dir`` to filter by history folder, and ``limit``.
+    """
+    q = request.query_params.get('q', '')
+    dirs = request.query_params.getlist('dir') or None
+    try:
+        limit = int(request.query_params.get('limit', 50))
+    except ValueError:
+        limit = 50
+    return {"results": logic.search_all_chats(q, dirs=dirs, limit=limit)}
+
+
 @app.post('/api/load')
 async def api_load(data: dict, request: Request, response: Response):
-    """Load a chat file and return the updated state."""
-    _, sess = get_session(request, response)
+    """Load a chat file and return the updated state.
+
+    Like every chat-changing route, a ``since`` revision in the body limits
+    the returned chat to what changed after it.
+    """
+    sid, sess = get_session(request, response)
     chat_data = sess["chat_data"]
     active_filename = sess["active"]
     messages = chat_data["messages"]
-    res, chat_data, active_filename = handle_command(f"/load {data.get('filename','')}", chat_data, messages, active_filename)
+    res, chat_data, active_filename = await handle_command(f"/load {data.get('filename','')}", chat_data, messages, active_filename)
     sess["chat_data"] = chat_data
     sess["active"] = active_filename
-    return {"result": res, "chat": get_chat_state(chat_data, active_filename)}
+    sessions.update(sid)
+    return {"result": res, "chat": session_store.chat_state(sess, parse_since(data.get('since')))}
 
 
 @app.post('/api/archive')
 async def api_archive(data: dict):
     """Archive the given chat file."""
-    success = archive_file(data.get('filename', ''))
+    success = logic.get_storage().archive(data.get('filename', ''))
     return {"success": success, "chats": list_chats()}
 
 
 @app.post('/api/restore')
 async def api_restore(data: dict):
     """Restore an archived chat."""
-    success = restore_file(data.get('filename', ''))
+    success = logic.get_storage().restore(data.get('filename', ''))
     return {"success": success, "chats": list_chats()}
 
 
 @app.post('/api/delete')
 async def api_delete(data: dict):
     """Delete an archived chat permanently."""
-    success = delete_file(data.get('filename', ''))
+    success = logic.get_storage().delete(data.get('filename', ''))
     return {"success": success, "chats": list_chats()}
 
 
 @app.post('/api/clear-archive')
 async def api_clear_archive():
     """Delete all chats from the archive."""
-    success = clear_archive()
+    success = logic.get_storage().clear_archive()
     return {"success": success, "chats": list_chats()}
 
 
 @app.post('/api/api-key')
 async def api_set_api_key(data: dict):
     """Update the stored GROQ_API_KEY value."""
-    global client
     key = data.get('api_key', '').strip()
     if not key:
         return {"success": False}
@@ -459,7 +946,7 @@ async def api_set_api_key(data: dict):
         return {"success": False}
     os.environ['GROQ_API_KEY'] = key
     logic.API_KEY = key
-    client = logic.setup_client()
+    upstream.set_keys(logic.api_keys(), make_client)
     return {"success": True}
 
 
@@ -472,6 +959,7 @@ async def api_update(background_tasks: BackgroundTasks):
         update_path = os.path.join(script_dir, 'update.py')
         subprocess.run([sys.executable, update_path], cwd=script_dir)
         server_path = os.path.join(script_dir, 'server.py')
+        logic.flush_saves()
         os.execl(sys.executable, sys.executable, server_path)
 
     background_tasks.add_task(do_update)
@@ -480,15 +968,91 @@ async def api_update(background_tasks: BackgroundTasks):
 
 @app.post('/api/message')
 async def api_message(data: dict, request: Request, response: Response):
-    """Process a chat message or command."""
-    _, sess = get_session(request, response)
-    chat_data = sess["chat_data"]
-    active_filename = sess["active"]
-    messages = chat_data["messages"]
-    res, chat_data, active_filename = process_message(data.get('message',''), chat_data, messages, active_filename)
-    sess["chat_data"] = chat_data
-    sess["active"] = active_filename
-    return {"result": res, "chat": get_chat_state(chat_data, active_filename)}
+    """Process a chat message or command, returning changes after ``since``.
+
+    A request repeating the ``Idempotency-Key`` of an earlier one gets that
+    request's answer instead of being processed again.
+    """
+    sid, sess = get_session(request, response)
+
+    async def answer():
+        res, chat_data, active_filename = await process_message(
+            data.get('message', ''), sess["chat_data"], sess["chat_data"]["messages"],
+            sess["active"], bool(data.get('fresh'))
+        )
+        sess["chat_data"] = chat_data
+        sess["active"] = active_filename
+        sessions.update(sid)
+        return res
+
+    res = await answer_once(sess, idempotency_key(request, data), answer)
+    return {"result": res, "chat": session_store.chat_state(sess, parse_since(data.get('since')))}
+
+
+@app.post('/api/compare')
+async def api_compare(data: dict, request: Request, response: Response):
+    """Send one message to several models concurrently and report each answer.
+
+    Body: ``models`` (a list or comma separated string), ``message`` and an
+    optional ``since`` revision.  The chat is not changed until an answer is
+    kept through ``/api/compare/pick``.
+    """
+    sid, sess = get_session(request, response)
+    models = data.get('models') or []
+    if isinstance(models, str):
+        models = logic.parse_compare_args([models])[0]
+    res = await run_comparison(sess["chat_data"], sess["active"], models, data.get('message', '').strip())
+    return {"result": res, "chat": session_store.chat_state(sess, parse_since(data.get('since')))}
+
+
+@app.post('/api/compare/pick')
+async def api_compare_pick(data: dict, request: Request, response: Response):
+    """Keep the answer ``choice`` (number or model) of the last comparison."""
+    sid, sess = get_session(request, response)
+    res = pick_comparison(sess["chat_data"], sess["active"], str(data.get('choice', '')))
+    sessions.update(sid)
+    return {"result": res, "chat": session_store.chat_state(sess, parse_since(data.get('since')))}
+
+
+@app.post('/api/message/stream')
+async def api_message_stream(data: dict, request: Request, response: Response):
+    """Stream the assistant answer as Server-Sent Events.
+
+    Commands are not streamed; they are processed normally and returned as a
+    single ``done`` event so the client can use one code path for every input.
+    A repeated ``Idempotency-Key`` gets the earlier answer as a ``done`` event.
+    """
+    sid, sess = get_session(request, response)
+    text = data.get('message', '')
+    fresh = bool(data.get('fresh'))
+    since = parse_since(data.get('since'))
+    key = idempotency_key(request, data)
+    if text.startswith('/'):
+        async def answer():
+            res, chat_data, active_filename = await process_message(
+                text, sess["chat_data"], sess["chat_data"]["messages"], sess["active"], fresh
+            )
+            sess["chat_data"] = chat_data
+            sess["active"] = active_filename
+            sessions.update(sid)
+            return res
+
+        res = await answer_once(sess, key, answer)
+        frames = [sse_event("done", {"result": res, "chat": session_store.chat_state(sess, since)})]
+    else:
+        answered, first = idempotent_request(sess, key) if key else (None, True)
+        if first:
+            frames = stream_message(text, sid, sess, fresh, since, answered)
+        else:
+            frames = replay_answer(answered, sess, since)
+    stream = StreamingResponse(
+        frames,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Keep the session cookie that get_session may have just issued
+    stream.raw_headers.extend(h for h in response.raw_headers if h[0] == b"set-cookie")
+    return stream
 
 
 @app.get('/manifest.json')
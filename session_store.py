@@ -0,0 +1,245 @@
+"""Bounded store of web sessions with idle expiry and size based eviction."""
+
+import copy
+import itertools
+import time
+from collections import OrderedDict
+
+# Revisions are unique across sessions and restarts of the server, so a
+# revision held by a client can never match a different state of the chat
+_revisions = itertools.count(int(time.time() * 1000))
+_MISSING = object()
+# What publish() remembers for every message not loaded into memory
+_UNLOADED = ("unloaded", "")
+
+
+def chat_bytes(chat_data):
+    """Return the UTF-8 size of the message text held by ``chat_data``."""
+    total = 0
+    for m in chat_data.get("messages", []):
+        total += len((m.get("content") or "").encode("utf-8"))
+    total += len((chat_data.get("memory") or {}).get("summary", "").encode("utf-8"))
+    return total
+
+
+def window_start(chat_data):
+    """Return the first loaded message after the system prompt, or 0 when all are.
+
+    Long chats are loaded with only their recent messages; the ones before
+    the window are placeholders that the client pages in on demand.
+    """
+    window = chat_data.get("window")
+    messages = chat_data.get("messages", [])
+    if not window or not 1 < window["first"] <= len(messages):
+        return 0
+    # Cutting the chat below the window and growing it again ends the window
+    if messages[window["first"] - 1].get("role") != "unloaded":
+        return 0
+    return window["first"]
+
+
+class SessionStore:
+    """LRU of session dicts keyed by session id.
+
+    Sessions idle for longer than ``ttl`` seconds are dropped, and the least
+    recently used ones are evicted while there are more than ``max_sessions``
+    or their messages take more than ``max_bytes``.  ``on_evict(session)`` is
+    called before a session is dropped so its chat can be saved.  Sessions
+    marked busy (a reply is streaming into them) are never evicted.
+
+    The chat file of an evicted session is remembered so a returning client
+    with the same cookie picks up where it left off.
+    """
+
+    def __init__(self, max_sessions=1000, max_bytes=64 * 1024 * 1024, ttl=3600, on_evict=None):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        # Chat file of recently evicted sessions, bounded like the sessions
+        self._evicted = OrderedDict()
+        self._stats = {"created": 0, "resumed": 0, "expired": 0, "evicted_lru": 0, "evicted_bytes": 0}
+
+    def __contains__(self, sid):
+        return sid in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, sid):
+        """Return the live session for ``sid`` or ``None``, marking it used."""
+        self.expire()
+        sess = self._sessions.get(sid) if sid else None
+        if sess is not None:
+            sess["touched"] = time.monotonic()
+            self._sessions.move_to_end(sid)
+        return sess
+
+    def evicted_file(self, sid):
+        """Return the chat file of an evicted session ``sid``, forgetting it."""
+        return self._evicted.pop(sid, None) if sid else None
+
+    def add(self, sid, chat_data, active, resumed=False):
+        """Store a new session and return it."""
+        sess = {"chat_data": chat_data, "active": active, "touched": time.monotonic(),
+                "bytes": 0, "busy": 0}
+        self._sessions[sid] = sess
+        self._stats["resumed" if resumed else "created"] += 1
+        self.update(sid)
+        return sess
+
+    def update(self, sid):
+        """Re-measure the messages of ``sid`` after its chat changed."""
+        sess = self._sessions.get(sid)
+        if sess is None:
+            return
+        size = chat_bytes(sess["chat_data"])
+        self._bytes += size - sess["bytes"]
+        sess["bytes"] = size
+        self._enforce_limits()
+
+    def expire(self):
+        """Drop sessions that have been idle for longer than the TTL."""
+        deadline = time.monotonic() - self.ttl
+        # Ordered by last use, so expired sessions are at the front
+        for sid in list(self._sessions):
+            sess = self._sessions[sid]
+            if sess["touched"] > deadline:
+                break
+            if not sess["busy"]:
+                self._drop(sid, "expired")
+
+    def _enforce_limits(self):
+        for sid in list(self._sessions):
+            over_count = len(self._sessions) > self.max_sessions
+            over_bytes = self._bytes > self.max_bytes
+            if not over_count and not over_bytes:
+                break
+            if not self._sessions[sid]["busy"]:
+                self._drop(sid, "evicted_lru" if over_count else "evicted_bytes")
+
+    def _drop(self, sid, reason):
+        sess = self._sessions.pop(sid)
+        self._bytes -= sess["bytes"]
+        self._stats[reason] += 1
+        if self.on_evict:
+            self.on_evict(sess)
+        self._evicted[sid] = sess["active"]
+        while len(self._evicted) > self.max_sessions:
+            self._evicted.popitem(last=False)
+
+    def stats(self):
+        """Return the number and size of live sessions and eviction counters."""
+        stats = dict(self._stats)
+        stats["sessions"] = len(self._sessions)
+        stats["bytes"] = self._bytes
+        return stats
+
+
+def publish(sess):
+    """Record what changed in the session's chat and return its revision.
+
+    The chat is compared with the state seen on the previous call; every
+    changed or appended message and every changed top-level field gets a new
+    revision.  Each scanned message's ``(role, content)`` is compared by
+    equality with the one seen before.  That is quick while a message keeps
+    the same content string, since equal objects are matched by identity
+    first, but a content string that was replaced is compared character by
+    character.  Messages before the window of a long chat are not scanned
+    again.
+    """
+    view = sess.get("view")
+    if view is None:
+        rev = next(_revisions)
+        view = sess["view"] = {
+            "base": rev, "rev": rev, "messages": [], "message_revs": [], "meta": {}, "meta_revs": {},
+        }
+    rev = None
+
+    def bump():
+        nonlocal rev
+        if rev is None:
+            rev = next(_revisions)
+        return rev
+
+    chat_data = sess["chat_data"]
+    messages = chat_data.get("messages", [])
+    seen = view["messages"]
+    revs = view["message_revs"]
+    indices = range(len(messages))
+    first = window_start(chat_data)
+    if first and len(seen) >= first:
+        indices = itertools.chain(range(1), range(first, len(messages)))
+    for i in indices:
+        m = messages[i]
+        item = (m.get("role"), m.get("content"))
+        if item == _UNLOADED:
+            item = _UNLOADED
+        if i < len(seen):
+            if seen[i] == item:
+                continue
+            seen[i] = item
+            revs[i] = bump()
+        else:
+            seen.append(item)
+            revs.append(bump())
+    if len(seen) > len(messages):
+        del seen[len(messages):]
+        del revs[len(messages):]
+        bump()
+
+    meta = {k: v for k, v in chat_data.items() if k not in ("messages", "window")}
+    meta["file"] = sess["active"]
+    for key in set(view["meta"]) | set(meta):
+        value = meta.get(key, _MISSING)
+        if view["meta"].get(key, _MISSING) == value:
+            continue
+        if value is _MISSING:
+            del view["meta"][key]
+        else:
+            view["meta"][key] = copy.deepcopy(value)
+        view["meta_revs"][key] = bump()
+
+    if rev is not None:
+        view["rev"] = rev
+    return view["rev"]
+
+
+def chat_state(sess, since=None):
+    """Return the session's chat, or only what changed after revision ``since``.
+
+    The full state is the chat dict with ``file`` and ``rev`` added.  For a
+    long chat loaded only in part, its ``messages`` are the system prompt
+    followed by the messages from index ``first`` on, and ``length`` is the
+    full message count.  A delta
+    has ``rev``, the message count as ``length``, ``changes`` as a list of
+    ``[index, message]`` pairs and the changed top-level fields in ``meta``
+    (``None`` for removed ones).  The full state is returned when ``since``
+    is unknown to this session.
+    """
+    rev = publish(sess)
+    view = sess["view"]
+    chat_data = sess["chat_data"]
+    if since is None or since < view["base"] or since > rev:
+        data = dict(chat_data)
+        data.pop("window", None)
+        first = window_start(chat_data)
+        if first:
+            data["messages"] = chat_data["messages"][:1] + chat_data["messages"][first:]
+            data["first"] = first
+            data["length"] = len(chat_data["messages"])
+        data["file"] = sess["active"]
+        data["rev"] = rev
+        return data
+    messages = chat_data["messages"]
+    return {
+        "rev": rev,
+        "length": len(messages),
+        "changes": [
+            [i, messages[i]] for i, r in enumerate(view["message_revs"])
+            if r > since and view["messages"][i] is not _UNLOADED
+        ],
+        "meta": {k: view["meta"].get(k) for k, r in view["meta_revs"].items() if r > since},
+    }
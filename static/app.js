@@ -2,6 +2,25 @@ let chatData={};
 // Front-end logic for the GroqChat web UI
 
 let currentTab='';
+// Last chat state received from the server; later responses only carry
+// the changes made after chatState.rev
+let chatState=null;
+// Only the messages near the visible part of the chat are in the DOM:
+// bubbles by message index for the rendered window, measured bubble heights
+// by message index, and spacers standing in for the messages above and below
+let messageEls=new Map();
+let messageHeights=[];
+let topSpacer=null,bottomSpacer=null;
+// Extra pixels rendered above and below the viewport
+const RENDER_MARGIN=800;
+// Space between bubbles, must match the .message margin in index.html
+const MESSAGE_GAP=8;
+let renderQueued=false;
+// Long chats arrive with only their recent messages; older ones are fetched
+// in pages of this many messages when they scroll into view
+const PAGE_SIZE=100;
+const PLACEHOLDER_HEIGHT=60;
+let pagesLoading=new Set();
 
 // Show or hide the sidebar on small screens
 function toggleSidebar(){
@@ -19,10 +38,13 @@ function hideSidebarOnMobile(){
   }
 }
 
-// Keep the newest messages visible when updating the chat
-function scrollMessagesToEnd(){
+// Keep the newest messages visible when updating the chat; instant skips the
+// smooth scrolling animation, which would render every message on the way
+function scrollMessagesToEnd(instant){
   const msgDiv=document.getElementById('messages');
+  if(instant) msgDiv.style.scrollBehavior='auto';
   msgDiv.scrollTop=msgDiv.scrollHeight;
+  msgDiv.style.scrollBehavior='';
 }
 
 // Very small Markdown renderer for messages
@@ -34,6 +56,12 @@ function md(t){
   return h.replace(/\n/g,'<br>');
 }
 
+// Add the revision the UI has already rendered to a request body
+function withRev(body){
+  if(chatState) body.since=chatState.rev;
+  return body;
+}
+
 // Update the system prompt textarea
 function setSystem(text){
   document.getElementById('sysPrompt').value=text||'';
@@ -103,7 +131,7 @@ function renderFiles(){
 
 // Load an individual chat file
 async function loadChat(name){
-  const res=await fetch('/api/load',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({filename:name})});
+  const res=await fetch('/api/load',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(withRev({filename:name}))});
   const data=await res.json();
   showMessages(data.chat,data.result);
   hideSidebarOnMobile();
@@ -112,7 +140,7 @@ async function loadChat(name){
 // Send the updated system prompt to the server
 async function updateSystem(){
   const text=document.getElementById('sysPrompt').value;
-  const res=await fetch('/api/message',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({message:'/system '+text})});
+  const res=await fetch('/api/message',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(withRev({message:'/system '+text}))});
   const data=await res.json();
   showMessages(data.chat,data.result);
 }
@@ -125,17 +153,82 @@ async function sendMsg(){
   // Show the message immediately while waiting for the server
   const div=document.getElementById('messages');
   const p=document.createElement('div');
-  p.className='message user';
+  p.className='message user transient';
   p.innerHTML=md(text);
   div.appendChild(p);
   scrollMessagesToEnd();
 
-  const res=await fetch('/api/message',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({message:text})});
-  const data=await res.json();
-  showMessages(data.chat,data.result);
+  // Stream the answer token by token into a new assistant bubble
+  const a=document.createElement('div');
+  a.className='message assistant transient';
+  let answer='';
+  let done=null;
+  const showError=text=>{
+    const e=document.createElement('div');
+    e.className='message error transient';
+    e.textContent=text;
+    div.appendChild(e);
+  };
+  // A dropped connection is retried with the same key, so the server answers
+  // the retry with the original turn instead of adding the message twice
+  const key=requestKey();
+  for(let attempt=0;;attempt++){
+    try{
+      await readStream('/api/message/stream',withRev({message:text,idempotency_key:key}),(event,data)=>{
+        if(event==='start'){
+          answer='';
+          a.title=`First token after ${data.ttft.toFixed(2)}s`;
+          div.appendChild(a);
+        }else if(event==='token'){
+          answer+=data.token;
+          a.innerHTML=md(answer);
+          scrollMessagesToEnd();
+        }else if(event==='error'){
+          showError(data.error);
+        }else if(event==='done'){
+          done=data;
+        }
+      });
+      break;
+    }catch(err){
+      if(attempt>=2){showError('Could not reach the server');break;}
+      await new Promise(r=>setTimeout(r,1000*(attempt+1)));
+    }
+  }
+  if(done) showMessages(done.chat,done.result);
   hideSidebarOnMobile();
 }
 
+// Random id sent with a message so a retried request is recognised
+function requestKey(){
+  if(window.crypto&&crypto.randomUUID) return crypto.randomUUID();
+  return Date.now().toString(36)+Math.random().toString(36).slice(2);
+}
+
+// POST JSON and call onEvent for each Server-Sent Event in the response
+async function readStream(url,body,onEvent){
+  const res=await fetch(url,{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(body)});
+  const reader=res.body.getReader();
+  const decoder=new TextDecoder();
+  let buf='';
+  while(true){
+    const {value,done}=await reader.read();
+    if(done) break;
+    buf+=decoder.decode(value,{stream:true});
+    let idx;
+    while((idx=buf.indexOf('\n\n'))>=0){
+      const frame=buf.slice(0,idx);
+      buf=buf.slice(idx+2);
+      let event='message',data='';
+      frame.split('\n').forEach(line=>{
+        if(line.startsWith('event: ')) event=line.slice(7);
+        else if(line.startsWith('data: ')) data+=line.slice(6);
+      });
+      if(data) onEvent(event,JSON.parse(data));
+    }
+  }
+}
+
 // Move a chat into the archive
 async function archiveFile(name){
   await fetch('/api/archive',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({filename:name})});
@@ -180,76 +273,261 @@ async function updateApiKey(){
 
 async function newChat(){
   // Start a new chat session
-  const res=await fetch('/api/message',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify({message:'/new'})});
+  const res=await fetch('/api/message',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(withRev({message:'/new'}))});
   const data=await res.json();
   showMessages(data.chat,data.result);
   hideSidebarOnMobile();
 }
 
-function showMessages(chat,res){
-  // Render the message history and any system responses
-  const msgs=chat.messages;
-  document.getElementById('chatName').textContent=chat.name||'';
-  document.getElementById('chatPath').textContent=chat.file||'';
+// Guess the height of a message that has not been rendered yet
+function estimateHeight(m){
+  const text=m.content||'';
+  const lines=text.split('\n').length+Math.floor(text.length/80);
+  return 16+lines*20;
+}
+
+// Height of message i including the gap; estimates are kept until the
+// message is rendered and measured
+function messageHeight(i){
+  const m=chatState.messages[i];
+  if(!m) return PLACEHOLDER_HEIGHT+MESSAGE_GAP;
+  if(messageHeights[i]===undefined) messageHeights[i]=estimateHeight(m);
+  return messageHeights[i]+MESSAGE_GAP;
+}
+
+// Build the bubble for message i, or a placeholder while its page loads
+function messageElement(i){
+  const m=chatState.messages[i];
+  const p=document.createElement('div');
+  if(!m){
+    p.className='message assistant';
+    p.textContent='…';
+    p.style.minHeight=PLACEHOLDER_HEIGHT+'px';
+    loadPage(i);
+    return p;
+  }
+  p.className='message '+(m.role==='user'?'user':'assistant');
+  p.innerHTML=md(m.content);
+  return p;
+}
+
+// Put the spacers back after the message list was emptied
+function resetMessageList(){
   const div=document.getElementById('messages');
   div.innerHTML='';
-  document.getElementById('summaryText').textContent=chat.summary||'';
-  if(msgs[0]&&msgs[0].role==='system') setSystem(msgs[0].content);
-  msgs.slice(1).forEach(m=>{
-    const p=document.createElement('div');
-    p.className='message '+(m.role==='user'?'user':'assistant');
-    p.innerHTML=md(m.content);
-    div.appendChild(p);
+  messageEls=new Map();
+  messageHeights=[];
+  topSpacer=document.createElement('div');
+  bottomSpacer=document.createElement('div');
+  [topSpacer,bottomSpacer].forEach(sp=>{
+    // Empty flex items would otherwise shrink to nothing
+    sp.style.flexShrink='0';
+    div.appendChild(sp);
   });
-  if(res){
-    if(res.system){
-      const p=document.createElement('div');
-      p.className='message system';
-      p.innerHTML=md(res.system);
-      div.appendChild(p);
-    }
-    if(res.error){
-      const p=document.createElement('div');
-      p.className='message error';
-      p.textContent=res.error;
-      div.appendChild(p);
+}
+
+// Render the messages around the viewport and size the spacers for the rest
+function renderWindow(){
+  if(!chatState) return;
+  const div=document.getElementById('messages');
+  const msgs=chatState.messages;
+  const first=msgs[0]&&msgs[0].role==='system'?1:0;
+  const top=div.scrollTop-RENDER_MARGIN;
+  const bottom=div.scrollTop+div.clientHeight+RENDER_MARGIN;
+  let start=first,end=first,y=0,above=0,below=0;
+  for(let i=first;i<msgs.length;i++){
+    const h=messageHeight(i);
+    if(y+h<top){above+=h;start=i+1;}
+    else if(y<=bottom) end=i+1;
+    else below+=h;
+    y+=h;
+  }
+  if(end<start) end=start;
+  for(const [i,p] of messageEls){
+    if(i<start||i>=end){p.remove();messageEls.delete(i);}
+  }
+  let next=bottomSpacer;
+  for(let i=end-1;i>=start;i--){
+    let p=messageEls.get(i);
+    if(!p){p=messageElement(i);messageEls.set(i,p);}
+    if(p.nextSibling!==next) div.insertBefore(p,next);
+    next=p;
+  }
+  topSpacer.style.height=above+'px';
+  bottomSpacer.style.height=below+'px';
+  for(const [i,p] of messageEls) messageHeights[i]=p.offsetHeight;
+}
+
+function queueRender(){
+  if(renderQueued) return;
+  renderQueued=true;
+  requestAnimationFrame(()=>{renderQueued=false;renderWindow();});
+}
+
+// Fetch the page of older messages holding message i and show it
+async function loadPage(i){
+  const offset=Math.floor(i/PAGE_SIZE)*PAGE_SIZE;
+  if(pagesLoading.has(offset)) return;
+  pagesLoading.add(offset);
+  const state=chatState;
+  try{
+    const res=await fetch(`/api/chat/messages?offset=${offset}&limit=${PAGE_SIZE}`);
+    if(!res.ok||chatState!==state) return;
+    const page=await res.json();
+    page.messages.forEach((m,k)=>{
+      const j=offset+k;
+      if(state.messages[j]) return;
+      state.messages[j]=m;
+      const old=messageEls.get(j);
+      if(old){
+        const p=messageElement(j);
+        old.replaceWith(p);
+        messageEls.set(j,p);
+      }
+    });
+    queueRender();
+  }finally{
+    pagesLoading.delete(offset);
+  }
+}
+
+// Bring chatState and the message bubbles up to date with a full chat or a
+// delta ({rev,length,changes,meta}); returns true if the chat list changed
+function applyChat(chat){
+  let changed,listChanged;
+  if(!('changes' in chat)){
+    let {messages,rev,first,length,...meta}=chat;
+    if(first!==undefined){
+      // Only the system prompt and the messages from first on were sent
+      const msgs=new Array(length);
+      msgs[0]=messages[0];
+      messages.slice(1).forEach((m,k)=>{msgs[first+k]=m;});
+      messages=msgs;
     }
-    if(res.prompts){
-      const p=document.createElement('div');
-      p.className='message system';
-      p.textContent='Prompts: '+res.prompts.join(', ');
-      div.appendChild(p);
+    chatState={rev,messages,meta};
+    pagesLoading=new Set();
+    resetMessageList();
+    changed=messages.length&&messages[0].role==='system'?[0]:[];
+    listChanged=true;
+  }else{
+    const msgs=chatState.messages;
+    const before=msgs.length;
+    chatState.rev=chat.rev;
+    for(const [i,p] of messageEls){
+      if(i>=chat.length){p.remove();messageEls.delete(i);}
     }
-    if(res.results){
-      const p=document.createElement('div');
-      p.className='message system';
-      p.innerHTML=md(res.results.join('\n'));
-      div.appendChild(p);
+    messageHeights.length=Math.min(messageHeights.length,chat.length);
+    msgs.length=Math.min(msgs.length,chat.length);
+    changed=chat.changes.map(([i,m])=>{msgs[i]=m;return i;});
+    Object.assign(chatState.meta,chat.meta);
+    // A new chat shows up in the list once its first message is saved
+    listChanged='file' in chat.meta||'name' in chat.meta||(before<=1&&msgs.length>1);
+  }
+  const msgs=chatState.messages;
+  changed.forEach(i=>{
+    if(i===0&&msgs[0].role==='system'){setSystem(msgs[0].content);return;}
+    delete messageHeights[i];
+    const old=messageEls.get(i);
+    if(old){
+      const p=messageElement(i);
+      old.replaceWith(p);
+      messageEls.set(i,p);
     }
-    if(res.models){
-      const p=document.createElement('div');
-      p.className='message system';
-      p.textContent='Models: '+res.models.join(', ');
-      div.appendChild(p);
+  });
+  document.getElementById('chatName').textContent=chatState.meta.name||'';
+  document.getElementById('chatPath').textContent=chatState.meta.file||'';
+  return listChanged;
+}
+
+// The generated name of a new chat arrives shortly after its first answer;
+// ask for changes until it shows up (unchanged chats answer 304)
+async function pollChatName(tries){
+  const rev=chatState.rev;
+  const res=await fetch('/api/chat?since='+rev,{headers:{'If-None-Match':`"${rev}"`}});
+  if(res.status===200){
+    const listChanged=applyChat(await res.json());
+    renderWindow();
+    if(listChanged) loadChats();
+  }
+  if(tries>1&&(chatState.meta.name||'').startsWith('Chat ')){
+    setTimeout(()=>pollChatName(tries-1),1000);
+  }
+}
+
+// Add a bubble that is removed again when the next chat update arrives
+function addTransient(className,html,text){
+  const p=document.createElement('div');
+  p.className='message '+className+' transient';
+  if(html!==undefined) p.innerHTML=html;
+  else p.textContent=text;
+  document.getElementById('messages').appendChild(p);
+}
+
+// Show each answer of a /compare with its timings and a button to keep it
+function showComparison(res){
+  res.comparison.forEach((r,i)=>{
+    const stats=[`${r.latency.toFixed(2)}s`];
+    if(r.ttft!==null) stats.push(`first token ${r.ttft.toFixed(2)}s`);
+    if(r.tokens_per_second) stats.push(`${Math.round(r.tokens_per_second)} tok/s`);
+    if(r.usage) stats.push(`${r.usage.prompt_tokens} in / ${r.usage.completion_tokens} out tokens`);
+    const head=`**${i+1}. ${r.model}** (${r.error?'error':stats.join(', ')})\n`;
+    addTransient(r.error?'error':'assistant',md(head+(r.error||r.answer)));
+    if(r.answer){
+      const btn=document.createElement('button');
+      btn.className='chat-btn transient';
+      btn.textContent='Keep '+r.model;
+      btn.onclick=()=>pickComparison(i+1);
+      document.getElementById('messages').appendChild(btn);
     }
+  });
+  addTransient('system',undefined,`All answers in ${res.elapsed.toFixed(2)}s`);
+}
+
+// Keep one answer of the last comparison in the chat
+async function pickComparison(choice){
+  const res=await fetch('/api/compare/pick',{method:'POST',headers:{'Content-Type':'application/json'},body:JSON.stringify(withRev({choice}))});
+  const data=await res.json();
+  showMessages(data.chat,data.result);
+}
+
+function showMessages(chat,res){
+  // Apply the chat update and show any system responses
+  document.querySelectorAll('#messages .transient').forEach(p=>p.remove());
+  const full=!('changes' in chat);
+  const listChanged=applyChat(chat);
+  document.getElementById('summaryText').textContent=chatState.meta.summary||'';
+  if(res){
+    if(res.system) addTransient('system',md(res.system));
+    if(res.error) addTransient('error',undefined,res.error);
+    if(res.prompts) addTransient('system',undefined,'Prompts: '+res.prompts.join(', '));
+    if(res.results) addTransient('system',md(res.results.join('\n')));
+    if(res.models) addTransient('system',undefined,'Models: '+res.models.join(', '));
     if(res.file){
-      const p=document.createElement('div');
-      p.className='message system';
-      p.textContent=`File: ${res.file} | Model: ${res.model} | Messages: ${res.messages}`;
-      div.appendChild(p);
+      addTransient('system',undefined,`File: ${res.file} | Model: ${res.model} | Messages: ${res.messages}`);
     }
     if(res.summary){
       document.getElementById('summaryText').textContent=res.summary;
     }
+    if(res.comparison) showComparison(res);
+    if(res.naming) setTimeout(()=>pollChatName(10),1000);
   }
-  if(chat.summary){
-    document.getElementById('summaryText').textContent=chat.summary;
+  if(chatState.meta.summary){
+    document.getElementById('summaryText').textContent=chatState.meta.summary;
   }
-  // ensure the scroll position follows new messages
-  scrollMessagesToEnd();
-  loadChats();
+  // ensure the scroll position follows new messages; rendering replaces
+  // estimated heights with measured ones, so settle at the end twice
+  for(let k=0;k<2;k++){
+    scrollMessagesToEnd(full);
+    renderWindow();
+  }
+  scrollMessagesToEnd(full);
+  if(listChanged) loadChats();
 }
 
+document.getElementById('messages').addEventListener('scroll',queueRender);
+// Bubble heights depend on the width of the chat
+window.addEventListener('resize',()=>{messageHeights=[];queueRender();});
+
 loadChats();
 // Load the most recent chat when the page first opens
 fetch('/api/chat').then(r=>r.json()).then(d=>showMessages(d));
@@ -0,0 +1,506 @@
+"""Storage backends for saved chats.
+
+Everything that reads or writes saved chats goes through a
+:class:`ChatStorage`, so the CLI and the web server share one code path.  The
+default backend keeps the journal files below ``chat_history``
+(``logic.FileStorage``); :class:`SQLiteStorage` keeps every chat in one SQLite
+database in WAL mode with a row per message.  ``CHAT_STORAGE`` picks the
+backend and ``python cli.py storage`` copies chats from one to the other.
+
+Whatever the backend, a chat is named by its path below the history
+directory, such as ``autosave/autosave-20240101-120000.chat``.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import catalog
+
+# Stands in for the messages of a long chat that were not read into memory, so
+# indices stay those of the stored chat.  A windowed chat has a "window" entry
+# ({"source": ..., "first": ...}) naming where the backend reads them back from.
+UNLOADED = {"role": "unloaded", "content": ""}
+
+# Folders a bare chat file name is looked up in, in order
+CHAT_FOLDERS = ("", "autosave", "userchat", "archive")
+ARCHIVE = "archive"
+
+
+def chat_meta(chat_data):
+    """Return the fields of ``chat_data`` stored next to its messages."""
+    return {k: v for k, v in chat_data.items() if k not in ("messages", "window")}
+
+
+def _unchanged(new, old):
+    """Return whether message ``new`` needs no record over the saved ``old``.
+
+    A token count cached on the message after it was saved (see
+    ``logic.message_tokens``) is not worth rewriting the message for.
+    """
+    if new == old:
+        return True
+    return (
+        "tokens" in new and "tokens" not in old and len(new) == len(old) + 1
+        and all(new.get(k) == v for k, v in old.items())
+    )
+
+
+def chat_changes(state, chat_data):
+    """Return the records that turn the saved ``state`` into ``chat_data``.
+
+    ``state`` holds the ``messages`` and ``meta`` last written.  Records are
+    ``cut`` (drop messages from index ``n``), ``set`` (replace message ``i``),
+    ``add`` (append a message) and ``meta`` (changed and removed fields).
+    """
+    records = []
+    old = state["messages"]
+    new = chat_data["messages"]
+    common = min(len(old), len(new))
+    if len(new) < len(old):
+        records.append({"op": "cut", "n": len(new)})
+    for i in range(common):
+        # Unloaded messages are as stored, whatever the snapshot holds
+        if new[i] is not UNLOADED and not _unchanged(new[i], old[i]):
+            records.append({"op": "set", "i": i, "msg": new[i]})
+    for m in new[common:]:
+        records.append({"op": "add", "msg": m})
+    meta = chat_meta(chat_data)
+    changed = {k: v for k, v in meta.items() if state["meta"].get(k, object()) != v}
+    removed = [k for k in state["meta"] if k not in meta]
+    if changed or removed:
+        records.append({"op": "meta", "set": changed, "del": removed})
+    return records
+
+
+def _entry(row):
+    file, name, model, messages, size, mtime = row
+    return {"file": file, "name": name, "model": model, "messages": messages, "size": size, "mtime": mtime}
+
+
+def archived_copy_name(name, taken):
+    """Return ``name``, or ``name`` with a timestamp when ``taken(name)`` is true."""
+    if not taken(name):
+        return name
+    base, ext = os.path.splitext(name)
+    return f"{base}-{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+
+
+class ChatStorage(ABC):
+    """The operations every chat storage backend provides.
+
+    ``rel`` is always a path below the history directory.  Backends are
+    thread-safe and must implement every abstract method; ``flush`` only
+    matters for backends that write in the background.
+    """
+
+    @abstractmethod
+    def save(self, rel, chat_data):
+        """Persist ``chat_data`` as ``rel`` and return where it was written."""
+
+    @abstractmethod
+    def load(self, name, full=False):
+        """Return ``(data, rel)`` for the chat ``name`` or ``(None, None)``.
+
+        A bare file name is looked up in each of ``CHAT_FOLDERS``.  Long chats
+        come back windowed unless ``full`` is set, which also skips preparing
+        the chat for being saved back (for export or copying).
+        """
+
+    @abstractmethod
+    def window_messages(self, source, start, stop):
+        """Return messages ``start`` to ``stop`` of the windowed chat stored at ``source``."""
+
+    @abstractmethod
+    def get(self, rel):
+        """Return the listing entry of ``rel`` or ``None``."""
+
+    @abstractmethod
+    def entries(self, top=None):
+        """Return listing entries, newest first, optionally for one folder.
+
+        Entries have ``file``, ``name``, ``model``, ``messages``, ``size``
+        and ``mtime``.
+        """
+
+    @abstractmethod
+    def dirs(self):
+        """Return the folders chats are listed under."""
+
+    @abstractmethod
+    def search(self, text, dirs=None, limit=50):
+        """Return the best matching messages of every chat, like ``ChatCatalog.search``."""
+
+    @abstractmethod
+    def archive(self, rel):
+        """Move a chat into the archive, remembering where it came from."""
+
+    @abstractmethod
+    def restore(self, rel):
+        """Move an archived chat back to where it was archived from."""
+
+    @abstractmethod
+    def delete(self, rel):
+        """Delete an archived chat for good."""
+
+    @abstractmethod
+    def clear_archive(self):
+        """Delete every archived chat."""
+
+    def flush(self, rel=None):
+        """Write saves still queued for ``rel``, or for every chat."""
+
+
+class SQLiteStorage(ChatStorage):
+    """Every chat in one SQLite database, one row per message.
+
+    Messages are keyed by chat and index, so appending a message writes one
+    row and a long chat can be opened with only its last ``window`` messages.
+    Like the journal files, each save only writes the messages that changed
+    since this process last saved or loaded the chat.  The database runs in
+    WAL mode so the CLI and the server can use it at the same time; a chat
+    changed by another process is rewritten in full on its next save.
+    """
+
+    def __init__(self, path, window=200):
+        self.path = path
+        self.window = window
+        self._lock = threading.RLock()
+        # What each chat looked like after this process last wrote or read it
+        self._saved = {}
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chats (
+                file TEXT PRIMARY KEY,
+                dir TEXT NOT NULL,
+                name TEXT NOT NULL,
+                model TEXT,
+                meta TEXT NOT NULL,
+                messages INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS chats_dir ON chats (dir, mtime);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                file TEXT NOT NULL,
+                dir TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                extra TEXT,
+                UNIQUE (file, idx)
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content, content='messages', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages
+            WHEN new.role != 'system' BEGIN
+                INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages
+            WHEN old.role != 'system' BEGIN
+                INSERT INTO messages_fts (messages_fts, rowid, content)
+                VALUES ('delete', old.id, old.content);
+            END;
+            """
+        )
+        self._db.commit()
+
+    # --- rows ---
+
+    @staticmethod
+    def _message_row(m):
+        extra = {k: v for k, v in m.items() if k not in ("role", "content")}
+        return m.get("role", ""), m.get("content") or "", json.dumps(extra) if extra else None
+
+    @staticmethod
+    def _row_message(role, content, extra):
+        m = {"role": role, "content": content}
+        if extra:
+            m.update(json.loads(extra))
+        return m
+
+    @staticmethod
+    def _size(messages):
+        return sum(len((m.get("content") or "").encode("utf-8")) for m in messages)
+
+    def _insert(self, rel, top, puts, replace=True):
+        puts = list(puts)
+        if replace:
+            # Delete first: a REPLACE would skip the trigger keeping the index in sync
+            self._db.executemany(
+                "DELETE FROM messages WHERE file = ? AND idx = ?", [(rel, idx) for idx, _ in puts]
+            )
+        self._db.executemany(
+            "INSERT INTO messages (file, dir, idx, role, content, extra) VALUES (?, ?, ?, ?, ?, ?)",
+            [(rel, top, idx, *self._message_row(m)) for idx, m in puts],
+        )
+
+    def _resolve(self, name):
+        for folder in CHAT_FOLDERS:
+            rel = os.path.join(folder, name) if folder else name
+            row = self._db.execute(
+                "SELECT meta, messages, mtime FROM chats WHERE file = ?", (rel,)
+            ).fetchone()
+            if row is not None:
+                return rel, row
+        if os.path.basename(name) == name:
+            # A bare name also finds the latest chat of that name in any archive folder
+            row = self._db.execute(
+                "SELECT file, meta, messages, mtime FROM chats WHERE dir = ?"
+                " AND substr(file, -length(?) - 1) = '/' || ? ORDER BY mtime DESC LIMIT 1",
+                (ARCHIVE, name, name),
+            ).fetchone()
+            if row is not None:
+                return row[0], row[1:]
+        return None, None
+
+    # --- reading and writing ---
+
+    def save(self, rel, chat_data):
+        messages = chat_data["messages"]
+        top = catalog.ChatCatalog.top_dir(rel)
+        with self._lock:
+            state = self._saved.get(rel)
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT mtime, size FROM chats WHERE file = ?", (rel,)
+                ).fetchone()
+                rewrite = state is None or row is None or row[0] != state["mtime"]
+                if rewrite:
+                    # Unknown to this process or changed by another one
+                    full = self._filled(chat_data)
+                    self._db.execute("DELETE FROM messages WHERE file = ?", (rel,))
+                    self._insert(rel, top, enumerate(full), replace=False)
+                    size = self._size(full)
+                else:
+                    size = row[1] + self._apply(rel, top, state, chat_changes(state, chat_data))
+                mtime = time.time()
+                meta = chat_meta(chat_data)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (rel, top, chat_data.get("name") or os.path.splitext(os.path.basename(rel))[0],
+                     chat_data.get("model"), json.dumps(meta), len(messages), size, mtime),
+                )
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                self._saved.pop(rel, None)
+                raise
+            if rewrite:
+                self._remember(rel, chat_data, mtime)
+            else:
+                state["meta"] = json.loads(json.dumps(meta))
+                state["mtime"] = mtime
+            window = chat_data.get("window")
+            if window:
+                # The unloaded messages are now read back from this chat
+                window["source"] = rel
+        return f"{rel} in {self.path}"
+
+    def _apply(self, rel, top, state, records):
+        """Write ``records`` as row changes and return the change in content bytes.
+
+        The snapshot in ``state`` is brought up to date without copying the
+        untouched messages.
+        """
+        snapshot = state["messages"]
+        delta = 0
+        puts = {}
+        for rec in records:
+            if rec["op"] == "cut":
+                self._db.execute("DELETE FROM messages WHERE file = ? AND idx >= ?", (rel, rec["n"]))
+                delta -= self._size(m for m in snapshot[rec["n"]:] if m is not UNLOADED)
+                del snapshot[rec["n"]:]
+            elif rec["op"] == "set":
+                old = snapshot[rec["i"]]
+                delta += self._size([rec["msg"]]) - (0 if old is UNLOADED else self._size([old]))
+                snapshot[rec["i"]] = dict(rec["msg"])
+                puts[rec["i"]] = rec["msg"]
+            elif rec["op"] == "add":
+                delta += self._size([rec["msg"]])
+                puts[len(snapshot)] = rec["msg"]
+                snapshot.append(dict(rec["msg"]))
+        self._insert(rel, top, puts.items())
+        return delta
+
+    def _filled(self, chat_data):
+        """Return the messages of ``chat_data`` with unloaded ones read back."""
+        messages = chat_data["messages"]
+        missing = [i for i, m in enumerate(messages) if m is UNLOADED]
+        if not missing:
+            return messages
+        lo, hi = missing[0], missing[-1] + 1
+        stored = self.window_messages(chat_data["window"]["source"], lo, hi)
+        return [stored[i - lo] if m is UNLOADED else m for i, m in enumerate(messages)]
+
+    def _remember(self, rel, chat_data, mtime):
+        self._saved[rel] = {
+            "messages": [m if m is UNLOADED else dict(m) for m in chat_data["messages"]],
+            "meta": json.loads(json.dumps(chat_meta(chat_data))),
+            "mtime": mtime,
+        }
+
+    def load(self, name, full=False):
+        with self._lock:
+            rel, row = self._resolve(name)
+            if rel is None:
+                return None, None
+            meta, count, mtime = row
+            first = 1
+            if not full and count > self.window + 1:
+                first = count - self.window
+            rows = self._db.execute(
+                "SELECT idx, role, content, extra FROM messages"
+                " WHERE file = ? AND (idx = 0 OR idx >= ?) ORDER BY idx",
+                (rel, first),
+            ).fetchall()
+            chat_data = json.loads(meta)
+            messages = [self._row_message(*r[1:]) for r in rows]
+            if first > 1:
+                messages[1:1] = [UNLOADED] * (first - 1)
+                chat_data["window"] = {"source": rel, "first": first}
+            chat_data["messages"] = messages
+            if not full:
+                self._remember(rel, chat_data, mtime)
+        return chat_data, rel
+
+    def window_messages(self, source, start, stop):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT role, content, extra FROM messages"
+                " WHERE file = ? AND idx >= ? AND idx < ? ORDER BY idx",
+                (source, start, stop),
+            ).fetchall()
+        if len(rows) != stop - start:
+            raise RuntimeError(f"{source} no longer holds messages {start} to {stop}")
+        return [self._row_message(*r) for r in rows]
+
+    # --- listing and search ---
+
+    _ENTRY = "SELECT file, name, model, messages, size, mtime FROM chats"
+
+    def get(self, rel):
+        with self._lock:
+            row = self._db.execute(self._ENTRY + " WHERE file = ?", (rel,)).fetchone()
+        return _entry(row) if row else None
+
+    def entries(self, top=None):
+        query, args = self._ENTRY, ()
+        if top is not None:
+            query += " WHERE dir = ?"
+            args = (top,)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY mtime DESC", args).fetchall()
+        return [_entry(r) for r in rows]
+
+    def dirs(self):
+        with self._lock:
+            rows = self._db.execute("SELECT DISTINCT dir FROM chats WHERE dir != ''").fetchall()
+        return sorted({"autosave", "userchat", ARCHIVE} | {r[0] for r in rows})
+
+    def search(self, text, dirs=None, limit=50):
+        query = catalog.ChatCatalog.fts_query(text)
+        if not query:
+            return []
+        sql = (
+            "SELECT m.file, m.idx, m.role,"
+            " snippet(messages_fts, 0, '**', '**', '...', 16), bm25(messages_fts) AS score,"
+            " c.name"
+            " FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid"
+            " LEFT JOIN chats c ON c.file = m.file"
+            " WHERE messages_fts MATCH ?"
+        )
+        args = [query]
+        if dirs:
+            sql += " AND m.dir IN (%s)" % ",".join("?" * len(dirs))
+            args.extend(dirs)
+        sql += " ORDER BY score LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        return [
+            {
+                "file": file,
+                "name": name or os.path.splitext(os.path.basename(file))[0],
+                "index": idx,
+                "role": role,
+                "snippet": snippet,
+                "score": -score,
+            }
+            for file, idx, role, snippet, score, name in rows
+        ]
+
+    # --- archive ---
+
+    def _rename(self, old_rel, new_rel, meta):
+        top = catalog.ChatCatalog.top_dir(new_rel)
+        self._db.execute("DELETE FROM messages WHERE file = ?", (new_rel,))
+        self._db.execute("DELETE FROM chats WHERE file = ?", (new_rel,))
+        self._db.execute(
+            "UPDATE chats SET file = ?, dir = ?, meta = ?, mtime = ? WHERE file = ?",
+            (new_rel, top, json.dumps(meta), time.time(), old_rel),
+        )
+        self._db.execute("UPDATE messages SET file = ?, dir = ? WHERE file = ?", (new_rel, top, old_rel))
+        self._db.commit()
+        self._saved.pop(old_rel, None)
+        self._saved.pop(new_rel, None)
+
+    def _meta(self, rel):
+        row = self._db.execute("SELECT meta FROM chats WHERE file = ?", (rel,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def archive(self, rel):
+        if rel.startswith(ARCHIVE + "/"):
+            return False
+        with self._lock:
+            meta = self._meta(rel)
+            if meta is None:
+                return False
+            meta["archived_from"] = rel
+            name = archived_copy_name(
+                rel, lambda n: self._meta(os.path.join(ARCHIVE, n)) is not None
+            )
+            self._rename(rel, os.path.join(ARCHIVE, name), meta)
+            return True
+
+    def restore(self, rel):
+        subpath = rel[len(ARCHIVE) + 1:] if rel.startswith(ARCHIVE + "/") else rel
+        src = os.path.join(ARCHIVE, subpath)
+        with self._lock:
+            meta = self._meta(src)
+            if meta is None:
+                return False
+            dest = meta.pop("archived_from", os.path.join("userchat", os.path.basename(rel)))
+            self._rename(src, dest, meta)
+            return True
+
+    def delete(self, rel):
+        subpath = rel[len(ARCHIVE) + 1:] if rel.startswith(ARCHIVE + "/") else rel
+        src = os.path.join(ARCHIVE, subpath)
+        with self._lock:
+            if self._meta(src) is None:
+                return False
+            self._db.execute("DELETE FROM messages WHERE file = ?", (src,))
+            self._db.execute("DELETE FROM chats WHERE file = ?", (src,))
+            self._db.commit()
+            self._saved.pop(src, None)
+            return True
+
+    def clear_archive(self):
+        with self._lock:
+            self._db.execute("DELETE FROM messages WHERE dir = ?", (ARCHIVE,))
+            self._db.execute("DELETE FROM chats WHERE dir = ?", (ARCHIVE,))
+            self._db.commit()
+            for rel in [r for r in self._saved if catalog.ChatCatalog.top_dir(r) == ARCHIVE]:
+                del self._saved[rel]
+            return True
@@ -0,0 +1,43 @@
+"""Shared fixtures: every test gets its own chat history below ``tmp_path``."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Never pick up a developer's .env, its keys or endpoint
+os.environ["LOAD_DOTENV"] = "false"
+os.environ.setdefault("GROQ_API_KEY", "test-key")
+
+import logic  # noqa: E402
+
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    """Point logic at an empty chat history in ``tmp_path`` and return its path."""
+    root = tmp_path / "chat_history"
+    for name in ("AUTOSAVE_DIR", "USERCHAT_DIR", "ARCHIVE_DIR"):
+        sub = os.path.relpath(getattr(logic, name), logic.CHAT_HISTORY_DIR)
+        monkeypatch.setattr(logic, name, str(root / sub))
+    monkeypatch.setattr(logic, "CHAT_HISTORY_DIR", str(root))
+    monkeypatch.setattr(logic, "CATALOG_FILE", str(root / "catalog.sqlite3"))
+    monkeypatch.setattr(logic, "STORAGE_FILE", str(root / "chats.sqlite3"))
+    monkeypatch.setattr(logic, "EXPORTS_DIR", str(tmp_path / "exports"))
+    monkeypatch.setattr(logic, "PROMPTS_DIR", str(tmp_path / "prompts"))
+    monkeypatch.setattr(logic, "_catalog", None)
+    monkeypatch.setattr(logic, "_archive", None)
+    monkeypatch.setattr(logic, "_storages", {})
+    monkeypatch.setattr(logic, "_journals", {})
+    logic.ensure_directories()
+    return root
+
+
+def make_chat(count, name="Chat test"):
+    """Return a chat with a system prompt and ``count`` alternating messages."""
+    messages = [{"role": "system", "content": "You are a test."}]
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": f"{role} message {i}"})
+    return {"name": name, "version": logic.CHAT_VERSION, "model": logic.MODEL,
+            "messages": messages, "summary": ""}
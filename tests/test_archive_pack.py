@@ -0,0 +1,34 @@
+"""Tests for archive_pack.py."""
+
+import archive_pack
+
+
+def test_clear_during_repack_keeps_new_chats(tmp_path):
+    pack = archive_pack.ArchivePack(str(tmp_path))
+    for i in range(5):
+        pack.put(f"c{i}.chat", b"x" * 100)
+    pack.delete("c0.chat")
+    lock = pack._lock
+
+    class ClearBeforeCatchUp:
+        """Clear the archive and add a chat once the unlocked copy is done."""
+        entered = 0
+
+        def __enter__(self):
+            ClearBeforeCatchUp.entered += 1
+            if ClearBeforeCatchUp.entered == 2:
+                with lock:
+                    pack.clear()
+                    pack.put("new.chat", b"hello")
+            return lock.__enter__()
+
+        def __exit__(self, *exc):
+            return lock.__exit__(*exc)
+
+    pack._lock = ClearBeforeCatchUp()
+    pack.repack()
+    pack._lock = lock
+
+    reopened = archive_pack.ArchivePack(str(tmp_path))
+    assert list(reopened.names()) == ["new.chat"]
+    assert reopened.get("new.chat") == b"hello"
@@ -0,0 +1,45 @@
+"""Tests for completion_cache.py: the disk tier's expiry and size bound."""
+
+import completion_cache
+
+
+def disk_keys(cache):
+    return {row[0] for row in cache._db.execute("SELECT key FROM completions")}
+
+
+def test_disk_evicts_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(completion_cache.CompletionCache, "EVICT_BATCH", 2)
+    cache = completion_cache.CompletionCache(max_entries=1, disk_path=str(tmp_path / "c.db"), disk_max_bytes=30)
+    for i in range(3):
+        cache.put(f"k{i}", "x" * 10)
+    cache._memory.clear()
+    assert cache.get("k0") == "x" * 10
+
+    cache.put("k3", "x" * 10)
+    assert disk_keys(cache) == {"k0", "k2", "k3"}
+    assert cache._disk_bytes == cache.stats()["disk_bytes"] == 30
+
+    cache.put("big", "y" * 25)
+    assert disk_keys(cache) == {"big"}
+    assert cache._disk_bytes == 25
+
+
+def test_replacing_a_key_keeps_the_byte_total(tmp_path):
+    cache = completion_cache.CompletionCache(disk_path=str(tmp_path / "c.db"), disk_max_bytes=100)
+    cache.put("k", "x" * 40)
+    cache.put("k", "x" * 10)
+    assert cache._disk_bytes == cache.stats()["disk_bytes"] == 10
+
+
+def test_expired_rows_are_dropped_and_total_reloaded(tmp_path):
+    path = str(tmp_path / "c.db")
+    cache = completion_cache.CompletionCache(ttl=60, disk_path=path)
+    cache.put("old", "x" * 10)
+    cache._db.execute("UPDATE completions SET created = created - 120")
+    cache._db.commit()
+    cache.put("new", "y" * 5)
+    assert disk_keys(cache) == {"new"}
+    assert cache._disk_bytes == 5
+
+    reopened = completion_cache.CompletionCache(ttl=60, disk_path=path)
+    assert reopened._disk_bytes == 5
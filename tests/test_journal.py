@@ -0,0 +1,110 @@
+"""Tests for the journaled chat file format in logic.py."""
+
+import json
+
+import pytest
+
+import logic
+from conftest import make_chat
+
+
+def records(path):
+    """Return the ops of the records following the header of an uncompressed journal."""
+    lines = path.read_bytes().decode("utf-8").splitlines()
+    assert "journal" in json.loads(lines[0])
+    return [json.loads(line)["op"] for line in lines[1:]]
+
+
+def test_saves_append_records_and_replay(tmp_path):
+    path = tmp_path / "a.chat"
+    chat = make_chat(2)
+    logic.write_chat_file(str(path), chat)
+    assert records(path) == ["add"] * 3
+
+    chat["messages"].append({"role": "user", "content": "added"})
+    logic.write_chat_file(str(path), chat)
+    chat["messages"][1] = {"role": "user", "content": "edited"}
+    logic.write_chat_file(str(path), chat)
+    del chat["messages"][2:]
+    logic.write_chat_file(str(path), chat)
+    chat["name"] = "Renamed"
+    del chat["summary"]
+    logic.write_chat_file(str(path), chat)
+
+    assert records(path) == ["add"] * 3 + ["add", "set", "cut", "meta"]
+    assert logic.read_chat_file(str(path)) == chat
+
+
+def test_unchanged_chat_writes_nothing(tmp_path):
+    path = tmp_path / "a.chat"
+    chat = make_chat(2)
+    logic.write_chat_file(str(path), chat)
+    size = path.stat().st_size
+    logic.write_chat_file(str(path), chat)
+    assert path.stat().st_size == size
+
+
+@pytest.mark.parametrize("codec", ["none", "gzip"])
+def test_torn_last_record_is_dropped_and_rewritten(tmp_path, codec):
+    path = tmp_path / "a.chat"
+    chat = make_chat(2)
+    logic.compact_chat_file(str(path), chat, codec)
+    logic.write_chat_file(str(path), chat)
+    whole = path.stat().st_size
+    chat["messages"].append({"role": "user", "content": "lost in a crash"})
+    logic.write_chat_file(str(path), chat)
+    # A crash in the middle of the last append
+    with open(path, "r+b") as f:
+        f.truncate(whole + (path.stat().st_size - whole) // 2)
+
+    kept = logic.read_chat_file(str(path), track=True)
+    assert kept["messages"] == chat["messages"][:-1]
+
+    # The damaged journal is not appended to but written again in full
+    logic.write_chat_file(str(path), chat)
+    assert logic.read_chat_file(str(path)) == chat
+    if codec == "none":
+        assert records(path) == ["add"] * 4
+
+
+def test_compaction_drops_dead_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(logic, "JOURNAL_COMPACT_SLACK", 5)
+    path = tmp_path / "a.chat"
+    chat = make_chat(2)
+    logic.write_chat_file(str(path), chat)
+    for i in range(6):
+        chat["messages"][1] = {"role": "user", "content": f"edit {i}"}
+        logic.write_chat_file(str(path), chat)
+    assert records(path) == ["add"] * 3
+    assert logic.read_chat_file(str(path)) == chat
+
+
+def test_compact_round_trip_and_legacy_files(tmp_path):
+    path = tmp_path / "a.chat"
+    chat = make_chat(3)
+    placed = logic.compact_chat_file(str(path), chat, "none")
+    raw = path.read_bytes()
+    for i, at, length in placed:
+        assert json.loads(raw[at:at + length])["msg"] == chat["messages"][i]
+    assert logic.read_chat_file(str(path)) == chat
+
+    # Chats saved before journals existed load as they were stored
+    legacy = tmp_path / "legacy.chat"
+    legacy.write_text(json.dumps(chat["messages"]))
+    assert logic.read_chat_file(str(legacy)) == chat["messages"]
+
+
+def test_token_counts_are_saved_with_new_messages(history):
+    chat = make_chat(2)
+    logic.save_chat_to_file("userchat/t.chat", chat)
+    for turn in range(3):
+        chat["messages"].append({"role": "user", "content": f"question {turn}"})
+        logic.save_chat_to_file("userchat/t.chat", chat)
+        logic.build_context(chat["messages"], logic.MODEL)
+        chat["messages"].append({"role": "assistant", "content": f"answer {turn}"})
+        logic.save_chat_to_file("userchat/t.chat", chat)
+    logic.flush_saves()
+    path = history / "userchat" / "t.chat"
+    assert records(path) == ["add"] * 9
+    saved = logic.read_chat_file(str(path))
+    assert all("tokens" in m for m in saved["messages"])
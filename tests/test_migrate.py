@@ -0,0 +1,72 @@
+"""Tests for migrate.py: format upgrades and resumable runs."""
+
+import json
+import os
+
+import logic
+import migrate
+
+QUIET = dict(workers=1, progress=lambda line: None)
+
+
+def legacy_chats(history, count):
+    """Write ``count`` chats in the pre-1.0 message list format and return their paths."""
+    paths = []
+    for i in range(count):
+        path = os.path.join(logic.AUTOSAVE_DIR, f"autosave-{i}.chat")
+        with open(path, "w") as f:
+            json.dump([{"role": "system", "content": "s"}, {"role": "user", "content": f"hi {i}"}], f)
+        paths.append(path)
+    return paths
+
+
+def write_checkpoint(lines):
+    with open(migrate.checkpoint_path("convert"), "w") as f:
+        f.write("".join(lines))
+
+
+HEADER = json.dumps({"migration": "convert", "target": logic.CHAT_VERSION}) + "\n"
+
+
+def test_unknown_version_is_upgraded_from_0():
+    chat = migrate.upgrade({"version": "0.5", "messages": []}, "autosave/old.chat")
+    assert chat["version"] == logic.CHAT_VERSION
+    assert chat["name"] == "old"
+    assert chat["model"] == logic.MODEL
+
+
+def test_convert_upgrades_every_file(history):
+    paths = legacy_chats(history, 3)
+    stats = migrate.run("convert", **QUIET)
+    assert stats["counts"] == {"converted": 3}
+    assert not os.path.exists(migrate.checkpoint_path("convert"))
+    for path in paths:
+        assert logic.read_chat_file(path)["version"] == logic.CHAT_VERSION
+    assert migrate.run("convert", **QUIET)["counts"] == {"current": 3}
+
+
+def test_checkpoint_resumes_and_ignores_a_torn_line(history):
+    paths = legacy_chats(history, 3)
+    write_checkpoint([HEADER, json.dumps({"file": paths[0]}) + "\n", '{"file": "' + paths[1][:5]])
+    stats = migrate.run("convert", **QUIET)
+    assert stats["resumed"] == 1
+    assert stats["counts"] == {"converted": 2}
+    # The file the checkpoint named was skipped, so it is still a message list
+    assert isinstance(logic.read_chat_file(paths[0]), list)
+
+
+def test_checkpoint_of_another_target_is_ignored(history):
+    paths = legacy_chats(history, 2)
+    other = json.dumps({"migration": "convert", "target": "0.9"}) + "\n"
+    write_checkpoint([other, json.dumps({"file": paths[0]}) + "\n"])
+    stats = migrate.run("convert", **QUIET)
+    assert stats["resumed"] == 0
+    assert stats["counts"] == {"converted": 2}
+
+
+def test_dry_run_writes_nothing(history):
+    paths = legacy_chats(history, 2)
+    stats = migrate.run("convert", dry_run=True, **QUIET)
+    assert stats["counts"] == {"converted": 2}
+    assert all(isinstance(logic.read_chat_file(p), list) for p in paths)
+    assert not os.path.exists(migrate.checkpoint_path("convert"))
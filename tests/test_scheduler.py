@@ -0,0 +1,156 @@
+"""Tests for scheduler.py, run against a fake clock and fake clients."""
+
+import asyncio
+import types
+
+import groq
+import httpx
+import pytest
+
+import scheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace the scheduler's clock, and make its retry sleeps advance it."""
+    fake = FakeClock()
+    monkeypatch.setattr(scheduler, "time", types.SimpleNamespace(monotonic=fake))
+    real_sleep = asyncio.sleep
+
+    async def sleep(delay, *args, **kwargs):
+        fake.now += delay
+        await real_sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    return fake
+
+
+def make_scheduler(keys=("key-a",), **kwargs):
+    sched = scheduler.Scheduler(**kwargs)
+    sched.set_keys(list(keys), lambda key, on_response: types.SimpleNamespace(key=key))
+    return sched
+
+
+def response(status, headers=None):
+    request = httpx.Request("POST", "https://api.groq.com/openai/v1/chat/completions")
+    return httpx.Response(status, headers=headers or {}, request=request)
+
+
+def test_token_bucket_refills_over_time(clock):
+    bucket = scheduler.TokenBucket(per_minute=60)
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    clock.now += 1.0
+    assert bucket.wait_time(1) == 0.0
+
+
+def test_sessions_take_turns(clock):
+    async def main():
+        sched = make_scheduler(max_concurrency=1)
+        busy = await sched.acquire("x")
+        order = []
+
+        async def request(session, n):
+            key = await sched.acquire(session)
+            order.append(f"{session}{n}")
+            await asyncio.sleep(0)
+            sched.release(key)
+
+        tasks = [asyncio.ensure_future(request("a", n)) for n in range(3)]
+        tasks.append(asyncio.ensure_future(request("b", 0)))
+        await asyncio.sleep(0)
+        # Session a queued three requests before b's one; b still goes second
+        sched.release(busy)
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(main()) == ["a0", "b0", "a1", "a2"]
+
+
+def test_interactive_requests_go_before_background_ones(clock):
+    async def main():
+        sched = make_scheduler(max_concurrency=1)
+        busy = await sched.acquire("a")
+        order = []
+
+        async def request(session, priority):
+            key = await sched.acquire(session, priority)
+            order.append(priority)
+            sched.release(key)
+
+        background = asyncio.ensure_future(request("b", scheduler.BACKGROUND))
+        interactive = asyncio.ensure_future(request("c", scheduler.INTERACTIVE))
+        await asyncio.sleep(0)
+        sched.release(busy)
+        await asyncio.gather(background, interactive)
+        return order
+
+    assert asyncio.run(main()) == [scheduler.INTERACTIVE, scheduler.BACKGROUND]
+
+
+def test_rejected_key_is_taken_out_of_rotation(clock):
+    async def main():
+        sched = make_scheduler(("key-a", "key-b"))
+        rejected, other = sched.keys
+        await rejected.observe(response(401))
+        assert rejected.disabled
+        picked = [await sched.acquire("a") for _ in range(3)]
+        for key in picked:
+            sched.release(key)
+        assert {k.key for k in picked} == {"key-b"}
+
+        await other.observe(response(403))
+        with pytest.raises(scheduler.UnavailableError):
+            await sched.acquire("a")
+
+    asyncio.run(main())
+
+
+def test_rate_limited_request_is_retried_after_the_pause(clock):
+    async def main():
+        sched = make_scheduler(max_retries=2)
+        key = sched.keys[0]
+        calls = []
+
+        async def call(client):
+            calls.append(clock.now)
+            if len(calls) == 1:
+                limited = response(429, {"retry-after": "2"})
+                await key.observe(limited)
+                raise groq.RateLimitError("rate limited", response=limited, body=None)
+            return "answer"
+
+        result = await sched.run(call, "a")
+        return result, calls, sched.stats()
+
+    result, calls, stats = asyncio.run(main())
+    assert result == "answer"
+    assert calls[1] - calls[0] >= 2.0
+    assert stats["rate_limited"] == 1
+    assert stats["retries"] == 1
+
+
+def test_errors_that_cannot_pass_are_not_retried(clock):
+    async def main():
+        sched = make_scheduler(max_retries=3)
+        calls = []
+
+        async def call(client):
+            calls.append(1)
+            raise groq.BadRequestError("bad", response=response(400), body=None)
+
+        with pytest.raises(groq.BadRequestError):
+            await sched.run(call, "a")
+        return calls, sched.stats()
+
+    calls, stats = asyncio.run(main())
+    assert len(calls) == 1
+    assert stats["failed"] == 1
@@ -0,0 +1,78 @@
+"""Tests for the streaming message endpoint of server.py."""
+
+import os
+
+import pytest
+
+os.environ["DEV_MODE"] = "true"
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import logic  # noqa: E402
+import server  # noqa: E402
+
+
+@pytest.fixture
+def client(history):
+    """A test client whose chats are written to the test's own history."""
+    with TestClient(server.app) as c:
+        yield c
+
+
+def test_stream_upstream_error_with_idempotency_key(client, monkeypatch):
+    async def failing_stream(*args, **kwargs):
+        raise RuntimeError("upstream failed")
+        yield  # pragma: no cover
+
+    monkeypatch.setattr(logic, "stream_completion_async", failing_stream)
+    headers = {"Idempotency-Key": "key-1"}
+    r = client.post("/api/message/stream", json={"message": "hello"}, headers=headers)
+    assert r.status_code == 200
+    assert "event: error" in r.text
+    assert "event: done" in r.text
+
+    # The failed request was forgotten, so a retry with the same key runs again
+    r = client.post("/api/message/stream", json={"message": "hello"}, headers=headers)
+    assert "event: error" in r.text
+    assert "event: done" in r.text
+    messages = client.get("/api/chat").json()["messages"]
+    assert [m["role"] for m in messages] == ["system"]
+
+
+def test_stream_save_error_releases_the_session(client, monkeypatch):
+    def failing_save(filename, chat_data):
+        raise OSError("disk full")
+
+    gauge = server.STREAMS_IN_FLIGHT
+    in_flight = gauge._values.get(gauge._key({}), 0)
+    monkeypatch.setattr(logic, "save_chat_to_file", failing_save)
+    headers = {"Idempotency-Key": "key-2"}
+    r = client.post("/api/message/stream", json={"message": "hello"}, headers=headers)
+    assert "disk full" in r.text
+    assert "event: done" in r.text
+    sess = server.sessions.get(client.cookies["session_id"])
+    assert sess["busy"] == 0
+    assert gauge._values.get(gauge._key({}), 0) == in_flight
+
+    # The future was failed, so a retry runs again instead of waiting forever
+    r = client.post("/api/message/stream", json={"message": "hello"}, headers=headers)
+    assert "disk full" in r.text
+    assert [m["role"] for m in sess["chat_data"]["messages"]] == ["system"]
+
+
+def test_chat_etag_answers_304_until_the_chat_changes(client):
+    # Reading the chat does not create a session; sending a command does
+    client.post("/api/message", json={"message": "/help"})
+    sess = server.sessions.get(client.cookies["session_id"])
+    r = client.get("/api/chat")
+    etag = r.headers["ETag"]
+    rev = r.json()["rev"]
+    assert etag == f'"{rev}"'
+    r = client.get("/api/chat", params={"since": rev}, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+
+    sess["chat_data"]["name"] = "Renamed"
+    r = client.get("/api/chat", params={"since": rev}, headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.json()["meta"] == {"name": "Renamed"}
+    assert r.headers["ETag"] == f'"{r.json()["rev"]}"'
@@ -0,0 +1,169 @@
+"""Tests for session_store.py: chat revisions and deltas, and session eviction."""
+
+import time
+import types
+
+import pytest
+
+import logic
+import session_store
+from conftest import make_chat
+
+
+def session(chat_data, active="autosave/a.chat"):
+    return {"chat_data": chat_data, "active": active}
+
+
+def test_full_state_then_deltas():
+    sess = session(make_chat(2))
+    full = session_store.chat_state(sess)
+    assert full["messages"] == sess["chat_data"]["messages"]
+    assert full["file"] == "autosave/a.chat"
+    rev = full["rev"]
+
+    assert session_store.chat_state(sess, rev) == {"rev": rev, "length": 3, "changes": [], "meta": {}}
+
+    sess["chat_data"]["messages"].append({"role": "user", "content": "new"})
+    sess["chat_data"]["name"] = "Named"
+    delta = session_store.chat_state(sess, rev)
+    assert delta["rev"] > rev
+    assert delta["length"] == 4
+    assert delta["changes"] == [[3, {"role": "user", "content": "new"}]]
+    assert delta["meta"] == {"name": "Named"}
+
+
+def test_removed_field_is_sent_as_none():
+    sess = session(make_chat(2))
+    rev = session_store.chat_state(sess)["rev"]
+    del sess["chat_data"]["summary"]
+    assert session_store.chat_state(sess, rev)["meta"] == {"summary": None}
+
+
+def test_cut_then_regrow_sends_the_new_messages():
+    chat = make_chat(4)
+    sess = session(chat)
+    rev = session_store.chat_state(sess)["rev"]
+    del chat["messages"][3:]
+    cut = session_store.chat_state(sess, rev)
+    assert cut["length"] == 3
+    assert cut["changes"] == []
+
+    chat["messages"].append({"role": "assistant", "content": "another answer"})
+    delta = session_store.chat_state(sess, rev)
+    assert delta["length"] == 4
+    assert delta["changes"] == [[3, {"role": "assistant", "content": "another answer"}]]
+
+
+def test_unknown_revision_gets_the_full_state():
+    sess = session(make_chat(2))
+    rev = session_store.chat_state(sess)["rev"]
+    for since in (None, rev + 1000, sess["view"]["base"] - 1):
+        state = session_store.chat_state(sess, since)
+        assert "changes" not in state
+        assert len(state["messages"]) == 3
+
+
+def test_window_skips_unloaded_messages():
+    chat = make_chat(10)
+    first = 8
+    chat["messages"][1:first] = [logic.UNLOADED] * (first - 1)
+    chat["window"] = {"source": "autosave/a.chat", "first": first}
+    sess = session(chat)
+
+    full = session_store.chat_state(sess)
+    assert "window" not in full
+    assert full["first"] == first
+    assert full["length"] == 11
+    assert full["messages"] == chat["messages"][:1] + chat["messages"][first:]
+
+    chat["messages"].append({"role": "user", "content": "new"})
+    delta = session_store.chat_state(sess, full["rev"])
+    assert delta["changes"] == [[11, {"role": "user", "content": "new"}]]
+    assert "window" not in delta["meta"]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(session_store, "time", types.SimpleNamespace(monotonic=fake, time=time.time))
+    return fake
+
+
+def chat_of(size):
+    """Return a chat whose messages take ``size`` bytes."""
+    return {"messages": [{"role": "user", "content": "x" * size}]}
+
+
+def make_store(**kwargs):
+    evicted = []
+    store = session_store.SessionStore(on_evict=evicted.append, **kwargs)
+    return store, evicted
+
+
+def test_least_recently_used_session_is_evicted(clock):
+    store, evicted = make_store(max_sessions=2)
+    a = store.add("a", chat_of(1), "autosave/a.chat")
+    b = store.add("b", chat_of(1), "autosave/b.chat")
+    assert store.get("a") is a
+    store.add("c", chat_of(1), "autosave/c.chat")
+    assert evicted == [b]
+    assert "b" not in store and "a" in store
+    assert store.stats()["evicted_lru"] == 1
+
+
+def test_idle_sessions_expire(clock):
+    store, evicted = make_store(ttl=10)
+    a = store.add("a", chat_of(1), "autosave/a.chat")
+    clock.now += 5
+    assert store.get("a") is a
+    clock.now += 11
+    assert store.get("a") is None
+    assert evicted == [a]
+    assert store.stats()["expired"] == 1
+
+
+def test_sessions_over_the_byte_limit_are_evicted(clock):
+    store, evicted = make_store(max_bytes=100)
+    a = store.add("a", chat_of(60), "autosave/a.chat")
+    b = store.add("b", chat_of(30), "autosave/b.chat")
+    assert evicted == []
+    b["chat_data"]["messages"].append({"role": "assistant", "content": "y" * 30})
+    store.update("b")
+    assert evicted == [a]
+    assert store.stats()["bytes"] == 60
+    assert store.stats()["evicted_bytes"] == 1
+
+
+def test_busy_sessions_are_never_evicted(clock):
+    store, evicted = make_store(max_sessions=2, ttl=10)
+    a = store.add("a", chat_of(1), "autosave/a.chat")
+    a["busy"] = 1
+    b = store.add("b", chat_of(1), "autosave/b.chat")
+    c = store.add("c", chat_of(1), "autosave/c.chat")
+    # a is the least recently used but is streaming, so b goes instead
+    assert evicted == [b]
+    clock.now += 20
+    store.expire()
+    assert evicted == [b, c]
+    assert "a" in store
+    a["busy"] = 0
+    store.expire()
+    assert evicted == [b, c, a]
+
+
+def test_evicted_session_remembers_its_chat_once(clock):
+    store, _ = make_store(max_sessions=1)
+    store.add("a", chat_of(1), "userchat/a.chat")
+    store.add("b", chat_of(1), "autosave/b.chat")
+    assert store.evicted_file("a") == "userchat/a.chat"
+    assert store.evicted_file("a") is None
+    store.add("a", chat_of(1), "userchat/a.chat", resumed=True)
+    assert store.stats()["resumed"] == 1
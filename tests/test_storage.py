@@ -0,0 +1,91 @@
+"""Tests that the chat storage backends behave the same, and copying between them."""
+
+import pytest
+
+import logic
+import migrate
+from conftest import make_chat
+
+
+@pytest.fixture(params=logic.STORAGE_BACKENDS)
+def store(request, history, monkeypatch):
+    monkeypatch.setattr(logic, "CHAT_STORAGE", request.param)
+    monkeypatch.setattr(logic, "CHAT_WINDOW", 5)
+    return logic.get_storage()
+
+
+def test_backends_behave_alike(store):
+    chat = make_chat(20, "Long")
+    logic.save_chat_to_file("userchat/long.chat", chat)
+    logic.save_chat_to_file("autosave/autosave-1.chat", make_chat(2, "Short"))
+    store.flush()
+
+    loaded, rel = logic.load_chat_from_file("long.chat")
+    assert rel == "userchat/long.chat"
+    assert loaded["name"] == "Long"
+    assert len(loaded["messages"]) == 21
+    assert loaded["window"]["first"] == 16
+    assert loaded["messages"][1] is logic.UNLOADED
+    assert logic.chat_messages(loaded) == chat["messages"]
+
+    # A windowed chat saves back without losing the messages it did not load
+    added = {"role": "user", "content": "added to the window"}
+    loaded["messages"].append(added)
+    logic.save_chat_to_file(rel, loaded)
+    store.flush()
+    full, _ = store.load(rel, full=True)
+    assert full["messages"] == chat["messages"] + [added]
+
+    assert {e["file"]: (e["name"], e["messages"]) for e in store.entries()} == {
+        "userchat/long.chat": ("Long", 22),
+        "autosave/autosave-1.chat": ("Short", 3),
+    }
+    assert [e["file"] for e in store.entries("autosave")] == ["autosave/autosave-1.chat"]
+    assert store.get(rel)["messages"] == 22
+    assert {"autosave", "userchat", "archive"} <= set(store.dirs())
+    assert [h["file"] for h in logic.search_all_chats("window")] == [rel]
+
+    assert store.archive(rel)
+    assert store.entries("userchat") == []
+    archived = store.entries("archive")[0]["file"]
+    assert archived == "archive/userchat/long.chat"
+    from_archive, _ = logic.load_chat_from_file(archived)
+    assert logic.chat_messages(from_archive) == full["messages"]
+    # /load with a bare name still finds the archived chat
+    by_name, found = logic.load_chat_from_file("long.chat")
+    assert found == archived
+    assert logic.chat_messages(by_name) == full["messages"]
+
+    assert store.restore(archived)
+    assert [e["file"] for e in store.entries("userchat")] == [rel]
+    assert store.entries("archive") == []
+
+    assert store.archive(rel)
+    assert store.delete(archived)
+    assert store.entries("archive") == []
+    assert logic.load_chat_from_file("long.chat") == (None, None)
+
+
+def test_copy_storage_resumes(history, monkeypatch):
+    files = logic.get_storage("files")
+    sqlite = logic.get_storage("sqlite")
+    chats = {f"userchat/chat-{i}.chat": make_chat(4, f"Chat {i}") for i in range(3)}
+    for rel, chat in list(chats.items())[:2]:
+        files.save(rel, chat)
+    quiet = dict(progress=lambda line: None)
+
+    stats = migrate.copy_storage("files", "sqlite", **quiet)
+    assert stats["counts"] == {"copied": 2}
+    assert stats["errors"] == []
+
+    # Only the chat added since the first copy is copied again
+    rel, chat = list(chats.items())[2]
+    files.save(rel, chat)
+    stats = migrate.copy_storage("files", "sqlite", **quiet)
+    assert stats["resumed"] == 2
+    assert stats["counts"] == {"copied": 1}
+
+    assert sorted(e["file"] for e in sqlite.entries()) == sorted(chats)
+    for rel, chat in chats.items():
+        copied, _ = sqlite.load(rel, full=True)
+        assert copied == chat
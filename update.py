@@ -20,6 +20,13 @@ GITHUB_REPO_URL = "https://raw.githubusercontent.com/Fleench/GroqChat/main/"
 # paths are relative to the repository root.
 LOCAL_FILE_PATHS = [
     "logic.py",
+    "archive_pack.py",
+    "catalog.py",
+    "completion_cache.py",
+    "metrics.py",
+    "session_store.py",
+    "storage.py",
+    "scheduler.py",
     "server.py",
     "static/index.html",
     "static/app.js",